@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.contrib.gis.db.models.fields
+
+
+def fill_simplified_borders(apps, schema_editor):
+    from django.conf import settings
+    from grical.data.models import simplify_borders
+    simplify_borders(apps.get_model("data", "CountryBorder"),
+            apps.get_model("data", "ContinentBorder"),
+            apps.get_model("data", "SimplifiedBorder"),
+            settings.BORDER_SIMPLIFY_TOLERANCES)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0002_country_continent_borders_initial_data'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimplifiedBorder',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('kind', models.CharField(max_length=10, choices=[(b'country', 'Country'), (b'continent', 'Continent')])),
+                ('code', models.CharField(max_length=2)),
+                ('tolerance', models.FloatField()),
+                ('mpoly', django.contrib.gis.db.models.fields.MultiPolygonField(srid=4326)),
+                ('xmin', models.FloatField()),
+                ('ymin', models.FloatField()),
+                ('xmax', models.FloatField()),
+                ('ymax', models.FloatField()),
+            ],
+            options={
+                'verbose_name_plural': 'Simplified Borders',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='simplifiedborder',
+            unique_together=set([('kind', 'code', 'tolerance')]),
+        ),
+        migrations.RunPython(fill_simplified_borders, migrations.RunPython.noop),
+    ]
@@ -24,6 +24,7 @@
 
 # imports {{{1
 from django.contrib.gis.db import models
+from django.contrib.gis.geos import MultiPolygon
 from django.utils.translation import ugettext as _
 
 # DATA from
@@ -79,7 +80,6 @@ CONTINENT_COUNTRIES = {
     'SA': ('AR', 'BO', 'BR', 'CL', 'CO', 'EC', 'FK', 'GF', 'GY', 'PE', 'PY',
     'SR', 'UY', 'VE')}
 
-# TODO GEO: use this data for getting the country out of coordinates
 class CountryBorder(models.Model): # {{{1
     """ contains multi polygons for each iso2 country code and for continent
     codes
@@ -100,7 +100,6 @@ class CountryBorder(models.Model): # {{{1
     def __unicode__(self):
         return self.code
 
-# TODO GEO: simplify the mpolys
 class ContinentBorder(models.Model): # {{{1
     """ contains multi polygons for each continent code.
 
@@ -178,3 +177,53 @@ class ContinentBorder(models.Model): # {{{1
 
     def __unicode__(self):
         return self.code
+
+class SimplifiedBorder(models.Model): # {{{1
+    """ a multi polygon of a :class:`CountryBorder` or a
+    :class:`ContinentBorder` simplified with a tolerance (in degrees) and its
+    extent, see :func:`simplify_borders`. They are used for finding in memory
+    the country or continent of coordinates, see
+    :class:`grical.events.utils.BorderIndex`. """
+    COUNTRY = 'country'
+    CONTINENT = 'continent'
+    kind = models.CharField(max_length=10,
+            choices=((COUNTRY, _('Country')), (CONTINENT, _('Continent'))))
+    code = models.CharField(max_length=2)
+    tolerance = models.FloatField()
+    mpoly = models.MultiPolygonField()
+    xmin = models.FloatField()
+    ymin = models.FloatField()
+    xmax = models.FloatField()
+    ymax = models.FloatField()
+
+    class Meta:
+        unique_together = ("kind", "code", "tolerance")
+        verbose_name_plural = "Simplified Borders"
+
+    def __unicode__(self):
+        return u'%s %s' % (self.code, self.tolerance)
+
+def simplify_borders(country_model, continent_model, simplified_model,
+        tolerances): # {{{1
+    """ replaces the rows of :class:`SimplifiedBorder` with the borders of
+    countries and continents simplified with each of ``tolerances``,
+    returning the number of rows. The models are parameters for using it in
+    migrations. """
+    simplified_model.objects.all().delete()
+    borders = []
+    for kind, model in ((SimplifiedBorder.COUNTRY, country_model),
+            (SimplifiedBorder.CONTINENT, continent_model)):
+        for code, mpoly in model.objects.values_list('code', 'mpoly'):
+            for tolerance in tolerances:
+                simplified = mpoly.simplify(tolerance, preserve_topology=True)
+                if simplified.empty:
+                    continue
+                if simplified.geom_type == 'Polygon':
+                    simplified = MultiPolygon(simplified)
+                simplified.srid = mpoly.srid
+                xmin, ymin, xmax, ymax = simplified.extent
+                borders.append(simplified_model(kind=kind, code=code,
+                    tolerance=tolerance, mpoly=simplified, xmin=xmin,
+                    ymin=ymin, xmax=xmax, ymax=ymax))
+    simplified_model.objects.bulk_create(borders, batch_size=100)
+    return len(borders)
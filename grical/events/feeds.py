@@ -34,7 +34,7 @@ from django.core.urlresolvers import reverse
 from django.conf import settings
 
 from grical.events.models import ( Event, Group, add_upcoming )
-from grical.events.search import search_events
+from grical.events.search import fetch_search_results, search_event_ids
 
 def site_domain():
     return Site.objects.get_current()
@@ -76,10 +76,9 @@ class UpcomingEventsFeed(EventsFeed): # {{{1
     def items( self ):
         """ items """
         today = datetime.date.today()
-        elist = Event.objects.filter(dates__eventdate_date__gte=today )
-        # TODO: test that this really works, ie it returns future events (and
-        # not past events, and not repetitions) sorted by upcoming
-        elist = add_upcoming(elist.distinct()).order_by('upcoming')
+        # next_date is the next upcoming date, see Event.update_next_dates
+        elist = Event.objects.filter( next_date__gte = today )
+        elist = add_upcoming( elist ).order_by('upcoming')
         return elist[0:settings.FEED_SIZE]
 
 class LastAddedEventsFeed(EventsFeed): # {{{1
@@ -119,9 +118,9 @@ class SearchEventsFeed(EventsFeed): # {{{1
 
     def items(self, obj):
         """ items """
-        # TODO: restrict the querysearch in the search to the values needed
-        return add_upcoming( search_events( obj )
-                ).order_by('upcoming').distinct()[0:settings.FEED_SIZE]
+        # the cached ids of the result, only the rows of the feed are fetched
+        return fetch_search_results( search_event_ids(
+            obj, ranked = False )[0:settings.FEED_SIZE] )
 
 class GroupEventsFeed(EventsFeed): # {{{1
     """ feed with the events of a group """
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+# docs {{{1
+""" client of the external geocoding APIs used by :mod:`grical.events.utils`
+
+Requests of each provider (``nominatim``, ``google`` and ``geonames``) go
+through :func:`fetch`, which reuses kept-alive connections, coalesces
+identical requests in flight, respects the requests per second of the
+provider (see :class:`RateLimiter`) and stops calling a failing provider
+for a while (see :class:`CircuitBreaker`). Tests can replace a provider by a
+:class:`FakeProvider` with :func:`set_provider`. """
+
+# imports {{{1
+import httplib
+import socket
+import threading
+import time
+import urllib
+import urlparse
+
+from django.conf import settings
+from django.core.cache import cache
+
+# BASE_URLS of the providers, geonames uses settings.GEONAMES_URL {{{1
+BASE_URLS = {
+    'nominatim': 'http://nominatim.openstreetmap.org/',
+    'google': 'http://maps.googleapis.com/', }
+
+class GeocoderError( IOError ): # {{{1
+    """ raised when a provider cannot answer a request """
+    pass
+
+class GeocoderUnavailable( GeocoderError ): # {{{1
+    """ raised without calling a provider when its circuit is open or its
+    rate limit is exhausted for too long """
+    pass
+
+class RateLimiter( object ): # {{{1
+    """ limits the requests to a provider to ``rate`` per second across all
+    processes. The tokens of each period (one second, or ``1 / rate``
+    seconds for rates below 1) are taken with an atomic increment of a
+    cache key of the period, because the cache has no compare-and-set for
+    refilling a stored bucket. :meth:`acquire` waits for the next period
+    up to ``max_wait`` seconds. """
+
+    def __init__( self, name, rate, max_wait ):
+        self.name = name
+        self.period = max( 1.0, 1.0 / rate )
+        self.tokens = max( 1, int( rate * self.period ) )
+        self.max_wait = max_wait
+
+    def acquire( self ): # {{{2
+        """ takes a token, waiting for it if needed, or raises
+        :class:`GeocoderUnavailable` """
+        deadline = time.time() + self.max_wait
+        while True:
+            now = time.time()
+            window = int( now / self.period )
+            key = 'geocoder_rate:%s:%d' % ( self.name, window )
+            timeout = int( self.period ) + 1
+            cache.add( key, 0, timeout )
+            try:
+                taken = cache.incr( key )
+            except ValueError:
+                # the key expired between add and incr
+                cache.add( key, 1, timeout )
+                taken = 1
+            if taken <= self.tokens:
+                return
+            wait = ( window + 1 ) * self.period - now
+            if now + wait > deadline:
+                raise GeocoderUnavailable(
+                        u'rate limit of %s exhausted' % self.name )
+            time.sleep( wait )
+
+class CircuitBreaker( object ): # {{{1
+    """ stops calling a provider during ``reset_timeout`` seconds after
+    ``threshold`` consecutive failures, across all processes through the
+    cache. Then one trial request is allowed: a success closes the circuit
+    and a failure opens it again. """
+
+    def __init__( self, name, threshold, reset_timeout ):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.open_key = 'geocoder_open:' + name
+        self.failures_key = 'geocoder_failures:' + name
+        self.trial_key = 'geocoder_trial:' + name
+
+    def allow( self ): # {{{2
+        """ returns True if the provider can be called """
+        if cache.get( self.open_key ):
+            return False
+        if ( cache.get( self.failures_key ) or 0 ) >= self.threshold:
+            # half open: only one trial request
+            return cache.add( self.trial_key, True, self.reset_timeout )
+        return True
+
+    def success( self ): # {{{2
+        cache.delete_many( [ self.failures_key, self.trial_key ] )
+
+    def failure( self ): # {{{2
+        cache.add( self.failures_key, 0, self.reset_timeout * 10 )
+        try:
+            failures = cache.incr( self.failures_key )
+        except ValueError:
+            cache.add( self.failures_key, 1, self.reset_timeout * 10 )
+            failures = 1
+        if failures >= self.threshold:
+            cache.set( self.open_key, True, self.reset_timeout )
+
+class _Call( object ): # {{{1
+    """ a request in flight, whose result is shared by identical requests
+    """
+
+    def __init__( self ):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait( self, timeout ):
+        if not self.done.wait( timeout ):
+            raise GeocoderError( u'timeout waiting for a coalesced request' )
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class Provider( object ): # {{{1
+    """ a geocoding API at ``base_url`` with one kept-alive connection per
+    thread, see :func:`fetch` """
+
+    def __init__( self, name, base_url, rate ):
+        self.name = name
+        url = urlparse.urlsplit( base_url )
+        self.secure = url.scheme == 'https'
+        self.host = url.netloc
+        self.prefix = url.path.rstrip( '/' ) + '/'
+        self.timeout = settings.GEOCODER_TIMEOUT
+        self.limiter = RateLimiter( name, rate, settings.GEOCODER_MAX_WAIT )
+        self.breaker = CircuitBreaker( name, settings.GEOCODER_FAILURES,
+                settings.GEOCODER_RESET_TIMEOUT )
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+    def fetch( self, path, params = () ): # {{{2
+        """ returns the body of the response to ``path`` with the query
+        ``params`` (a dictionary or a sequence of pairs). Identical requests
+        of other threads in flight wait for the result of the first one. It
+        raises :class:`GeocoderError`. """
+        if hasattr( params, 'items' ):
+            params = params.items()
+        query = urllib.urlencode( [ ( key, unicode( value ).encode( 'utf-8' ) )
+            for key, value in params ] )
+        url = self.prefix + path + ( '?' + query if query else '' )
+        with self._lock:
+            call = self._in_flight.get( url )
+            first = call is None
+            if first:
+                call = self._in_flight[ url ] = _Call()
+        if not first:
+            return call.wait( self.timeout + settings.GEOCODER_MAX_WAIT )
+        try:
+            call.result = self._fetch( url )
+        except GeocoderError as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[ url ]
+            call.done.set()
+        return call.result
+
+    def _fetch( self, url ): # {{{2
+        if not self.breaker.allow():
+            raise GeocoderUnavailable( u'%s is not available' % self.name )
+        self.limiter.acquire()
+        try:
+            text = self.request( url )
+        except GeocoderError:
+            self.breaker.failure()
+            raise
+        self.breaker.success()
+        return text
+
+    def request( self, url ): # {{{2
+        """ returns the body of the response to GET ``url`` using the
+        connection of the current thread """
+        for attempt in ( 1, 2 ):
+            conn = self._connection()
+            reused = conn.sock is not None
+            try:
+                conn.request( 'GET', url, headers = {
+                    'User-Agent': settings.GEOCODER_USER_AGENT } )
+                response = conn.getresponse()
+                text = response.read()
+            except ( httplib.HTTPException, socket.error ) as err:
+                conn.close()
+                if reused and attempt == 1:
+                    # the server closed the kept-alive connection
+                    continue
+                raise GeocoderError( u'%s: %s' % ( self.name, err ) )
+            if response.status != 200:
+                raise GeocoderError( u'%s: HTTP status %d' % (
+                    self.name, response.status ) )
+            return text
+
+    def _connection( self ): # {{{2
+        conn = getattr( self._local, 'connection', None )
+        if conn is None:
+            if self.secure:
+                conn = httplib.HTTPSConnection( self.host,
+                        timeout = self.timeout )
+            else:
+                conn = httplib.HTTPConnection( self.host,
+                        timeout = self.timeout )
+            self._local.connection = conn
+        return conn
+
+class FakeProvider( Provider ): # {{{1
+    """ a provider for tests answering from ``responses``, a dictionary of
+    paths (without query) to response bodies or to functions of the url
+    returning them. The urls requested are appended to ``requests``. An
+    unknown path is answered as a failure of the provider. """
+
+    def __init__( self, name, responses, rate = 1000 ):
+        super( FakeProvider, self ).__init__( name, 'http://localhost/',
+                rate )
+        self.responses = responses
+        self.requests = []
+
+    def request( self, url ): # {{{2
+        self.requests.append( url )
+        path = urlparse.urlsplit( url ).path.lstrip( '/' )
+        if path not in self.responses:
+            raise GeocoderError( u'%s: HTTP status 404' % self.name )
+        response = self.responses[ path ]
+        if callable( response ):
+            return response( url )
+        return response
+
+# providers {{{1
+_providers = {}
+_providers_lock = threading.Lock()
+
+def get_provider( name ): # {{{2
+    """ returns the :class:`Provider` ``name``, created on first use with
+    the rate of ``settings.GEOCODER_RATES`` """
+    with _providers_lock:
+        if name not in _providers:
+            if name == 'geonames':
+                base_url = settings.GEONAMES_URL
+            else:
+                base_url = BASE_URLS[ name ]
+            _providers[ name ] = Provider( name, base_url,
+                    settings.GEOCODER_RATES[ name ] )
+        return _providers[ name ]
+
+def set_provider( name, provider ): # {{{2
+    """ replaces the provider ``name`` by ``provider`` (e.g. a
+    :class:`FakeProvider`), returning the former one. None restores the
+    default. """
+    with _providers_lock:
+        former = _providers.pop( name, None )
+        if provider is not None:
+            _providers[ name ] = provider
+    return former
+
+def fetch( name, path, params = () ): # {{{2
+    """ returns the body of the response of the provider ``name`` to
+    ``path`` with ``params``, see :meth:`Provider.fetch` """
+    return get_provider( name ).fetch( path, params )
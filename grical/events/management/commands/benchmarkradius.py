@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+""" A management command which measures the latency of radius searches with
+the index of the geography of coordinates compared with distance lookups """
+import sys
+import time
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.contrib.gis.measure import D
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from grical.events.models import Event
+from grical.events.search import radius_q, order_by_distance
+
+# synthetic data {{{1
+# ( longitude, latitude ) of the centers of the synthetic events
+CENTERS = [ ( 13.40, 52.52 ), ( 2.35, 48.86 ), ( -77.04, 38.91 ),
+        ( -58.38, -34.60 ), ( 139.69, 35.69 ), ( 36.82, -1.29 ),
+        ( 151.21, -33.87 ), ( -79.38, 43.65 ), ( 72.88, 19.08 ) ]
+RADII = [ 10, 500, 5000 ]
+SYNTHETIC_EVENTS_SQL = """INSERT INTO events_event (creation_time,
+    modification_time, version, title, coordinates, start_date, next_date,
+    geo_status)
+SELECT now(), now(), 1, 'Radius benchmark ' || w.i,
+    ST_SetSRID(ST_MakePoint(w.lng + (random() - 0.5) * 20,
+        greatest(-89, least(89, w.lat + (random() - 0.5) * 20))), 4326),
+    current_date + (w.i %% 730) - 365, current_date + (w.i %% 730) - 365,
+    'complete'
+FROM (SELECT i,
+    (%(lngs)s::float[])[1 + i %% %(centers_count)s] AS lng,
+    (%(lats)s::float[])[1 + i %% %(centers_count)s] AS lat
+    FROM generate_series(1, %(count)s) AS i) AS w"""
+
+class Command( BaseCommand ): # {{{1
+    """ inserts synthetic events with coordinates and prints the median
+    latency in milliseconds of counting the events within 10, 500 and 5000
+    km of a point with ``distance_lte`` lookups (computing the distance for
+    each row) and with :func:`grical.events.search.radius_q` (using the
+    index of the geography), and of selecting the 20 nearest ones with
+    :func:`grical.events.search.order_by_distance`.
+
+    The synthetic events are deleted at the end (the transaction is rolled
+    back) unless ``--keep`` is given. """
+    help = "Benchmark radius searches on synthetic events (PostgreSQL)"
+
+    def add_arguments( self, parser ): # {{{2
+        parser.add_argument( '--events', type = int, default = 1000000,
+            help = 'number of synthetic events to insert, default 1000000' )
+        parser.add_argument( '--repeat', type = int, default = 5,
+            help = 'number of runs of each search, default 5' )
+        parser.add_argument( '--keep', action = 'store_true',
+            default = False, help = 'keep the synthetic events' )
+
+    def handle( self, *args, **options ): # {{{2
+        """ Executes the action, or do nothing if settings.READ_ONLY is True.
+        """
+        if settings.READ_ONLY == True:
+            return
+        if connection.vendor != 'postgresql':
+            raise CommandError( 'this benchmark needs PostgreSQL' )
+        with transaction.atomic():
+            if options['events']:
+                self.insert_events( options['events'] )
+            self.stdout.write( "%d events\n" % Event.objects.count() )
+            self.stdout.write( "%-10s %14s %14s %14s  %s\n" % ( 'radius',
+                'distance_lte', 'dwithin', 'nearest 20', 'matches' ) )
+            point = Point( *CENTERS[0], srid = 4326 )
+            for km in RADII:
+                self.measure( point, km, options['repeat'] )
+            if not options['keep']:
+                transaction.set_rollback( True )
+
+    def insert_events( self, count ): # {{{2
+        """ inserts *count* synthetic events around :data:`CENTERS` """
+        start = time.time()
+        cursor = connection.cursor()
+        cursor.execute( SYNTHETIC_EVENTS_SQL, {
+            'lngs': [ lng for lng, lat in CENTERS ],
+            'lats': [ lat for lng, lat in CENTERS ],
+            'centers_count': len( CENTERS ), 'count': count, } )
+        cursor.execute( "ANALYZE events_event" )
+        self.stdout.write( "inserted %d events in %.1f seconds\n" % (
+            count, time.time() - start ) )
+
+    def measure( self, point, km, repeat ): # {{{2
+        """ prints the median latencies of the searches within *km* of
+        *point* and the number of matches of each search """
+        meters = km * 1000
+        searches = (
+            lambda: Event.objects.filter( coordinates__distance_lte =
+                ( point, D( m = meters ) ) ).count(),
+            lambda: Event.objects.filter(
+                radius_q( point, meters ) ).count(),
+            lambda: len( order_by_distance( Event.objects.filter(
+                radius_q( point, meters ) ), point ).order_by(
+                    'distance' ).values_list( 'id', flat = True )[ 0:20 ] ), )
+        medians = []
+        matches = []
+        for search in searches:
+            seconds = []
+            for i in range( repeat ):
+                start = time.time()
+                count = search()
+                seconds.append( time.time() - start )
+            medians.append( sorted( seconds )[ len( seconds ) // 2 ] * 1000 )
+            matches.append( str( count ) )
+        self.stdout.write( "%-10s %12.1fms %12.1fms %12.1fms  %s\n" % (
+            '%d km' % km, medians[0], medians[1], medians[2],
+            '/'.join( matches ) ) )
+
+# setting stdout and stderr {{{1
+try:
+    getattr( Command, 'stdout' )
+except AttributeError:
+    Command.stdout = sys.stdout
+try:
+    getattr( Command, 'stderr' )
+except AttributeError:
+    Command.stderr = sys.stderr
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+""" A management command which measures the latency of searching words of
+events with the full-text and trigram indexes of PostgreSQL compared with
+``icontains`` lookups """
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from grical.events.models import Event, SEARCH_DOCUMENT_SQL
+from grical.events.search import full_text_restriction, icontains_restriction
+
+# synthetic data {{{1
+WORDS = [ 'conference', 'workshop', 'python', 'linux', 'meetup', 'festival',
+        'seminar', 'hackathon', 'summit', 'congress', 'symposium', 'kernel',
+        'database', 'security', 'open', 'source', 'music', 'science',
+        'education', 'design', 'photography', 'cinema', 'theatre', 'poetry',
+        'robotics', 'astronomy', 'climate', 'health', 'finance', 'gardening' ]
+CITIES = [ ( 'Washington D.C.', 'US' ), ( 'Berlin', 'DE' ),
+        ( 'Paris', 'FR' ), ( 'Buenos Aires', 'AR' ), ( 'Tokyo', 'JP' ),
+        ( 'Nairobi', 'KE' ), ( 'Sydney', 'AU' ), ( 'Toronto', 'CA' ),
+        ( 'Madrid', 'ES' ), ( 'Athens', 'GR' ), ( 'Mumbai', 'IN' ),
+        ( 'San Francisco', 'US' ), ( 'Frankfurt am Main', 'DE' ) ]
+# queries: complete words, words inside other words, partial words and typos
+QUERIES = [ 'washington', 'conference', 'python workshop', 'hack', 'berl',
+        'frankfurt', 'conferense' ]
+SYNTHETIC_EVENTS_SQL = """INSERT INTO events_event (creation_time,
+    modification_time, version, title, acronym, city, country, tags,
+    start_date, next_date, geo_status)
+SELECT now(), now(), 1,
+    initcap(w.word1) || ' ' || w.word2 || ' ' || w.i,
+    upper(left(w.word1, 4)) || (w.i %% 100),
+    w.city, w.country, w.word1 || ' ' || w.word2,
+    current_date + (w.i %% 730) - 365, current_date + (w.i %% 730) - 365,
+    'complete'
+FROM (SELECT i,
+    (%(words)s::text[])[1 + i %% %(words_count)s] AS word1,
+    (%(words)s::text[])[1 + (i / 7) %% %(words_count)s] AS word2,
+    (%(cities)s::text[])[1 + (i / 3) %% %(cities_count)s] AS city,
+    (%(countries)s::text[])[1 + (i / 3) %% %(cities_count)s] AS country
+    FROM generate_series(1, %(count)s) AS i) AS w"""
+
+class Command( BaseCommand ): # {{{1
+    """ inserts synthetic events and prints the median latency in
+    milliseconds of counting the events matching some words with
+    ``icontains`` lookups (the search of other databases), with the
+    full-text and trigram indexes and with the fuzzy mode, see
+    :func:`grical.events.search.full_text_restriction`.
+
+    The synthetic events are deleted at the end (the transaction is rolled
+    back) unless ``--keep`` is given. """
+    help = "Benchmark the search of words on synthetic events (PostgreSQL)"
+
+    def add_arguments( self, parser ): # {{{2
+        parser.add_argument( '--events', type = int, default = 1000000,
+            help = 'number of synthetic events to insert, default 1000000' )
+        parser.add_argument( '--repeat', type = int, default = 5,
+            help = 'number of runs of each query, default 5' )
+        parser.add_argument( '--keep', action = 'store_true',
+            default = False, help = 'keep the synthetic events' )
+        parser.add_argument( 'queries', nargs = '*',
+            help = 'queries to measure, default: ' + ', '.join( QUERIES ) )
+
+    def handle( self, *args, **options ): # {{{2
+        """ Executes the action, or do nothing if settings.READ_ONLY is True.
+        """
+        if settings.READ_ONLY == True:
+            return
+        if connection.vendor != 'postgresql':
+            raise CommandError( 'this benchmark needs PostgreSQL' )
+        with transaction.atomic():
+            if options['events']:
+                self.insert_events( options['events'] )
+            self.stdout.write( "%d events\n" % Event.objects.count() )
+            self.stdout.write( "%-20s %12s %12s %12s  %s\n" % ( 'query',
+                'icontains', 'full-text', 'fuzzy', 'matches' ) )
+            for query in options['queries'] or QUERIES:
+                self.measure( query, options['repeat'] )
+            if not options['keep']:
+                transaction.set_rollback( True )
+
+    def insert_events( self, count ): # {{{2
+        """ inserts *count* synthetic events with their search documents """
+        start = time.time()
+        last_id = Event.objects.order_by( '-id' ).values_list(
+                'id', flat = True ).first() or 0
+        cursor = connection.cursor()
+        cursor.execute( SYNTHETIC_EVENTS_SQL, {
+            'words': WORDS, 'words_count': len( WORDS ),
+            'cities': [ city for city, country in CITIES ],
+            'countries': [ country for city, country in CITIES ],
+            'cities_count': len( CITIES ), 'count': count, } )
+        cursor.execute( SEARCH_DOCUMENT_SQL + u' WHERE id > %(id)s', {
+            'config': settings.FULL_TEXT_SEARCH_CONFIG, 'id': last_id } )
+        cursor.execute( "ANALYZE events_event" )
+        self.stdout.write( "inserted %d events in %.1f seconds\n" % (
+            count, time.time() - start ) )
+
+    def measure( self, query, repeat ): # {{{2
+        """ prints the median latencies of *query* and the number of
+        matches of each search """
+        words = query.split()
+        searches = (
+            lambda: icontains_restriction(
+                Event.objects.all(), words, False, True ),
+            lambda: full_text_restriction(
+                Event.objects.all(), words, False ),
+            lambda: full_text_restriction(
+                Event.objects.all(), words, False, fuzzy = True ), )
+        medians = []
+        matches = []
+        for search in searches:
+            seconds = []
+            for i in range( repeat ):
+                start = time.time()
+                count = search().count()
+                seconds.append( time.time() - start )
+            medians.append( sorted( seconds )[ len( seconds ) // 2 ] * 1000 )
+            matches.append( str( count ) )
+        self.stdout.write( "%-20s %10.1fms %10.1fms %10.1fms  %s\n" % (
+            query, medians[0], medians[1], medians[2], '/'.join( matches ) ) )
+
+# setting stdout and stderr {{{1
+try:
+    getattr( Command, 'stdout' )
+except AttributeError:
+    Command.stdout = sys.stdout
+try:
+    getattr( Command, 'stderr' )
+except AttributeError:
+    Command.stderr = sys.stderr
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+""" A management command which queues the completion of geo data of pending
+events """
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from grical.events.models import Event
+from grical.events.tasks import complete_geo_data
+
+class Command( BaseCommand ): # {{{1
+    """ queues :func:`grical.events.tasks.complete_geo_data` for the events
+    whose geo data is pending, e.g. after the task queue was not available,
+    and optionally for the events whose completion failed (users were
+    already notified of them, so they are not notified again) """
+    help = "Queue the completion of geo data of pending events"
+
+    def add_arguments( self, parser ): # {{{2
+        parser.add_argument( '--failed', action = 'store_true',
+                default = False,
+                help = 'also retry the events whose completion failed' )
+
+    def handle( self, *args, **options ): # {{{2
+        """ Executes the action, or do nothing if settings.READ_ONLY is True.
+        """
+        if settings.READ_ONLY == True:
+            return
+        events = Event.objects.filter( geo_status = Event.GEO_PENDING )
+        failed = []
+        if options['failed']:
+            failed = Event.objects.filter( geo_status = Event.GEO_FAILED )
+            failed = set( failed.values_list( 'id', flat = True ) )
+            Event.objects.filter( id__in = failed ).update(
+                    geo_status = Event.GEO_PENDING )
+        count = 0
+        for event_id in events.values_list( 'id', flat = True ).iterator():
+            complete_geo_data.delay( event_id,
+                    notify = event_id not in failed )
+            count += 1
+        self.stdout.write( "queued %d events\n" % count )
+
+# setting stdout and stderr {{{1
+try:
+    getattr( Command, 'stdout' )
+except AttributeError:
+    Command.stdout = sys.stdout
+try:
+    getattr( Command, 'stderr' )
+except AttributeError:
+    Command.stderr = sys.stderr
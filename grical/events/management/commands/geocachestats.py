@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+""" A management command which shows the hits and misses of the cache of
+geo lookups """
+import sys
+
+from django.core.management.base import BaseCommand
+
+from grical.events.utils import GEO_CACHE
+
+class Command( BaseCommand ): # {{{1
+    """ shows the number of hits of each tier and the misses of the cache of
+    the results of the external geo APIs, see
+    :class:`grical.events.utils.TieredCache` """
+    help = "Show the hits and misses of the cache of geo lookups"
+
+    def add_arguments( self, parser ): # {{{2
+        parser.add_argument( '--reset', action = 'store_true',
+            default = False, help = 'set the counters to zero afterwards' )
+
+    def handle( self, *args, **options ): # {{{2
+        """ Executes the action """
+        stats = GEO_CACHE.stats()
+        total = sum( stats.values() )
+        for name in ( 'local', 'default', 'db', 'misses' ):
+            ratio = 100.0 * stats[ name ] / total if total else 0.0
+            self.stdout.write( "%s: %d (%.1f%%)\n" % ( name, stats[ name ],
+                ratio ) )
+        if options['reset']:
+            GEO_CACHE.reset_stats()
+
+# setting stdout and stderr {{{1
+try:
+    getattr( Command, 'stdout' )
+except AttributeError:
+    Command.stdout = sys.stdout
+try:
+    getattr( Command, 'stderr' )
+except AttributeError:
+    Command.stderr = sys.stderr
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+""" A management command which rebuilds the reverse index of filters """
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from grical.events.models import Filter
+
+class Command( BaseCommand ): # {{{1
+    """ rebuilds the reverse index of filters used to look up the filters
+    matching a new event, see :mod:`grical.events.percolator` """
+    help = "Rebuild the reverse index of filters"
+
+    def handle( self, *args, **options ): # {{{2
+        """ Executes the action, or do nothing if settings.READ_ONLY is True.
+        """
+        if settings.READ_ONLY == True:
+            return
+        count = 0
+        for fil in Filter.objects.all().iterator():
+            fil.update_index()
+            count += 1
+        self.stdout.write( "indexed %d filters\n" % count )
+
+# setting stdout and stderr {{{1
+try:
+    getattr( Command, 'stdout' )
+except AttributeError:
+    Command.stdout = sys.stdout
+try:
+    getattr( Command, 'stderr' )
+except AttributeError:
+    Command.stderr = sys.stderr
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+""" A management command which loads a GeoNames dump into the gazetteer used
+for looking up names of locations """
+import codecs
+import io
+import os
+import sys
+import zipfile
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from grical.events.models import GazetteerPlace, GazetteerName
+from grical.events.utils import reset_country_names
+
+# languages of the file of alternate names which are not names
+NOT_NAMES = set( [ 'link', 'post', 'iata', 'icao', 'faac', 'fr_1793',
+    'abbr', 'wkdt', 'unlc', 'tcid' ] )
+
+class Command( BaseCommand ): # {{{1
+    """ replaces the rows of :class:`grical.events.models.GazetteerPlace`
+    and :class:`grical.events.models.GazetteerName` with the populated
+    places of a dump of GeoNames (e.g. ``cities1000.zip`` of
+    http://download.geonames.org/export/dump/), optionally the countries of
+    ``countryInfo.txt`` and the names of ``alternateNames.zip`` """
+    help = "Load the cities and countries of a GeoNames dump"
+
+    def add_arguments( self, parser ): # {{{2
+        parser.add_argument( 'cities',
+            help = 'file of GeoNames (.txt or .zip) with the cities' )
+        parser.add_argument( '--countries', default = None,
+            help = 'the file countryInfo.txt of GeoNames' )
+        parser.add_argument( '--alternate-names', default = None,
+            help = 'file of alternate names of GeoNames (.txt or .zip)' )
+        parser.add_argument( '--min-population', type = int, default = 0,
+            help = 'ignore cities with less population' )
+        parser.add_argument( '--batch-size', type = int, default = 5000,
+            help = 'number of rows inserted at once' )
+
+    def handle( self, *args, **options ): # {{{2
+        """ Executes the action, or do nothing if settings.READ_ONLY is True.
+        """
+        if settings.READ_ONLY == True:
+            return
+        # a dictionary geonameid -> ( place, set of names )
+        places = {}
+        for row in read_dump( options['cities'] ):
+            if len( row ) < 15 or row[6] != 'P' or \
+                    int( row[14] or 0 ) < options['min_population']:
+                continue
+            place = GazetteerPlace( id = int( row[0] ), name = row[1][0:200],
+                    country = row[8], feature_code = row[7],
+                    population = int( row[14] or 0 ),
+                    coordinates = Point( float( row[5] ), float( row[4] ) ) )
+            places[ place.id ] = ( place,
+                    set( [ row[1], row[2] ] + row[3].split( ',' ) ) )
+        if options['countries']:
+            coordinates = capitals( places )
+            for row in read_dump( options['countries'] ):
+                if row[0].startswith( '#' ) or len( row ) < 17 or \
+                        not row[16]:
+                    continue
+                place = GazetteerPlace( id = int( row[16] ),
+                        name = row[4][0:200], country = row[0],
+                        feature_code = GazetteerPlace.COUNTRY,
+                        population = int( row[7] or 0 ),
+                        coordinates = coordinates.get(
+                            ( row[0], row[5] ), None ) )
+                places[ place.id ] = ( place, set( [ row[4], row[1] ] ) )
+        if options['alternate_names']:
+            for row in read_dump( options['alternate_names'] ):
+                if len( row ) < 4 or row[2] in NOT_NAMES or \
+                        ( len( row ) > 7 and row[7] == '1' ):
+                    continue
+                entry = places.get( int( row[1] ), None )
+                if entry:
+                    entry[1].add( row[3] )
+        if not places:
+            raise CommandError( "no places found" )
+        names = self.save( places, options['batch_size'] )
+        reset_country_names()
+        self.stdout.write( "loaded %d places with %d names\n" % (
+            len( places ), names ) )
+
+    def save( self, places, batch_size ): # {{{2
+        """ replaces the gazetteer with ``places`` returning the number of
+        names """
+        count = 0
+        with transaction.atomic():
+            GazetteerName.objects.all().delete()
+            GazetteerPlace.objects.all().delete()
+            GazetteerPlace.objects.bulk_create(
+                    [ place for place, names in places.itervalues() ],
+                    batch_size = batch_size )
+            batch = []
+            for place, names in places.itervalues():
+                for name in set( name.strip().lower()[ 0:200 ]
+                        for name in names ):
+                    if not name:
+                        continue
+                    batch.append( GazetteerName( place_id = place.id,
+                        name = name, country = place.country,
+                        population = place.population ) )
+                if len( batch ) >= batch_size:
+                    GazetteerName.objects.bulk_create( batch )
+                    count += len( batch )
+                    batch = []
+            GazetteerName.objects.bulk_create( batch )
+            count += len( batch )
+        return count
+
+def read_dump( path ): # {{{1
+    """ yields the tab separated fields of the lines of a file of GeoNames,
+    which can be a zip file containing a file with the same name and the
+    extension .txt """
+    if not os.path.exists( path ):
+        raise CommandError( "file %s not found" % path )
+    if path.endswith( '.zip' ):
+        archive = zipfile.ZipFile( path )
+        member = os.path.basename( path )[ 0:-4 ] + '.txt'
+        dump = codecs.getreader( 'utf-8' )( archive.open( member ) )
+    else:
+        dump = io.open( path, encoding = 'utf-8' )
+    with dump:
+        for line in dump:
+            yield line.rstrip( u'\r\n' ).split( u'\t' )
+
+def capitals( places ): # {{{1
+    """ returns a dictionary ( country, name ) -> coordinates of the cities
+    of ``places``, used as coordinates of the countries with the name of the
+    capital. Among cities with the same name the biggest one is chosen. """
+    biggest = {}
+    for place, names in places.itervalues():
+        key = ( place.country, place.name )
+        if key not in biggest or \
+                place.population > biggest[ key ].population:
+            biggest[ key ] = place
+    return dict( ( key, place.coordinates )
+            for key, place in biggest.iteritems() )
+
+# setting stdout and stderr {{{1
+try:
+    getattr( Command, 'stdout' )
+except AttributeError:
+    Command.stdout = sys.stdout
+try:
+    getattr( Command, 'stderr' )
+except AttributeError:
+    Command.stderr = sys.stderr
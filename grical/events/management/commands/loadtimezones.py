@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+""" A management command which loads the polygons of timezones used for
+looking up the timezone of coordinates """
+import sys
+
+from django.conf import settings
+from django.contrib.gis.gdal import DataSource, GDALException
+from django.contrib.gis.geos import MultiPolygon
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from grical.events.models import TimezoneBoundary
+from grical.events.utils import reset_timezone_polygons
+
+class Command( BaseCommand ): # {{{1
+    """ replaces the rows of :class:`grical.events.models.TimezoneBoundary`
+    with the polygons of a file readable by GDAL (e.g. the GeoJSON or the
+    shapefile of https://github.com/evansiroky/timezone-boundary-builder).
+    Running processes keep the simplified polygons they already read until
+    they are restarted. """
+    help = "Load the polygons of timezones"
+
+    def add_arguments( self, parser ): # {{{2
+        parser.add_argument( 'path',
+            help = 'file with the polygons (e.g. GeoJSON or shapefile)' )
+        parser.add_argument( '--field', default = 'tzid',
+            help = 'field with the name of the timezone, default: tzid' )
+
+    def handle( self, *args, **options ): # {{{2
+        """ Executes the action, or do nothing if settings.READ_ONLY is True.
+        """
+        if settings.READ_ONLY == True:
+            return
+        try:
+            layer = DataSource( options['path'] )[0]
+        except ( GDALException, IndexError ) as err:
+            raise CommandError( "cannot read %s: %s" % (
+                options['path'], err ) )
+        count = 0
+        with transaction.atomic():
+            TimezoneBoundary.objects.all().delete()
+            for feature in layer:
+                geometry = feature.geom
+                if geometry.srid and geometry.srid != 4326:
+                    geometry.transform( 4326 )
+                polygon = as_multipolygon( geometry.geos )
+                simplified = as_multipolygon( polygon.simplify(
+                    settings.TIMEZONE_SIMPLIFY_TOLERANCE,
+                    preserve_topology = True ) )
+                TimezoneBoundary.objects.create(
+                        name = feature.get( options['field'] ),
+                        polygon = polygon,
+                        simplified = simplified or polygon )
+                count += 1
+        reset_timezone_polygons()
+        self.stdout.write( "loaded %d timezones\n" % count )
+
+def as_multipolygon( geometry ): # {{{1
+    """ returns ``geometry`` as a ``MultiPolygon``, or None if it is empty
+    """
+    if geometry.empty:
+        return None
+    if geometry.geom_type == 'Polygon':
+        geometry = MultiPolygon( geometry )
+    geometry.srid = 4326
+    return geometry
+
+# setting stdout and stderr {{{1
+try:
+    getattr( Command, 'stdout' )
+except AttributeError:
+    Command.stdout = sys.stdout
+try:
+    getattr( Command, 'stderr' )
+except AttributeError:
+    Command.stderr = sys.stderr
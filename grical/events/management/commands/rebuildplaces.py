@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+""" A management command which rebuilds the places of the events """
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from grical.events.models import EventPlace
+
+class Command( BaseCommand ): # {{{1
+    """ aggregates the cities and countries of the events in
+    :class:`EventPlace`, used by :func:`utils.search_name` before the
+    gazetteer and the GeoNames API. Only changed places are saved, so that
+    it can run often, e.g. daily with cron. """
+    help = "Rebuild the places of the events, to be run periodically"
+
+    def handle( self, *args, **options ): # {{{2
+        """ Executes the action, or do nothing if settings.READ_ONLY is True.
+        """
+        if settings.READ_ONLY == True:
+            return
+        created, updated, deleted = EventPlace.objects.rebuild()
+        self.stdout.write( "places: %d created, %d updated, %d deleted\n" % (
+            created, updated, deleted ) )
+
+# setting stdout and stderr {{{1
+try:
+    getattr( Command, 'stdout' )
+except AttributeError:
+    Command.stdout = sys.stdout
+try:
+    getattr( Command, 'stderr' )
+except AttributeError:
+    Command.stderr = sys.stderr
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+""" A management command which simplifies the borders of countries and
+continents """
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from grical.data.models import (CountryBorder, ContinentBorder,
+        SimplifiedBorder, simplify_borders)
+
+class Command( BaseCommand ): # {{{1
+    """ replaces the rows of :class:`grical.data.models.SimplifiedBorder`
+    with the borders of countries and continents simplified with each
+    tolerance of ``settings.BORDER_SIMPLIFY_TOLERANCES``. Running processes
+    keep the borders they already read until they are restarted. """
+    help = "Simplify the borders of countries and continents"
+
+    def handle( self, *args, **options ): # {{{2
+        """ Executes the action, or do nothing if settings.READ_ONLY is True.
+        """
+        if settings.READ_ONLY == True:
+            return
+        count = simplify_borders( CountryBorder, ContinentBorder,
+                SimplifiedBorder, settings.BORDER_SIMPLIFY_TOLERANCES )
+        self.stdout.write( "simplified %d borders\n" % count )
+
+# setting stdout and stderr {{{1
+try:
+    getattr( Command, 'stdout' )
+except AttributeError:
+    Command.stdout = sys.stdout
+try:
+    getattr( Command, 'stderr' )
+except AttributeError:
+    Command.stderr = sys.stderr
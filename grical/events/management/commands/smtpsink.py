@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+""" A management command which runs a local SMTP server discarding all emails,
+    useful for load tests of notifications """
+import asyncore
+import smtpd
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+class SinkServer( smtpd.SMTPServer ): # {{{1
+    """ SMTP server which counts and discards the received emails """
+    def __init__( self, localaddr, stdout ):
+        smtpd.SMTPServer.__init__( self, localaddr, None )
+        self.stdout = stdout
+        self.count = 0
+        self.started = time.time()
+
+    def process_message( self, peer, mailfrom, rcpttos, data ):
+        self.count += 1
+        if self.count % 100 == 0:
+            self.stdout.write( "%d emails received, %.1f per second\n" % (
+                self.count, self.count / ( time.time() - self.started ) ) )
+
+class Command( BaseCommand ): # {{{1
+    """ runs a local SMTP server which discards all emails. To send emails to
+    it set ``EMAIL_BACKEND`` to
+    ``django.core.mail.backends.smtp.EmailBackend`` and ``EMAIL_PORT`` to the
+    port """
+    help = "Run a local SMTP server which counts and discards all emails"
+
+    def add_arguments( self, parser ): # {{{2
+        parser.add_argument( '--host', default = 'localhost' )
+        parser.add_argument( '--port', type = int, default = 1025 )
+
+    def handle( self, *args, **options ): # {{{2
+        server = SinkServer( ( options['host'], options['port'] ),
+                self.stdout )
+        self.stdout.write( "SMTP sink listening on %s:%d\n" % (
+            options['host'], options['port'] ) )
+        try:
+            asyncore.loop()
+        except KeyboardInterrupt:
+            self.stdout.write( "%d emails received\n" % server.count )
+
+# setting stdout and stderr {{{1
+try:
+    getattr( Command, 'stdout' )
+except AttributeError:
+    Command.stdout = sys.stdout
+try:
+    getattr( Command, 'stderr' )
+except AttributeError:
+    Command.stderr = sys.stderr
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+""" A management command which recounts the co-occurrences of the tags of
+events """
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from grical.tagging.models import TagCooccurrence
+
+from grical.events.models import Event
+
+class Command( BaseCommand ): # {{{1
+    """ rebuilds the rows of :class:`grical.tagging.models.TagCooccurrence`
+    for events, which are used for adding related events to searches. The
+    rows are updated when the tags of events change, so that it is only
+    needed if they were changed bypassing the tag manager. """
+    help = "Recount the co-occurrences of the tags of all events"
+
+    def handle( self, *args, **options ): # {{{2
+        """ Executes the action, or do nothing if settings.READ_ONLY is True.
+        """
+        if settings.READ_ONLY == True:
+            return
+        count = TagCooccurrence.objects.rebuild( Event )
+        self.stdout.write( "rebuilt %d co-occurrences\n" % count )
+
+# setting stdout and stderr {{{1
+try:
+    getattr( Command, 'stdout' )
+except AttributeError:
+    Command.stdout = sys.stdout
+try:
+    getattr( Command, 'stderr' )
+except AttributeError:
+    Command.stderr = sys.stderr
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# NOTE: the index of existing filters is filled with the command indexfilters
+# after migrating, because the keys need the lookups of places of the current
+# models (and maybe the network)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FilterIndexEntry',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('key', models.CharField(max_length=100, verbose_name='Key', db_index=True)),
+                ('filter', models.ForeignKey(related_name='index_entries', verbose_name='Filter', to='events.Filter')),
+            ],
+            options={
+                'verbose_name': 'Filter index entry',
+                'verbose_name_plural': 'Filter index entries',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='filterindexentry',
+            unique_together=set([('filter', 'key')]),
+        ),
+    ]
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0003_pendingnotification'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationRun',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('shards', models.PositiveIntegerField(verbose_name='Shards')),
+                ('pending_shards', models.PositiveIntegerField(verbose_name='Pending shards')),
+                ('matches', models.PositiveIntegerField(default=0, verbose_name='Matches')),
+                ('matching_seconds', models.FloatField(default=0, help_text='Sum of the times of all shards', verbose_name='Matching seconds')),
+                ('creation_time', models.DateTimeField(auto_now_add=True, verbose_name='Creation time')),
+                ('completion_time', models.DateTimeField(null=True, verbose_name='Completion time', blank=True)),
+                ('event', models.ForeignKey(verbose_name='Event', to='events.Event')),
+            ],
+            options={
+                'verbose_name': 'Notification run',
+                'verbose_name_plural': 'Notification runs',
+            },
+        ),
+    ]
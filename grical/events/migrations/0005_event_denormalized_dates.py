@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+from __future__ import unicode_literals
+
+import datetime
+
+from django.db import migrations, models
+
+
+def fill_dates(apps, schema_editor):
+    Event = apps.get_model("events", "Event")
+    EventDate = apps.get_model("events", "EventDate")
+    today = datetime.date.today()
+    columns = {}
+    for event_id, name, date in EventDate.objects.values_list(
+            'event_id', 'eventdate_name', 'eventdate_date').iterator():
+        start, end, next_date = columns.get(event_id, (None, None, None))
+        if name == 'start':
+            start = date
+        elif name == 'end':
+            end = date
+        if date >= today and (next_date is None or date < next_date):
+            next_date = date
+        columns[event_id] = (start, end, next_date)
+    for event_id, (start, end, next_date) in columns.items():
+        Event.objects.filter(pk=event_id).update(start_date=start,
+                end_date=end, next_date=next_date or start)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0004_notificationrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='start_date',
+            field=models.DateField(verbose_name='Start date', null=True, editable=False, blank=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='end_date',
+            field=models.DateField(verbose_name='End date', null=True, editable=False, blank=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='next_date',
+            field=models.DateField(verbose_name='Next date', null=True, editable=False, blank=True, db_index=True),
+        ),
+        migrations.RunPython(fill_dates, migrations.RunPython.noop),
+    ]
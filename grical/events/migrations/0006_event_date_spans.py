@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+from __future__ import unicode_literals
+
+import datetime
+
+from django.db import migrations
+
+
+def delete_ongoing_dates(apps, schema_editor):
+    EventDate = apps.get_model("events", "EventDate")
+    EventDate.objects.filter(eventdate_name='ongoing').delete()
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            "CREATE INDEX events_event_span_gist ON events_event "
+            "USING gist (daterange(start_date, end_date, '[]')) "
+            "WHERE end_date IS NOT NULL")
+
+
+def create_ongoing_dates(apps, schema_editor):
+    Event = apps.get_model("events", "Event")
+    EventDate = apps.get_model("events", "EventDate")
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX IF EXISTS events_event_span_gist")
+    for event_id, start, end in Event.objects.filter(
+            end_date__isnull=False).values_list(
+                'id', 'start_date', 'end_date').iterator():
+        EventDate.objects.bulk_create([
+            EventDate(event_id=event_id, eventdate_name='ongoing',
+                eventdate_date=start + datetime.timedelta(days=days))
+            for days in range(1, (end - start).days)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0005_event_denormalized_dates'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_ongoing_dates, create_ongoing_dates),
+    ]
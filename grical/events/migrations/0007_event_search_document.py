@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+from __future__ import unicode_literals
+
+import django.contrib.postgres.search
+from django.conf import settings
+from django.db import migrations
+
+SEARCH_DOCUMENT_SQL = """UPDATE events_event SET search_document =
+    setweight(to_tsvector(%(config)s::regconfig,
+        coalesce(title, '')), 'A') ||
+    setweight(to_tsvector(%(config)s::regconfig,
+        concat_ws(' ', acronym, tags)), 'B') ||
+    setweight(to_tsvector(%(config)s::regconfig,
+        concat_ws(' ', city, country)), 'C') ||
+    setweight(to_tsvector(%(config)s::regconfig, concat_ws(' ',
+        address, description,
+        (SELECT string_agg(url_name || ' ' || url, ' ') FROM events_eventurl
+            WHERE event_id = events_event.id),
+        (SELECT string_agg(eventdate_name, ' ') FROM events_eventdate
+            WHERE event_id = events_event.id),
+        (SELECT string_agg(session_name, ' ') FROM events_eventsession
+            WHERE event_id = events_event.id))), 'D')"""
+
+
+def create_search_documents(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        "CREATE INDEX events_event_search_document_gin ON events_event "
+        "USING gin (search_document)")
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(SEARCH_DOCUMENT_SQL,
+            {'config': settings.FULL_TEXT_SEARCH_CONFIG})
+
+
+def drop_search_document_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        "DROP INDEX IF EXISTS events_event_search_document_gin")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0006_event_date_spans'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='search_document',
+            field=django.contrib.postgres.search.SearchVectorField(null=True, editable=False),
+        ),
+        migrations.RunPython(create_search_documents,
+            drop_search_document_index),
+    ]
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.contrib.gis.db.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0008_event_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GazetteerPlace',
+            fields=[
+                ('id', models.IntegerField(serialize=False, verbose_name='GeoNames id', primary_key=True)),
+                ('name', models.CharField(max_length=200, verbose_name='Name')),
+                ('country', models.CharField(max_length=2, verbose_name='Country')),
+                ('feature_code', models.CharField(max_length=10, verbose_name='Feature code')),
+                ('population', models.BigIntegerField(default=0, verbose_name='Population')),
+                ('coordinates', django.contrib.gis.db.models.fields.PointField(srid=4326, null=True, verbose_name='Coordinates', blank=True)),
+            ],
+            options={
+                'verbose_name': 'Gazetteer place',
+                'verbose_name_plural': 'Gazetteer places',
+            },
+        ),
+        migrations.CreateModel(
+            name='GazetteerName',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=200, verbose_name='Name')),
+                ('country', models.CharField(max_length=2, verbose_name='Country')),
+                ('population', models.BigIntegerField(default=0, verbose_name='Population')),
+                ('place', models.ForeignKey(related_name='names', verbose_name='Place', to='events.GazetteerPlace')),
+            ],
+            options={
+                'verbose_name': 'Gazetteer name',
+                'verbose_name_plural': 'Gazetteer names',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='gazetteername',
+            unique_together=set([('place', 'name')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='gazetteername',
+            index_together=set([('name', 'country', 'population')]),
+        ),
+    ]
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.contrib.gis.db.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0009_gazetteer'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimezoneBoundary',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=50, verbose_name='Name')),
+                ('polygon', django.contrib.gis.db.models.fields.MultiPolygonField(srid=4326, verbose_name='Polygon')),
+                ('simplified', django.contrib.gis.db.models.fields.MultiPolygonField(help_text='Polygon simplified with the tolerance TIMEZONE_SIMPLIFY_TOLERANCE', srid=4326, spatial_index=False, verbose_name='Simplified polygon')),
+            ],
+            options={
+                'verbose_name': 'Timezone boundary',
+                'verbose_name_plural': 'Timezone boundaries',
+            },
+        ),
+    ]
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def fill_continents(apps, schema_editor):
+    Event = apps.get_model("events", "Event")
+    ContinentBorder = apps.get_model("data", "ContinentBorder")
+    for code, mpoly in ContinentBorder.objects.values_list('code', 'mpoly'):
+        Event.objects.filter(coordinates__within=mpoly).update(continent=code)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0003_simplifiedborder'),
+        ('events', '0010_timezoneboundary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='continent',
+            field=models.CharField(blank=True, editable=False, choices=[(b'AF', 'Africa'), (b'AS', 'Asia'), (b'EU', 'Europe'), (b'NA', 'North America'), (b'SA', 'South America'), (b'OC', 'Oceania'), (b'AN', 'Antarctica')], max_length=2, null=True, verbose_name='Continent', db_index=True),
+        ),
+        migrations.RunPython(fill_continents, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.contrib.gis.db.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0013_event_geo_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventPlace',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(help_text='City normalized with normalize_name', max_length=200, verbose_name='Name')),
+                ('country', models.CharField(blank=True, max_length=2, verbose_name='Country')),
+                ('coordinates', django.contrib.gis.db.models.fields.PointField(srid=4326, verbose_name='Coordinates')),
+                ('events', models.PositiveIntegerField(default=0, verbose_name='Events')),
+                ('aliases', models.TextField(help_text='The spellings of the city in the events, one per line, the most used first', verbose_name='Aliases')),
+                ('modification_time', models.DateTimeField(auto_now=True, verbose_name='Modification time')),
+            ],
+            options={
+                'verbose_name': 'Event place',
+                'verbose_name_plural': 'Event places',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='eventplace',
+            unique_together=set([('name', 'country')]),
+        ),
+    ]
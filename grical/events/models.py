@@ -36,23 +36,28 @@ from django.contrib.auth.models import User, AnonymousUser
 from django.contrib.gis.db import models
 from django.contrib.gis.db.models import Q, F
 from django.contrib.gis.geos import Point
+from django.contrib.postgres.search import SearchVectorField
 from django.contrib.sites.models import Site
 from django.core.exceptions import ValidationError
 from django.core.mail import EmailMessage
 from django.core.validators import RegexValidator, URLValidator
-from django.db.models import Min
+from django.db import connection, transaction
 from django.db.models.signals import post_save
+from django.dispatch import Signal
 from django.forms import DateField
 from django.template.loader import render_to_string
 from django.utils.encoding import smart_str, smart_unicode
 from django.utils.translation import ugettext_lazy as _
 
+from grical.data.models import CONTINENTS
 from grical.tagging.fields import TagField
 from grical.tagging.models import Tag
+from grical.tagging.utils import parse_tag_input
 
 from grical.events.utils import (exact_as_bool_str,  validate_year,
         search_name, search_coordinates, search_address, search_timezone,
-        search_country_code, validate_tags_chars)
+        search_country_code, validate_tags_chars, reverse_geocode,
+        search_continent, normalize_name, COUNTRY_NAMES)
 
 # COUNTRIES {{{1
 # TODO: use instead a client library from http://www.geonames.org/ accepting
@@ -786,6 +791,9 @@ TIMEZONES = (
         ( 'UTC', _( 'UTC' ) ), )
     )
 )
+TIMEZONE_NAMES = frozenset( [ timezone[0] for group in TIMEZONES
+    for timezone in group[1] ] )
+""" the names of :data:`TIMEZONES` """
 
 # EXAMPLE {{{1
 EXAMPLE = u"""acronym: GriCal
@@ -814,6 +822,25 @@ sessions:
 description:
 Grical will be presented"""
 
+# SEARCH_DOCUMENT_SQL {{{1
+# weighted full-text search document of events (PostgreSQL only), see
+# Event.update_search_document
+SEARCH_DOCUMENT_SQL = u"""UPDATE events_event SET search_document =
+    setweight(to_tsvector(%(config)s::regconfig,
+        coalesce(title, '')), 'A') ||
+    setweight(to_tsvector(%(config)s::regconfig,
+        concat_ws(' ', acronym, tags)), 'B') ||
+    setweight(to_tsvector(%(config)s::regconfig,
+        concat_ws(' ', city, country)), 'C') ||
+    setweight(to_tsvector(%(config)s::regconfig, concat_ws(' ',
+        address, description,
+        (SELECT string_agg(url_name || ' ' || url, ' ') FROM events_eventurl
+            WHERE event_id = events_event.id),
+        (SELECT string_agg(eventdate_name, ' ') FROM events_eventdate
+            WHERE event_id = events_event.id),
+        (SELECT string_agg(session_name, ' ') FROM events_eventsession
+            WHERE event_id = events_event.id))), 'D')"""
+
 # TODO: add alters_data=True to all functions that do that.
 # see http://docs.djangoproject.com/en/1.2/ref/templates/api/
 
@@ -848,6 +875,11 @@ class Event( models.Model ): # {{{1 pylint: disable-msg=R0904
             validators = [validate_tags_chars] )
     country = models.CharField( _( u'Country' ), blank = True, null = True,
             max_length = 2, choices = COUNTRIES )
+    continent = models.CharField( _( u'Continent' ), editable = False,
+            blank = True, null = True, max_length = 2, choices = CONTINENTS,
+            db_index = True )
+    """ continent of the coordinates, set in :meth:`save` for restricting
+    searches to continents without geometric operations """
     address = models.CharField( _( u'Location' ), blank = True,
             null = True, max_length = 200,
             help_text = _( u'Complete address including city and country. ' \
@@ -864,12 +896,41 @@ class Event( models.Model ): # {{{1 pylint: disable-msg=R0904
                 'the same city or town'))
     # in forms 'exact' is a select field with the values '1', '2' and '3' for
     # Unknown, Yes and No respectively
+    GEO_PENDING = 'pending'
+    GEO_COMPLETE = 'complete'
+    GEO_FAILED = 'failed'
+    GEO_STATUSES = (
+        ( GEO_PENDING, _( u'pending' ) ),
+        ( GEO_COMPLETE, _( u'complete' ) ),
+        ( GEO_FAILED, _( u'failed' ) ), )
+    GEO_FIELDS = ( 'address', 'city', 'country', 'coordinates', 'exact',
+            'timezone' )
+    """ fields completed by :meth:`complete_geo_data` """
+    geo_status = models.CharField( _( u'Geo data' ), editable = False,
+            max_length = 8, choices = GEO_STATUSES, default = GEO_COMPLETE,
+            db_index = True )
+    """ ``pending`` while :func:`tasks.complete_geo_data` is completing the
+    geo data in the background, see :meth:`queue_geo_completion` """
     description = models.TextField(
             _( u'Description' ), blank = True, null = True,
             help_text = _( u'For formating use <a href="http://docutils.' \
                 'sourceforge.net/docs/user/rst/quickref.html">' \
                 'ReStructuredText</a> syntax. Events can be referenced with' \
                 ' for instance :e:`123`' ) )
+    # denormalized dates, kept up to date by EventDate.save and
+    # EventDate.delete, see :meth:`update_dates_columns`
+    start_date = models.DateField( _( u'Start date' ), editable = False,
+            blank = True, null = True, db_index = True )
+    end_date = models.DateField( _( u'End date' ), editable = False,
+            blank = True, null = True, db_index = True )
+    next_date = models.DateField( _( u'Next date' ), editable = False,
+            blank = True, null = True, db_index = True )
+    """ next upcoming date, or start if all are in the past. It is refreshed
+    nightly by :meth:`update_next_dates` """
+    search_document = SearchVectorField( editable = False, null = True )
+    """ weighted full-text search document: title (A), acronym and tags
+    (B), city and country (C) and the rest (D). Only maintained in
+    PostgreSQL, see :meth:`update_search_document` """
 
     objects = models.GeoManager() # {{{2
 
@@ -900,6 +961,8 @@ class Event( models.Model ): # {{{1 pylint: disable-msg=R0904
     def _get_startdate(self):
         if hasattr(self, 'startdate_cache') and self.startdate_cache:
             return self.startdate_cache
+        if self.start_date:
+            return self.start_date
         try:
             eventdate = self.dates.get(eventdate_name='start')
         except EventDate.DoesNotExist:
@@ -928,6 +991,9 @@ class Event( models.Model ): # {{{1 pylint: disable-msg=R0904
     def _get_enddate(self):
         if hasattr(self, 'enddate_cache') and self.enddate_cache:
             return self.enddate_cache
+        if self.start_date:
+            # the denormalized dates are set
+            return self.end_date
         try:
             eventdate = self.dates.get(eventdate_name='end')
         except EventDate.DoesNotExist:
@@ -957,11 +1023,7 @@ class Event( models.Model ): # {{{1 pylint: disable-msg=R0904
     # read only countryname property {{{3
     @property
     def countryname(self):
-        if self.country:
-            for code_country in COUNTRIES:
-                if code_country[0] == self.country:
-                    return code_country[1]
-        return None
+        return COUNTRY_NAMES.name( self.country )
 
     # read only upcomingdate property {{{3
     @property
@@ -970,6 +1032,9 @@ class Event( models.Model ): # {{{1 pylint: disable-msg=R0904
         if hasattr( self, 'upcomingdate_cache' ) and self.upcomingdate_cache:
             return self.upcomingdate_cache
         today = datetime.date.today()
+        if self.next_date and self.next_date >= today:
+            # not outdated
+            return self.next_date
         future_dates = EventDate.objects.filter(
                 event = self, eventdate_date__gte = today )
         if future_dates:
@@ -1320,6 +1385,7 @@ class Event( models.Model ): # {{{1 pylint: disable-msg=R0904
                     pass
         # Call the "real" delete() method:
         super( Event, self ).delete( *args, **kwargs )
+        self.search_results_changed()
         # if the recurrences contains only one event, we delete it
         if recurring:
             recurrences = Recurrence.objects.filter( master = master )
@@ -1401,6 +1467,17 @@ class Event( models.Model ): # {{{1 pylint: disable-msg=R0904
                         if not self.country and result.has_key('country'):
                             self.country = result['country']
                         self.exact = True
+        if self.coordinates and not (self.city and self.country):#{{{4
+            # without network, with the borders of countries and the gazetteer
+            result = reverse_geocode( self.latitude, self.longitude,
+                    city = not self.city )
+            if result:
+                if not self.country:
+                    something_completed = True
+                    self.country = result['country']
+                if not self.city and result['city']:
+                    something_completed = True
+                    self.city = result['city']
         if self.coordinates and not (self.address and self.city and self.country):#{{{4
             result = search_coordinates( self.latitude, self.longitude )
             if result:
@@ -1425,13 +1502,27 @@ class Event( models.Model ): # {{{1 pylint: disable-msg=R0904
             self.country = search_country_code( self.country )
         return something_completed
 
+    def queue_geo_completion( self, ip ): #{{{3
+        """ marks the event as pending (to be saved by the caller) and queues
+        :func:`tasks.complete_geo_data` after the commit of the current
+        transaction, so that :meth:`complete_geo_data` with its calls to
+        external APIs runs outside of the request """
+        from .tasks import complete_geo_data
+        self.geo_status = Event.GEO_PENDING
+        transaction.on_commit(
+                lambda: complete_geo_data.delay( self.id, ip ) )
+
     def save( self, *args, **kwargs ): #{{{3
         """ Marks an event as new or not (for :meth:`Event.post_save`), deals
         with address data, update the master of a recurrence if appropiate, and
         deletes caches of properties.
         """
         assert not settings.READ_ONLY
-        if Event.objects.filter( id = self.id ).exists():
+        # former values for invalidating cached search results
+        old_values = Event.objects.filter( id = self.id ).values_list(
+                'tags', 'city', 'country' ).first()
+        existed = old_values is not None
+        if existed:
             self.version = self.version + 1
         if self.recurring:
             if self.enddate:
@@ -1446,6 +1537,11 @@ class Event( models.Model ): # {{{1 pylint: disable-msg=R0904
             events.exclude( pk = self.pk ).update( version = F('version') + 1 )
         # dealing with the country name
         self.country = search_country_code( self.country )
+        if self.coordinates:
+            self.continent = search_continent(
+                    self.coordinates.y, self.coordinates.x )
+        else:
+            self.continent = None
         # Call the "real" save() method:
         super( Event, self ).save( *args, **kwargs )
         # deletes caches
@@ -1455,20 +1551,109 @@ class Event( models.Model ): # {{{1 pylint: disable-msg=R0904
             delattr( self, 'enddate_cache')
         if hasattr( self, 'upcomingdate_cache'):
             delattr( self, 'upcomingdate_cache')
+        if existed:
+            # the denormalized dates of self could have been outdated
+            self.update_dates_columns()
+        self.update_search_document()
+        if existed:
+            self.search_results_changed( *old_values )
+        else:
+            self.search_results_changed()
+
+    def search_results_changed( self, tags = None, city = None,
+            country = None ): #{{{3
+        """ invalidates the cached search results which can contain
+        ``self``, see :func:`grical.events.search.search_event_ids`.
+        ``tags``, ``city`` and ``country`` are former values of the event.
+        """
+        from grical.events.search import bump_search_generations
+        tags = set( parse_tag_input( self.tags ) ) | \
+                set( parse_tag_input( tags ) )
+        places = set( [ self.city, self.country, city, country ] )
+        bump_search_generations( tags, [ place for place in places if place ] )
+
+    def update_search_document( self ): #{{{3
+        """ updates in the DB the full-text search document
+        :attr:`search_document` from the fields of the event and the names
+        of its urls, dates and sessions. It does nothing if the database is
+        not PostgreSQL. """
+        if connection.vendor != 'postgresql':
+            return
+        cursor = connection.cursor()
+        cursor.execute( SEARCH_DOCUMENT_SQL + u' WHERE id = %(id)s', {
+            'config': settings.FULL_TEXT_SEARCH_CONFIG, 'id': self.pk } )
+
+    @staticmethod # def update_search_documents(): {{{3
+    def update_search_documents():
+        """ updates :attr:`search_document` of all events, e.g. after
+        changing ``settings.FULL_TEXT_SEARCH_CONFIG``. Returns the number of
+        updated events, or None if the database is not PostgreSQL. """
+        if connection.vendor != 'postgresql':
+            return None
+        cursor = connection.cursor()
+        cursor.execute( SEARCH_DOCUMENT_SQL, {
+            'config': settings.FULL_TEXT_SEARCH_CONFIG } )
+        return cursor.rowcount
+
+    def update_dates_columns( self, **kwargs ): #{{{3
+        """ updates in the DB and in ``self`` the denormalized dates
+        :attr:`start_date`, :attr:`end_date` and :attr:`next_date` and the
+        fields in ``kwargs`` """
+        today = datetime.date.today()
+        start = end = next_date = None
+        for name, date in EventDate.objects.filter( event = self ).values_list(
+                'eventdate_name', 'eventdate_date' ):
+            if name == 'start':
+                start = date
+            elif name == 'end':
+                end = date
+            if date >= today and ( next_date is None or date < next_date ):
+                next_date = date
+        if start and end and start < today <= end:
+            # the event is ongoing
+            next_date = today
+        kwargs.update( { 'start_date': start, 'end_date': end,
+            'next_date': next_date or start, } )
+        Event.objects.filter( pk = self.pk ).update( **kwargs )
+        for field, value in kwargs.items():
+            setattr( self, field, value )
+        for cache in ( 'startdate_cache', 'enddate_cache',
+                'upcomingdate_cache' ):
+            if hasattr( self, cache ):
+                delattr( self, cache )
+
+    @staticmethod # def update_next_dates(): {{{3
+    def update_next_dates():
+        """ updates :attr:`next_date` of events with a next date in the
+        past. Returns the number of updated events. It should run daily, see
+        the management command ``updatenextdates``. """
+        today = datetime.date.today()
+        events = Event.objects.filter( next_date__lt = today ).filter(
+                Q( dates__eventdate_date__gte = today ) |
+                ~Q( next_date = F( 'start_date' ) ) ).distinct()
+        count = 0
+        for event in events.only( 'id', 'version' ):
+            event.update_dates_columns()
+            count += 1
+        return count
 
     @staticmethod # def post_save( sender, **kwargs ): {{{3
     def post_save(sender, instance, created, **kwargs):
         """ notify users if a filter of a user matches an event but only for
-        new events.
+        new events. New events with pending geo data are notified by
+        :func:`tasks.complete_geo_data` once their location is known.
         """
         event = instance
         if not created:
             return
+        if event.geo_status == Event.GEO_PENDING:
+            return
         if event.recurring:
             # this event is an instance of a serie of recurring events
             return
         from .tasks import notify_users_when_wanted
-        notify_users_when_wanted.delay( event = event )
+        # only the id is sent to the task
+        notify_users_when_wanted.delay( event = event.id )
 
     @staticmethod # def save_startdate_enddate(event, startdate, enddate) {{{3
     def save_startdate_enddate( event, startdate, enddate ):
@@ -2296,6 +2481,13 @@ class EventUrl( models.Model ): # {{{1
         # we update Event.version
         event_queryset = Event.objects.filter( pk = self.event.pk )
         event_queryset.update( version = self.event.version + 1 )
+        self.event.update_search_document()
+        self.event.search_results_changed()
+
+    def delete( self, *args, **kwargs ):
+        super( EventUrl, self ).delete( *args, **kwargs )
+        self.event.update_search_document()
+        self.event.search_results_changed()
 
     def __unicode__( self ): # {{{2
         return self.url
@@ -2432,49 +2624,25 @@ class EventDate( models.Model ): # {{{1
                 raise RuntimeError( unicode(self.event) +
                         " was going to have an ongoing after end" )
         super( EventDate, self ).save( *args, **kwargs ) # {{{4
-        # adding and deleting ongoing dates {{{4
-        # if it is and end-date, we add missing ongoing-dates and delete
-        # gratuitous
+        # multi-day events are stored as the span start_date-end_date of the
+        # event instead of one 'ongoing' row per day, see
+        # :func:`grical.events.search.span_overlap_q`
         if self.eventdate_name == 'end' or self.eventdate_name == 'start':
             self.event.startdate_cache = None
             self.event.enddate_cache = None
-            start = self.event.startdate
-            end = self.event.enddate
-            if end:
-                # deletes all ongoings outside start-end range
-                gratuitous_ongoings = EventDate.objects.filter(
-                        event = self.event, eventdate_name = 'ongoing',
-                        ).exclude( eventdate_date__range = ( start, end ) )
-                gratuitous_ongoings.delete()
-                # deletes ongoings == start or == end
-                EventDate.objects.filter(
-                        event = self.event,
-                        eventdate_date__in = (start, end),
-                        eventdate_name = 'ongoing' ).delete()
-                # we add missing ongoings
-                dates = [ start + datetime.timedelta(days=x) for x in
-                        range( 1, (end - start).days) ]
-                for date in dates:
-                    EventDate.objects.get_or_create(
-                            event = self.event,
-                            eventdate_name = 'ongoing',
-                            eventdate_date = date )
-                    # TODO: the above can be done more efficiently, see
-                    # http://stackoverflow.com/questions/2252530/efficent-way-to-bulk-insert-with-get-or-create-in-django-sql-python-django
-        event_queryset = Event.objects.filter( pk = self.event.pk )
-        event_queryset.update( version = self.event.version + 1 )
+        # update event.version and the denormalized dates
+        self.event.update_dates_columns( version = self.event.version + 1 )
+        self.event.update_search_document()
+        self.event.search_results_changed()
 
     def delete( self, *args, **kwargs ): #{{{3
-        """ deletes all ongoing dates when the deleted EventDate is an end date
+        """ deletes the date and updates the denormalized dates of the event
         """
         super( EventDate, self ).delete( *args, **kwargs )
-        # update event.version
-        event_queryset = Event.objects.filter( pk = self.event.pk )
-        event_queryset.update( version = self.event.version + 1 )
-        if not self.eventdate_name == 'end':
-            return
-        EventDate.objects.filter(
-            event = self.event, eventdate_name = 'ongoing' ).delete()
+        # update event.version and the denormalized dates
+        self.event.update_dates_columns( version = self.event.version + 1 )
+        self.event.update_search_document()
+        self.event.search_results_changed()
 
     #def natural_key( self ):
     #    return ( self.eventdate_name, self.event.natural_key() )
@@ -2493,7 +2661,9 @@ class EventDate( models.Model ): # {{{1
     @staticmethod # def reserved_names: {{{2
     def reserved_names():
         """ tuple with the names of reserved eventdate_names (start,
-        end, ongoing) """
+        end, ongoing). 'ongoing' is not stored any more but used for the days
+        between start and end expanded when rendering, see
+        :func:`grical.events.models.expand_ongoing` """
         return ('start', 'end', 'ongoing')
 
     @staticmethod # def get_eventdates( text ): {{{2
@@ -2611,6 +2781,13 @@ class EventSession( models.Model ): # {{{1
         # we update Event.version
         event_queryset = Event.objects.filter( pk = self.event.pk )
         event_queryset.update( version = self.event.version + 1 )
+        self.event.update_search_document()
+        self.event.search_results_changed()
+
+    def delete( self, *args, **kwargs ): #{{{3
+        super( EventSession, self ).delete( *args, **kwargs )
+        self.event.update_search_document()
+        self.event.search_results_changed()
 
     def __unicode__( self ): # {{{2
         return unicode( self.session_date ) + u'    ' + \
@@ -2745,6 +2922,14 @@ class FilterManager( models.Manager ): # {{{1
                 name = name,
                 user = User.objects.get( username = username ) )
 
+    def candidates_for_event( self, event ):
+        """ returns a queryset of the filters which could match *event*
+        looked up in the reverse index of filters, see
+        :mod:`grical.events.percolator` """
+        from grical.events.percolator import event_index_keys
+        return self.filter( index_entries__key__in =
+                list( event_index_keys( event ) ) ).distinct()
+
 class Filter( models.Model ): # {{{1
     """ search queries of users """
     # {{{2 attributes
@@ -2773,6 +2958,21 @@ class Filter( models.Model ): # {{{1
     def __unicode__( self ): # {{{2
         return self.name
 
+    def save( self, *args, **kwargs ): #{{{2
+        """ saves the filter and updates its entries in the reverse index of
+        filters """
+        super( Filter, self ).save( *args, **kwargs )
+        self.update_index()
+
+    def update_index( self ): # {{{2
+        """ replaces the entries of the filter in the reverse index of
+        filters, see :mod:`grical.events.percolator` """
+        from grical.events.percolator import filter_index_keys
+        self.index_entries.all().delete()
+        FilterIndexEntry.objects.bulk_create( [
+            FilterIndexEntry( filter = self, key = key )
+            for key in filter_index_keys( self.query ) ] )
+
     @models.permalink
     def get_absolute_url( self ): # {{{2
         "get internal URL of an event"
@@ -2794,17 +2994,10 @@ class Filter( models.Model ): # {{{1
         """ return True if the query matches the event, False otherwise.
         """
         # body {{{3
-        from grical.events.search import search_events
-        qset = search_events( query, related = False ).filter(pk = event.id)
-        if qset.exists():
-            return True
-        return False
-        # EFFICIENCY: a much more efficient way would be to check manually
-        # everything here, but then every change in
-        # :meth:`search.search` would cause changes here and
-        # comparing and adapting both methods would be very time consuming and
-        # error-pround. We had a long code here until charset 336:e725aaa6a108
-
+        # the query is evaluated in memory, the conformance with
+        # :func:`search.search_events` is checked in tests/test_search.py
+        from grical.events.search import compile_query
+        return compile_query( query ).matches( event )
 
     def matches_count( self ): # {{{2
         """ returns the number of events which would be returned without
@@ -2812,6 +3005,280 @@ class Filter( models.Model ): # {{{1
         from grical.events.search import search_events
         return search_events( self.query ).count()
 
+class PendingNotification( models.Model ): # {{{1
+    """ a match of a filter with a new event waiting to be sent to the user
+    in a digest, see :func:`tasks.send_notification_digests` """
+    user = models.ForeignKey( User, verbose_name = _( u'User' ) )
+    filter = models.ForeignKey( Filter, verbose_name = _( u'Filter' ) )
+    event = models.ForeignKey( Event, verbose_name = _( u'Event' ) )
+    creation_time = models.DateTimeField( _( u'Creation time' ),
+            editable = False, auto_now_add = True )
+
+    class Meta: # {{{2 pylint: disable-msg=C0111,W0232,R0903
+        unique_together = ( "filter", "event" )
+        ordering = [ 'user', 'creation_time' ]
+        verbose_name = _( u'Pending notification' )
+        verbose_name_plural = _( u'Pending notifications' )
+
+    def __unicode__( self ): # {{{2
+        return u'%s: %s' % ( self.filter, self.event )
+
+class NotificationRun( models.Model ): # {{{1
+    """ the matching of a new event against the filters, split in shards
+    running in parallel, see :func:`tasks.notify_users_when_wanted` """
+    event = models.ForeignKey( Event, verbose_name = _( u'Event' ) )
+    shards = models.PositiveIntegerField( _( u'Shards' ) )
+    pending_shards = models.PositiveIntegerField( _( u'Pending shards' ) )
+    matches = models.PositiveIntegerField( _( u'Matches' ), default = 0 )
+    matching_seconds = models.FloatField( _( u'Matching seconds' ),
+            default = 0, help_text = _( u'Sum of the times of all shards' ) )
+    creation_time = models.DateTimeField( _( u'Creation time' ),
+            editable = False, auto_now_add = True )
+    completion_time = models.DateTimeField( _( u'Completion time' ),
+            blank = True, null = True )
+
+    class Meta: # {{{2 pylint: disable-msg=C0111,W0232,R0903
+        verbose_name = _( u'Notification run' )
+        verbose_name_plural = _( u'Notification runs' )
+
+    def __unicode__( self ): # {{{2
+        return u'%s: %d/%d' % ( self.event_id,
+                self.shards - self.pending_shards, self.shards )
+
+    def shard_done( self, matches, seconds ): # {{{2
+        """ records atomically the end of a shard and sends the signal
+        :data:`notification_run_finished` if it was the last one. Returns the
+        finished run in the last case, None otherwise. """
+        runs = NotificationRun.objects.filter( pk = self.pk )
+        runs.update( pending_shards = F( 'pending_shards' ) - 1,
+                matches = F( 'matches' ) + matches,
+                matching_seconds = F( 'matching_seconds' ) + seconds )
+        if runs.filter( pending_shards = 0, completion_time__isnull = True
+                ).update( completion_time = datetime.datetime.now() ) == 0:
+            return None
+        run = runs.get()
+        notification_run_finished.send( sender = NotificationRun, run = run )
+        return run
+
+notification_run_finished = Signal( providing_args = [ 'run' ] )
+""" sent when all shards of a :class:`NotificationRun` are done """
+
+class FilterIndexEntry( models.Model ): # {{{1
+    """ entry of the reverse index of filters, see
+    :mod:`grical.events.percolator`. Entries are deleted with their filter.
+    """
+    filter = models.ForeignKey( Filter, verbose_name = _( u'Filter' ),
+            related_name = 'index_entries' )
+    key = models.CharField( _( u'Key' ), max_length = 100, db_index = True )
+
+    class Meta: # {{{2 pylint: disable-msg=C0111,W0232,R0903
+        unique_together = ( "filter", "key" )
+        verbose_name = _( u'Filter index entry' )
+        verbose_name_plural = _( u'Filter index entries' )
+
+    def __unicode__( self ): # {{{2
+        return self.key
+
+class GazetteerPlaceManager( models.Manager ): # {{{1
+    def search( self, city, country = None ):
+        """ returns the place of the gazetteer named ``city`` with the
+        biggest population, in ``country`` (a code or a name of a country)
+        if given, or None. Names are compared case insensitively and
+        include the alternate names of the GeoNames dump. """
+        names = GazetteerName.objects.filter(
+                name = city.strip().lower()[ 0:200 ] )
+        if country:
+            country = country.strip()
+            if len( country ) != 2:
+                codes = GazetteerName.objects.filter(
+                        name = country.lower()[ 0:200 ],
+                        place__feature_code = GazetteerPlace.COUNTRY
+                        ).values_list( 'country', flat = True )[ 0:1 ]
+                if not codes:
+                    return None
+                country = codes[0]
+            names = names.filter( country = country.upper() )
+        place_ids = names.order_by( '-population' ).values_list(
+                'place_id', flat = True )[ 0:1 ]
+        if not place_ids:
+            return None
+        return self.get( pk = place_ids[0] )
+
+class GazetteerPlace( models.Model ): # {{{1
+    """ a populated place or a country of the GeoNames dump loaded with the
+    command ``loadgeonames``, used by :func:`utils.search_name` instead of
+    the GeoNames API """
+    COUNTRY = 'PCLI'
+    """ feature code of the places of the countries """
+    id = models.IntegerField( _( u'GeoNames id' ), primary_key = True )
+    name = models.CharField( _( u'Name' ), max_length = 200 )
+    country = models.CharField( _( u'Country' ), max_length = 2 )
+    feature_code = models.CharField( _( u'Feature code' ), max_length = 10 )
+    population = models.BigIntegerField( _( u'Population' ), default = 0 )
+    coordinates = models.PointField( _( u'Coordinates' ),
+            blank = True, null = True )
+
+    objects = GazetteerPlaceManager()
+
+    class Meta: # {{{2 pylint: disable-msg=C0111,W0232,R0903
+        verbose_name = _( u'Gazetteer place' )
+        verbose_name_plural = _( u'Gazetteer places' )
+
+    def __unicode__( self ): # {{{2
+        return u'%s, %s' % ( self.name, self.country )
+
+    def as_search_name( self ): # {{{2
+        """ returns the dictionary of :func:`utils.search_name` """
+        return { 'coordinates': self.coordinates,
+                'city': None if self.feature_code == self.COUNTRY
+                    else self.name,
+                'country': self.country }
+
+class GazetteerName( models.Model ): # {{{1
+    """ a name in lower case of a :class:`GazetteerPlace`, including its
+    alternate names. The country and population of the place are repeated
+    for selecting names with only one index. """
+    place = models.ForeignKey( GazetteerPlace, verbose_name = _( u'Place' ),
+            related_name = 'names' )
+    name = models.CharField( _( u'Name' ), max_length = 200 )
+    country = models.CharField( _( u'Country' ), max_length = 2 )
+    population = models.BigIntegerField( _( u'Population' ), default = 0 )
+
+    class Meta: # {{{2 pylint: disable-msg=C0111,W0232,R0903
+        unique_together = ( "place", "name" )
+        index_together = [ [ "name", "country", "population" ] ]
+        verbose_name = _( u'Gazetteer name' )
+        verbose_name_plural = _( u'Gazetteer names' )
+
+    def __unicode__( self ): # {{{2
+        return self.name
+
+def _median( values ): # {{{1
+    """ returns the median of a not empty list of numbers """
+    values = sorted( values )
+    middle = len( values ) // 2
+    if len( values ) % 2:
+        return values[ middle ]
+    return ( values[ middle - 1 ] + values[ middle ] ) / 2.0
+
+class EventPlaceManager( models.Manager ): # {{{1
+    def search( self, city, country = None ):
+        """ returns the place of the events named ``city`` with the most
+        events, in ``country`` (a code or a name of a country) if given, or
+        None. Names are compared with :func:`utils.normalize_name`. Places
+        with less than ``settings.EVENT_PLACE_MIN_EVENTS`` events are
+        ignored. """
+        places = self.filter( name = normalize_name( city )[ 0:200 ],
+                events__gte = settings.EVENT_PLACE_MIN_EVENTS )
+        if country:
+            country = country.strip()
+            if len( country ) != 2:
+                country = COUNTRY_NAMES.code( country )
+                if country is None:
+                    return None
+            places = places.filter( country = country.upper() )
+        return places.order_by( '-events' ).first()
+
+    @transaction.atomic
+    def rebuild( self ):
+        """ aggregates the cities and countries of the events with
+        coordinates in places and saves only the places which changed.
+        Returns a tuple with the numbers of created, updated and deleted
+        places. """
+        # ( name, country ) -> ( longitudes, latitudes, spelling -> count )
+        groups = {}
+        events = Event.objects.exclude( city = None ).exclude(
+                city = '' ).exclude( coordinates = None ).values_list(
+                        'city', 'country', 'coordinates' )
+        for city, country, coordinates in events.iterator():
+            name = normalize_name( city )[ 0:200 ]
+            if not name:
+                continue
+            longitudes, latitudes, spellings = groups.setdefault(
+                    ( name, ( country or '' ).upper() ), ( [], [], {} ) )
+            longitudes.append( coordinates.x )
+            latitudes.append( coordinates.y )
+            spelling = city.strip()
+            spellings[ spelling ] = spellings.get( spelling, 0 ) + 1
+        existing = dict( ( ( place.name, place.country ), place )
+                for place in self.all() )
+        new = []
+        updated = 0
+        for key, ( longitudes, latitudes, spellings ) in groups.items():
+            # the median ignores events with wrong coordinates
+            coordinates = Point( _median( longitudes ), _median( latitudes ),
+                    srid = 4326 )
+            aliases = u'\n'.join( sorted( spellings,
+                key = lambda spelling: ( -spellings[ spelling ], spelling ) ) )
+            place = existing.pop( key, None )
+            if place is None:
+                new.append( EventPlace( name = key[0], country = key[1],
+                    coordinates = coordinates, events = len( longitudes ),
+                    aliases = aliases ) )
+                continue
+            if place.events == len( longitudes ) and \
+                    place.aliases == aliases and \
+                    place.coordinates.equals_exact( coordinates, 1e-7 ):
+                continue
+            place.coordinates = coordinates
+            place.events = len( longitudes )
+            place.aliases = aliases
+            place.save()
+            updated += 1
+        self.bulk_create( new, batch_size = 500 )
+        deleted = [ old.id for old in existing.values() ]
+        for i in range( 0, len( deleted ), 500 ):
+            self.filter( id__in = deleted[ i : i + 500 ] ).delete()
+        return len( new ), updated, len( deleted )
+
+class EventPlace( models.Model ): # {{{1
+    """ a city of the events with the median of their coordinates, built
+    with the command ``rebuildplaces`` and used by :func:`utils.search_name`
+    before the gazetteer and the GeoNames API """
+    name = models.CharField( _( u'Name' ), max_length = 200,
+            help_text = _( u'City normalized with normalize_name' ) )
+    country = models.CharField( _( u'Country' ), max_length = 2,
+            blank = True )
+    coordinates = models.PointField( _( u'Coordinates' ) )
+    events = models.PositiveIntegerField( _( u'Events' ), default = 0 )
+    aliases = models.TextField( _( u'Aliases' ), help_text = _( u'The '
+        u'spellings of the city in the events, one per line, the most used '
+        u'first' ) )
+    modification_time = models.DateTimeField( _( u'Modification time' ),
+            editable = False, auto_now = True )
+
+    objects = EventPlaceManager()
+
+    class Meta: # {{{2 pylint: disable-msg=C0111,W0232,R0903
+        unique_together = ( "name", "country" )
+        verbose_name = _( u'Event place' )
+        verbose_name_plural = _( u'Event places' )
+
+    def __unicode__( self ): # {{{2
+        return u'%s, %s' % ( self.name, self.country )
+
+    def as_search_name( self ): # {{{2
+        """ returns the dictionary of :func:`utils.search_name` """
+        return { 'coordinates': self.coordinates,
+                'city': self.aliases.split( u'\n' )[0],
+                'country': self.country or None }
+
+class TimezoneBoundary( models.Model ): # {{{1
+    """ the area of a timezone loaded with the command ``loadtimezones``,
+    used by :func:`utils.search_timezone` instead of the GeoNames API """
+    name = models.CharField( _( u'Name' ), max_length = 50 )
+    polygon = models.MultiPolygonField( _( u'Polygon' ) )
+    simplified = models.MultiPolygonField( _( u'Simplified polygon' ),
+            spatial_index = False, help_text = _( u'Polygon simplified '
+                u'with the tolerance TIMEZONE_SIMPLIFY_TOLERANCE' ) )
+
+    class Meta: # {{{2 pylint: disable-msg=C0111,W0232,R0903
+        verbose_name = _( u'Timezone boundary' )
+        verbose_name_plural = _( u'Timezone boundaries' )
+
+    def __unicode__( self ): # {{{2
+        return self.name
+
 class GroupManager( models.Manager ): # {{{1
     def get_by_natural_key(self, name):
         return self.get( name = name )
@@ -2935,8 +3402,8 @@ class Group( models.Model ): # {{{1
 
         """
         today = datetime.date.today()
-        events = Event.objects.filter( Q(calendar__group = self) & (
-                    Q(dates__eventdate_date__gte = today) )).distinct()
+        events = Event.objects.filter( calendar__group = self,
+                next_date__gte = today ).distinct()
         events = add_upcoming( events ).order_by('upcoming')
         if limit == -1:
             return events
@@ -3036,6 +3503,15 @@ class Calendar( models.Model ): # {{{1
         verbose_name = _( u'Calendar' )
         verbose_name_plural = _( u'Calendars' )
 
+    def save( self, *args, **kwargs ):
+        super( Calendar, self ).save( *args, **kwargs )
+        # searches for groups can contain now the event
+        self.event.search_results_changed()
+
+    def delete( self, *args, **kwargs ):
+        super( Calendar, self ).delete( *args, **kwargs )
+        self.event.search_results_changed()
+
 
 # Next code is an adaptation of some code in python-django-registration
 SHA1_RE = re.compile( '^[a-f0-9]{40}$' )
@@ -3283,45 +3759,65 @@ class GroupInvitation( models.Model ): # {{{1
     activation_key_expired.boolean = True
 
 def add_start( queryset ): #{{{1
-    """ returns a new queryset adding a join query to ``queryset``
-    (Event or EventDate as model) which include the ``start`` date
-    of each event """
+    """ returns a new queryset adding to ``queryset`` (Event or EventDate as
+    model) the ``start`` date of each event, see :attr:`Event.start_date` """
     if queryset.model == EventDate:
-        return queryset.extra(select={'start':
-            "SELECT T2.eventdate_date FROM events_eventdate T2 WHERE " \
-            "T2.event_id = events_eventdate.event_id and " \
-            "T2.eventdate_name = 'start'"})
+        return queryset.annotate( start = F( 'event__start_date' ) )
     elif queryset.model == Event:
-        return queryset.extra(select={'start':
-            "SELECT eventdate_date FROM events_eventdate WHERE " \
-            "events_event.id = events_eventdate.event_id and " \
-            "eventdate_name = 'start'"})
+        return queryset.annotate( start = F( 'start_date' ) )
     else:
         raise RuntimeError('queryset.model was either EventDate nor Event')
 
 def add_end( queryset ): #{{{1
-    """ returns a new queryset adding a join query to ``queryset``
-    (Event or EventDate as model) which include the ``end`` date
-    of each event """
+    """ returns a new queryset adding to ``queryset`` (Event or EventDate as
+    model) the ``end`` date of each event, see :attr:`Event.end_date` """
     if queryset.model == EventDate:
-        return queryset.extra(select={'end':
-            "SELECT T2.eventdate_date FROM events_eventdate T2 WHERE " \
-            "T2.event_id = events_eventdate.event_id and " \
-            "T2.eventdate_name = 'end'"})
+        return queryset.annotate( end = F( 'event__end_date' ) )
     elif queryset.model == Event:
-        return queryset.extra(select={'end':
-            "SELECT eventdate_date FROM events_eventdate WHERE " \
-            "events_event.id = events_eventdate.event_id and " \
-            "eventdate_name = 'end'"})
+        return queryset.annotate( end = F( 'end_date' ) )
     else:
         raise RuntimeError('queryset.model was either EventDate nor Event')
 
 def add_upcoming( queryset ): #{{{1
+    """ returns a new queryset adding to ``queryset`` the ``upcoming`` date
+    of each event, see :attr:`Event.next_date` """
     if queryset.model == Event:
-        return queryset.annotate( upcoming = Min('dates__eventdate_date') )
+        return queryset.annotate( upcoming = F( 'next_date' ) )
     else:
         raise RuntimeError('queryset.model was not Event')
 
+def expand_ongoing( eventdates, events, date1 = None, date2 = None ): #{{{1
+    """ returns a list with ``eventdates`` (sorted EventDate instances with
+    ``start`` and ``end``, see :func:`add_start`) and, for each multi-day
+    event of the Event queryset ``events``, an unsaved EventDate named
+    ``ongoing`` for each day between its start and its end inside the window
+    from ``date1`` to ``date2``, sorted by date.
+
+    ``date1`` and ``date2`` default to the first and last date of
+    ``eventdates``, which can be empty if both are given. Multi-day events
+    are stored as spans (see :meth:`Event.update_dates_columns`), so that
+    only the days of the page being rendered are expanded. """
+    eventdates = list( eventdates )
+    if not eventdates and ( date1 is None or date2 is None ):
+        return eventdates
+    date1 = date1 or eventdates[0].eventdate_date
+    date2 = date2 or eventdates[-1].eventdate_date
+    one_day = datetime.timedelta( days = 1 )
+    ongoing = []
+    for event in events.filter( end_date__isnull = False,
+            start_date__lt = date2, end_date__gt = date1 ).distinct():
+        day = max( event.start_date + one_day, date1 )
+        while day < event.end_date and day <= date2:
+            eventdate = EventDate( event = event, eventdate_name = 'ongoing',
+                    eventdate_date = day )
+            eventdate.start = event.start_date
+            eventdate.end = event.end_date
+            ongoing.append( eventdate )
+            day += one_day
+    # sorted is stable: stored dates are kept before ongoing days
+    return sorted( eventdates + ongoing,
+            key = lambda eventdate: eventdate.eventdate_date )
+
 class Session: #{{{1
     def __init__(self, date=None, start=None, end=None, name=None):
         self.date = date
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+# docs {{{1
+""" keyset (cursor) pagination and approximate counts """
+
+# imports {{{1
+import base64
+import datetime
+import json
+import operator
+
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import F, Q
+from django.utils.functional import cached_property
+
+class InvalidCursorError( ValueError ): # {{{1
+    """ raised for a cursor not made by :func:`encode_cursor` or with other
+    keys, e.g. in an edited url """
+    pass
+
+class CursorPage( object ): # {{{1
+    """ a page of :func:`keyset_page` with the methods of the pages of
+    django's ``Paginator`` used by the templates, and the opaque cursors of
+    the next and previous pages (None if there are no such pages) """
+    cursor_pagination = True
+
+    def __init__( self, object_list, next_cursor = None,
+            previous_cursor = None ):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __len__( self ):
+        return len( self.object_list )
+
+    def has_next( self ):
+        return self.next_cursor is not None
+
+    def has_previous( self ):
+        return self.previous_cursor is not None
+
+    def has_other_pages( self ):
+        return self.has_next() or self.has_previous()
+
+def keyset_page( queryset, keys, cursor = None, limit = 20 ): # {{{1
+    """ returns a :class:`CursorPage` with up to ``limit`` rows of
+    ``queryset`` (instances or dictionaries of ``values()``) sorted by
+    ``keys``, names of fields or annotations (descending if prefixed with
+    ``-``) the last of which must be unique and not NULL, e.g. ``id``. Rows
+    with NULL values of the other keys come after the others (see
+    :func:`keyset_ordering`).
+
+    Instead of counting the rows and using ``OFFSET``, the rows after (or
+    before) the position encoded in ``cursor`` are selected with a
+    ``WHERE`` on the keys, and one more row tells if there are more. It
+    raises :class:`InvalidCursorError` for an invalid cursor. """
+    if cursor:
+        forward, values = decode_cursor( cursor, len( keys ) )
+    else:
+        forward, values = True, None
+    if values is not None:
+        queryset = queryset.filter( _after_q( keys, values, forward ) )
+    rows = list( queryset.order_by(
+        *keyset_ordering( keys, forward ) )[ : limit + 1 ] )
+    more = len( rows ) > limit
+    rows = rows[ : limit ]
+    if forward:
+        has_next, has_previous = more, values is not None
+    else:
+        rows.reverse()
+        has_next, has_previous = True, more
+    next_cursor = previous_cursor = None
+    if rows and has_next:
+        next_cursor = encode_cursor( True, _key_values( rows[-1], keys ) )
+    if rows and has_previous:
+        previous_cursor = encode_cursor( False, _key_values( rows[0], keys ) )
+    return CursorPage( rows, next_cursor, previous_cursor )
+
+def keyset_ordering( keys, forward = True ): # {{{1
+    """ returns the arguments of ``order_by`` sorting by ``keys`` as
+    :func:`keyset_page` does, with NULLs last (the default of PostgreSQL for
+    ascending keys but not for descending ones), or reversed with NULLs
+    first if not ``forward`` """
+    ordering = []
+    for key in keys:
+        name = key.lstrip( '-' )
+        if key.startswith( '-' ) == forward:
+            ordering.append( F( name ).desc( nulls_last = forward,
+                nulls_first = not forward ) )
+        else:
+            ordering.append( F( name ).asc( nulls_last = forward,
+                nulls_first = not forward ) )
+    return ordering
+
+def encode_cursor( forward, values ): # {{{1
+    """ returns an opaque string for the position of a row with the values
+    ``values`` of the keys, see :func:`keyset_page`
+
+    >>> cursor = encode_cursor( True, [ datetime.date( 2010, 1, 2 ), 7 ] )
+    >>> decode_cursor( cursor, 2 )
+    (True, [u'2010-01-02', 7])
+    """
+    values = [ value.isoformat() if isinstance( value, datetime.date )
+            else value for value in values ]
+    return base64.urlsafe_b64encode(
+            json.dumps( [ 'n' if forward else 'p' ] + values ) ).rstrip( '=' )
+
+def decode_cursor( cursor, length ): # {{{1
+    """ returns a tuple (forward, values) of a cursor made by
+    :func:`encode_cursor` with ``length`` values, raising
+    :class:`InvalidCursorError` if it is not valid """
+    try:
+        cursor = str( cursor )
+        values = json.loads( base64.urlsafe_b64decode(
+            cursor + '=' * ( -len( cursor ) % 4 ) ) )
+    except ( TypeError, ValueError ):
+        raise InvalidCursorError( 'invalid cursor' )
+    if not isinstance( values, list ) or len( values ) != length + 1 or \
+            values[0] not in ( 'n', 'p' ):
+        raise InvalidCursorError( 'invalid cursor' )
+    return values[0] == 'n', values[1:]
+
+def _after_q( keys, values, forward = True ): # {{{1
+    """ returns a Q object selecting the rows after (or before if not
+    ``forward``) the row with ``values`` for ``keys`` in the order of
+    :func:`keyset_ordering`. NULL values can't be compared with ``<`` or
+    ``>``, they are selected with ``IS NULL`` or ``IS NOT NULL``.
+
+    >>> _after_q( [ '-rank', 'id' ], [ None, 7 ] )
+    <Q: (AND: ('rank__isnull', True), ('id__gt', 7))>
+    >>> _after_q( [ '-rank', 'id' ], [ None, 7 ], forward = False )
+    <Q: (OR: ('rank__isnull', False), (AND: ('rank__isnull', True), ('id__lt', 7)))>
+    """
+    conditions = []
+    equal = []
+    for position, ( key, value ) in enumerate( zip( keys, values ) ):
+        name = key.lstrip( '-' )
+        if value is None:
+            # NULLs are last going forward, first going backward
+            if not forward:
+                conditions.append(
+                        equal + [ Q( **{ name + '__isnull': False } ) ] )
+            equal.append( Q( **{ name + '__isnull': True } ) )
+            continue
+        lookup = '__lt' if key.startswith( '-' ) == forward else '__gt'
+        after = Q( **{ name + lookup: value } )
+        if forward and position < len( keys ) - 1:
+            after |= Q( **{ name + '__isnull': True } )
+        conditions.append( equal + [ after ] )
+        equal.append( Q( **{ name: value } ) )
+    if not conditions:
+        return Q( pk__in = [] )
+    return reduce( operator.or_, [ reduce( operator.and_, condition )
+        for condition in conditions ] )
+
+def _key_values( row, keys ): # {{{1
+    names = [ key.lstrip( '-' ) for key in keys ]
+    if isinstance( row, dict ):
+        return [ row[name] for name in names ]
+    return [ getattr( row, name ) for name in names ]
+
+class ApproximateCount( int ): # {{{1
+    """ a number of rows which is shown as ``1000+`` if it is a lower bound
+    (*capped*) or as ``~12000`` if it is an estimate (not *exact*)
+
+    >>> unicode( ApproximateCount( 7 ) )
+    u'7'
+    >>> count = ApproximateCount( 1000, exact = False, capped = True )
+    >>> count > 0, unicode( count )
+    (True, u'1000+')
+    >>> unicode( ApproximateCount( 12000, exact = False ) )
+    u'~12000'
+    """
+    def __new__( cls, value, exact = True, capped = False ):
+        count = super( ApproximateCount, cls ).__new__( cls, value )
+        count.exact = exact
+        count.capped = capped
+        return count
+
+    def __unicode__( self ):
+        if self.capped:
+            return u'%d+' % self
+        if not self.exact:
+            return u'~%d' % self
+        return u'%d' % self
+
+    def __str__( self ):
+        return str( unicode( self ) )
+
+def approximate_count( queryset, threshold = None, strategy = None ): # {{{1
+    """ returns an :class:`ApproximateCount` with the number of rows of
+    ``queryset``, exact only up to ``threshold`` rows (default
+    ``settings.COUNT_THRESHOLD``), so that large results are not scanned.
+    Above it, the estimate of the query planner is returned if
+    ``strategy`` (default ``settings.COUNT_STRATEGY``) is ``estimate`` and
+    the database is PostgreSQL, otherwise ``threshold`` as lower bound. """
+    if threshold is None:
+        threshold = settings.COUNT_THRESHOLD
+    if strategy is None:
+        strategy = settings.COUNT_STRATEGY
+    # the slice makes a COUNT of a subquery with LIMIT
+    count = queryset[ : threshold + 1 ].count()
+    if count <= threshold:
+        return ApproximateCount( count )
+    if strategy == 'estimate' and \
+            connections[ queryset.db ].vendor == 'postgresql':
+        estimate = planner_rows( queryset )
+        if estimate > threshold:
+            return ApproximateCount( estimate, exact = False )
+    return ApproximateCount( threshold, exact = False, capped = True )
+
+def planner_rows( queryset ): # {{{1
+    """ returns the number of rows of ``queryset`` estimated by the query
+    planner of PostgreSQL with ``EXPLAIN`` """
+    sql, params = queryset.query.sql_with_params()
+    cursor = connections[ queryset.db ].cursor()
+    cursor.execute( 'EXPLAIN (FORMAT JSON) ' + sql, params )
+    plan = cursor.fetchone()[0]
+    if isinstance( plan, basestring ):
+        plan = json.loads( plan )
+    return int( plan[0]['Plan']['Plan Rows'] )
+
+class ApproximatePaginator( Paginator ): # {{{1
+    """ a ``Paginator`` of a queryset whose ``count`` is an
+    :class:`ApproximateCount`; pages after the real last page are empty """
+    @cached_property
+    def count( self ):
+        return approximate_count( self.object_list )
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+# docs {{{1
+""" reverse index of the queries of filters (a "percolator")
+
+Instead of running the query of every :class:`models.Filter` against a new
+event, every filter is indexed with keys which an event **must** produce in
+order to match the filter. For a new event all its keys are computed and the
+candidate filters are looked up with only one query (see
+:meth:`models.FilterManager.candidates_for_event`). Candidates need to be
+verified with :meth:`models.Filter.matches_event`, the index only guarantees
+that non-candidates don't match.
+
+For each term of a query (terms are separated by `` | ``) only one
+restriction is indexed: the most selective one of the term. A term without
+any indexable restriction is indexed with the key ``all``, which all events
+produce.
+
+>>> sorted( filter_index_keys( u'#Linux berlin' ) )
+[u'tag:linux']
+>>> sorted( filter_index_keys( u'=12 | !Grical' ) )
+[u'event:12', u'group:grical']
+>>> sorted( filter_index_keys( u'-#linux' ) )
+[u'all']
+>>> sorted( filter_index_keys( u'conference' ) )
+[u'word:con']
+>>> sorted( filter_index_keys( u'e-learning' ) )
+[u'all']
+"""
+
+# imports {{{1
+import math
+
+from grical.tagging import settings as tagging_settings
+from grical.tagging.utils import parse_tag_input
+
+# constants {{{1
+ALL_KEY = u'all'
+# sizes in degrees of the cells of the grid used to index geographic
+# restrictions, from the smallest to the biggest
+GEO_CELL_SIZES = ( 0.25, 1, 4, 16, 64 )
+# maximum number of cells used to index one geographic restriction
+GEO_MAX_CELLS = 16
+# maximum number of months used to index a dates restriction
+MAX_MONTHS = 24
+# length of the substrings used to index words
+WORD_KEY_LENGTH = 3
+# maximum length of keys, see models.FilterIndexEntry.key
+KEY_MAX_LENGTH = 100
+KM_PER_DEGREE = 111.32
+KM_PER_MILE = 1.609344
+
+def filter_index_keys( query ): #{{{1
+    """ returns a set of keys to index *query*; an event matching *query*
+    produces (see :func:`event_index_keys`) at least one of them. The keys
+    are built from the terms of :func:`search.compile_query`, so that they
+    are normalized (e.g. tags in lower case) as the query is evaluated. """
+    from grical.events.search import (compile_query, GeoLookupError,
+            ContinentLookupError)
+    keys = set()
+    if not query:
+        return keys
+    try:
+        terms = compile_query( query ).terms
+    except ( ValueError, GeoLookupError, ContinentLookupError ):
+        # the search raises the error too, the filter is checked with all
+        # events in case the error is temporary (e.g. a geo lookup)
+        return set( [ ALL_KEY ] )
+    for term in terms:
+        keys.update( _term_index_keys( term ) )
+    return truncate_keys( keys )
+
+def truncate_keys( keys ): #{{{1
+    """ returns a set with the keys cut to :data:`KEY_MAX_LENGTH`; keys of
+    filters and of events are cut in the same way so that long keys (e.g.
+    of long group names) still match
+
+    >>> len( list( truncate_keys( [ u'group:' + u'g' * 200 ] ) )[0] )
+    100
+    """
+    return set( [ key[ 0 : KEY_MAX_LENGTH ] for key in keys ] )
+
+def _term_index_keys( term ): #{{{1
+    """ returns a set of keys for a :class:`search.CompiledTerm` (see
+    :func:`filter_index_keys`) """
+    if term.event_ids:
+        return set( [ u'event:%d' % term.event_ids[0] ] )
+    # candidates is a list of (priority, set of keys)
+    candidates = []
+    if term.groups:
+        candidates.append( ( 1, set( [ u'group:' + term.groups[0] ] ) ) )
+    if term.continents:
+        candidates.append(
+                ( 7, set( [ u'continent:' + term.continents[0][0] ] ) ) )
+    for location in term.locations:
+        keys = _location_index_keys( location )
+        priority = 4 if [ k for k in keys
+                if k.startswith( u'place:' ) ] else 6
+        candidates.append( ( priority, keys ) )
+    if term.tags:
+        # NOTE: non existing tags are ignored by the search, so any of the
+        # tags is necessary, not all
+        candidates.append(
+                ( 0, set( [ u'tag:' + tag for tag in term.tags ] ) ) )
+    if term.dates_range:
+        months = _months( term.dates_range[0], term.dates_range[1] )
+        if len( months ) <= MAX_MONTHS:
+            candidates.append( ( 5, set( [ u'month:' + month
+                for month in months ] ) ) )
+    if not term.broad:
+        # words of broad searches can match many fields, e.g. the description
+        # words with other characters than one lexeme can match events
+        # with the lexemes in any order in the full-text search (e.g.
+        # e-learning), which produce no key with their beginning; strict
+        # words are only searched as parts of the text
+        from grical.events.search import LEXEME_REGEX
+        words = [ word for word in term.words
+                if LEXEME_REGEX.findall( word ) == [ word ] ]
+        words.extend( term.words_strict )
+        words = [ word for word in words if len( word ) >= WORD_KEY_LENGTH ]
+        if words:
+            word = max( sorted( words ), key = len )
+            candidates.append( ( 3, set(
+                [ u'word:' + word[ 0 : WORD_KEY_LENGTH ] ] ) ) )
+    if not candidates:
+        return set( [ ALL_KEY ] )
+    return min( candidates, key = lambda candidate: candidate[0] )[1]
+
+def _location_index_keys( location ): #{{{1
+    """ returns a set of keys for a location of a
+    :class:`search.CompiledTerm` """
+    kind = location[0]
+    if kind == 'name':
+        # the search looks for the city or the country
+        return set( [ u'place:' + location[1] ] )
+    elif kind == 'city':
+        city, country, point, meters = location[1:]
+        if not point:
+            return set( [ u'place:' + city ] )
+        return set( [ u'place:' + city ] ) | _radius_cells( point.y,
+                point.x, meters / 1000.0, 'km' )
+    elif kind == 'distance':
+        point, meters = location[1:]
+        return _radius_cells( point.y, point.x, meters / 1000.0, 'km' )
+    assert kind == 'box'
+    return _box_cells( *location[1:] )
+
+def _radius_cells( lat, lng, distance, unit ): #{{{1
+    """ returns the cells of the bounding box of a circle """
+    lat = float( lat )
+    lng = float( lng )
+    distance = float( distance )
+    if unit == 'mi':
+        distance = distance * KM_PER_MILE
+    delta_lat = distance / KM_PER_DEGREE
+    cos_lat = math.cos( math.radians( min( abs( lat ) + delta_lat, 90 ) ) )
+    if cos_lat < 0.01:
+        delta_lng = 360
+    else:
+        delta_lng = distance / ( KM_PER_DEGREE * cos_lat )
+    if delta_lng >= 180:
+        return _box_cells( -180, lat - delta_lat, 180, lat + delta_lat )
+    west = lng - delta_lng
+    east = lng + delta_lng
+    if west < -180 or east > 180:
+        # the box crosses the antimeridian
+        return _box_cells( max( west, -180 ), lat - delta_lat,
+                    min( east, 180 ), lat + delta_lat ) | \
+                _box_cells( -180 if west < -180 else east - 360,
+                    lat - delta_lat,
+                    west + 360 if west < -180 else 180, lat + delta_lat )
+    return _box_cells( west, lat - delta_lat, east, lat + delta_lat )
+
+def _box_cells( west, south, east, north ): #{{{1
+    """ returns the keys of the cells of the smallest size covering the box
+    with no more than :data:`GEO_MAX_CELLS` cells """
+    south = max( south, -90 )
+    north = min( north, 90 )
+    for size in GEO_CELL_SIZES:
+        xs = range( _cell( west, size ), _cell( east, size ) + 1 )
+        ys = range( _cell( south, size ), _cell( north, size ) + 1 )
+        if len( xs ) * len( ys ) <= GEO_MAX_CELLS or \
+                size == GEO_CELL_SIZES[-1]:
+            return set( [ _cell_key( size, x, y ) for x in xs for y in ys ] )
+
+def _cell( degrees, size ): #{{{1
+    return int( math.floor( float( degrees ) / size ) )
+
+def _cell_key( size, x, y ): #{{{1
+    return u'geo:%s:%d:%d' % ( size, x, y )
+
+def _months( date1, date2, limit = MAX_MONTHS ): #{{{1
+    """ returns a list of strings ``yyyy-mm`` of all months from *date1* to
+    *date2*, but no more than *limit* + 1 if *limit* is not None """
+    months = []
+    year, month = date1.year, date1.month
+    while ( year, month ) <= ( date2.year, date2.month ):
+        months.append( u'%04d-%02d' % ( year, month ) )
+        if limit is not None and len( months ) > limit:
+            break
+        year, month = ( year + 1, 1 ) if month == 12 else ( year, month + 1 )
+    return months
+
+def event_index_keys( event ): #{{{1
+    """ returns a set of keys of *event*, see :func:`filter_index_keys` """
+    from grical.data.models import CONTINENT_COUNTRIES
+    keys = set( [ ALL_KEY, u'event:%d' % event.id ] )
+    tags = parse_tag_input( event.tags )
+    if tagging_settings.FORCE_LOWERCASE_TAGS:
+        # as the tags of compiled queries
+        tags = [ tag.lower() for tag in tags ]
+    keys.update( [ u'tag:' + tag for tag in tags ] )
+    keys.update( [ u'group:' + name.lower() for name in
+        event.calendar.values_list( 'group__name', flat = True ) ] )
+    for text in ( event.title, event.city, event.acronym, event.tags ):
+        if not text:
+            continue
+        text = text.lower()
+        keys.update( [ u'word:' + text[ i : i + WORD_KEY_LENGTH ] for i in
+            range( 0, len( text ) - WORD_KEY_LENGTH + 1 ) ] )
+    if event.city:
+        keys.add( u'place:' + event.city.lower() )
+    if event.country:
+        keys.add( u'place:' + event.country.lower() )
+    span = {}
+    for eventdate in event.dates.all():
+        keys.add( u'month:%04d-%02d' % ( eventdate.eventdate_date.year,
+            eventdate.eventdate_date.month ) )
+        if eventdate.eventdate_name in ( 'start', 'end' ):
+            span[ eventdate.eventdate_name ] = eventdate.eventdate_date
+    if len( span ) == 2:
+        # the days between start and end are not stored as dates
+        keys.update( [ u'month:' + month for month in
+            _months( span['start'], span['end'], None ) ] )
+    if event.coordinates:
+        for size in GEO_CELL_SIZES:
+            keys.add( _cell_key( size, _cell( event.coordinates.x, size ),
+                _cell( event.coordinates.y, size ) ) )
+    # the continent restriction looks for the continent of the coordinates
+    # or the country
+    if event.continent:
+        keys.add( u'continent:' + event.continent )
+    keys.update( [ u'continent:' + code for code, countries in
+        CONTINENT_COUNTRIES.items() if event.country in countries ] )
+    return truncate_keys( keys )
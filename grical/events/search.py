@@ -24,17 +24,32 @@
 """ event search functions """
 
 # imports {{{1
+from collections import OrderedDict
+from hashlib import md5
 import re
 import datetime
+import math
+import threading
+import time
 
 from django.contrib.gis.db.models import Q
 from django.contrib.gis.measure import D # D is a shortcut for Distance
 from django.contrib.gis.geos import Point, Polygon
 from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.db import connection
+from django.db.models import FloatField
+from django.db.models.expressions import RawSQL
 
-from grical.tagging.models import Tag, TaggedItem
+from grical.tagging import settings as tagging_settings
+from grical.tagging.models import Tag, TagCooccurrence, TaggedItem
+from grical.tagging.utils import parse_tag_input
 
-from grical.events.models import Event, EventDate
+from grical.events.models import (Event, EventDate, add_start, add_end,
+        add_upcoming)
+from grical.events.pagination import (CursorPage, keyset_page,
+        keyset_ordering, approximate_count)
 from grical.events.utils import search_name
 
 # regexes {{{1
@@ -48,6 +63,13 @@ GROUP_REGEX = re.compile(r'(?:^|\s)!([-\w]+)\b', re.UNICODE) #{{{2
 TAG_REGEX = re.compile(r'(?:^|\s)#([-\w]+)\b', re.UNICODE) #{{{2
 EXCLUSION_REGEX = re.compile(r'(?:^|\s)-([#@]?[-\w]+)\b', re.UNICODE) #{{{2
 SPACE_REGEX = re.compile(r'\s+', re.UNICODE) #{{{2
+# LEXEME_REGEX: letters and digits, the only characters of words passed to
+# PostgreSQL's to_tsquery {{{2
+LEXEME_REGEX = re.compile(r'[^\W_]+', re.UNICODE)
+# LIKE_SPECIAL_REGEX: characters to escape in LIKE patterns {{{2
+LIKE_SPECIAL_REGEX = re.compile(r'[\\%_]')
+# BROAD_REGEX: beginning with * followed by 1 or more spaces {{{2
+BROAD_REGEX = re.compile(r'^\* +', re.UNICODE)
 # CONTINENT_REGEX {{{2
 CONTINENT_REGEX = re.compile(r'(?:^|\s)@@(\w\w)\b', re.UNICODE) #{{{2
 # LOCATION_REGEX {{{2
@@ -90,6 +112,36 @@ LOCATION_REGEX = re.compile(r"""
 # CITY_COUNTRY_RE : city, country (optional) #{{{2
 CITY_COUNTRY_RE = re.compile(r'\s*([^,]+)(?:,\s*(.+))?')
 
+# EARTH_RADIUS in meters, the same used by PostGIS for spheres {{{1
+EARTH_RADIUS = 6370986
+
+# RADIUS_SQL: ids of events within a distance, see radius_q {{{1
+# it uses the index of coordinates::geography (PostgreSQL only), the last
+# parameter of ST_DWithin selects the sphere of _sphere_distance
+RADIUS_SQL = u"""SELECT id FROM events_event WHERE
+    ST_DWithin(coordinates::geography, ST_GeogFromText(%s), %s, false)"""
+
+# DISTANCE_SQL: meters to a point, see order_by_distance {{{1
+# events without coordinates are sorted last
+DISTANCE_SQL = {
+    'postgresql': u"""COALESCE(ST_Distance(events_event.coordinates::geography,
+        ST_GeogFromText(%s), false), 1e9)""",
+    'sqlite': u"""COALESCE(Distance(events_event.coordinates,
+        GeomFromText(%s, 4326), 1), 1e9)""", }
+
+# CLUSTER_SQL: clusters of the events of a map tile, see _tile_clusters {{{1
+# the events of the subquery are grouped by the cells of a grid starting at
+# the south-west corner of the tile
+CLUSTER_SQL = {
+    'postgresql': u"""SELECT COUNT(*), AVG(ST_X(coordinates)),
+        AVG(ST_Y(coordinates)), (array_agg(id ORDER BY id))[1:%%s]
+        FROM events_event WHERE id IN (%s)
+        GROUP BY ST_SnapToGrid(coordinates, %%s, %%s, %%s, %%s)""",
+    'sqlite': u"""SELECT COUNT(*), AVG(X(coordinates)), AVG(Y(coordinates)),
+        group_concat(id) FROM events_event WHERE id IN (%s)
+        GROUP BY CAST((X(coordinates) - %%s) / %%s AS INTEGER),
+            CAST((Y(coordinates) - %%s) / %%s AS INTEGER)""", }
+
 class GeoLookupError( Exception ): # {{{1
     """ exception raises when no coordinates can be looked up for a given name
     """
@@ -99,37 +151,27 @@ class ContinentLookupError( Exception ): # {{{1
     """
     pass
 
-def continent_restriction( queryset, query ): #{{{1
-    """ returns a tuple (a queryset an a string ) restricting ``queryset`` with
-    the continent of ``query`` and removing them from ``query`` """
-    for loc in CONTINENT_REGEX.findall(query):
-        from grical.data.models import (ContinentBorder,
-                CONTINENT_COUNTRIES)
-        continent = loc.upper()
-        try:
-            mpoly = ContinentBorder.objects.get(code=continent).mpoly
-            # TODO: also use names in different languages using
-            # data.models.CONTINENTS
-            # Example: @@europa
-        except ContinentBorder.DoesNotExist:
-            raise ContinentLookupError()
-        countries = CONTINENT_COUNTRIES[continent]
+# TRIGRAM_COLUMNS: columns of Event with a trigram index {{{1
+TRIGRAM_COLUMNS = ( 'title', 'city', 'acronym' )
+
+def continent_restriction( queryset, continents ): #{{{1
+    """ returns ``queryset`` restricted to the ``continents`` of a compiled
+    term, see :class:`CompiledTerm` """
+    for code, countries in continents:
+        # the continent of the coordinates is stored in Event.save
         if queryset.model == Event:
             queryset = queryset.filter(
-                    Q(coordinates__contained = mpoly) |
-                    Q(country__in = countries))
+                    Q(continent = code) | Q(country__in = countries))
         else:
             queryset = queryset.filter(
-                    Q(event__coordinates__contained = mpoly) |
+                    Q(event__continent = code) |
                     Q(event__country__in = countries))
-        query = CONTINENT_REGEX.sub("", query)
-    return queryset, query
+    return queryset
 
-def exclusion( queryset, query ): #{{{1
-    """ returns a tuple (a queryset an a string ) restricting ``queryset``
-    excluding events if ``query`` contains expressions starting with ``-``
-    """
-    for word in EXCLUSION_REGEX.findall(query):
+def exclusion( queryset, words ): #{{{1
+    """ returns ``queryset`` excluding events matching the expressions of
+    ``words`` (expressions starting with ``-`` in a query, without it) """
+    for word in words:
         if queryset.model == Event:
             if word[0] == '#':
                 if len(word) == 1:
@@ -184,101 +226,123 @@ def exclusion( queryset, query ): #{{{1
                     Q(event__acronym__icontains = word) | \
                     Q(event__tags__icontains = word)
         queryset = queryset.exclude(exclusion_q)
-        query = EXCLUSION_REGEX.sub("", query)
-    return queryset, query
-
-def location_restriction( queryset, query ): #{{{1
-    """ returns a tuple (a queryset an a string ) restricting ``queryset`` with
-    the locations of ``query`` and removing them from ``query`` """
-    for loc in LOCATION_REGEX.findall(query):
-        if loc[11]: # name or name,name
-            # name given, which can have a city, a comma and a country
-            city, country = CITY_COUNTRY_RE.findall( loc[11] )[0]
-            if not country:
-                if queryset.model == Event:
-                    queryset = queryset.filter(
-                        Q( city__iexact = city ) | Q(
-                            country__iexact = city ) )
-                        # TODO: use also translations of locations and
-                        # alternative names
-                else:
-                    queryset = queryset.filter(
-                        Q( event__city__iexact = city ) | Q(
-                            event__country__iexact = city ) )
-            else:
-                result = search_name( city + ', ' + country )
-                if result:
-                    point = result.get('coordinates', None)
-                else:
-                    point = None
-                distance = { settings.DISTANCE_UNIT_DEFAULT:
-                        settings.CITY_RADIUS, }
-                if queryset.model == Event:
-                    if point:
-                        # example: ...coordinates__distance_lte=(pnt, D(km=7)))
-                        queryset = queryset.filter(
-                           Q( city__iexact=city, country__iexact=country ) |
-                           Q( coordinates__distance_lte =
-                            ( point, D( **distance ) ) ) )
-                    else:
-                        queryset = queryset.filter(
-                           city__iexact = city, country__iexact = country )
-                else:
-                    if point:
-                        queryset = queryset.filter(
-                           Q( event__city__iexact = city,
-                               event__country__iexact = country ) |
-                           Q( event__coordinates__distance_lte =
-                                ( point, D( **distance ) ) ) )
-                    else:
-                        queryset = queryset.filter(
-                           event__city__iexact = city,
-                           event__country__iexact = country )
-        elif loc[8]: # name + distance + optional unit
-            result = search_name( loc[8] )
-            if result:
-                point = result.get('coordinates', None)
-            else:
-                point = None
-            if not point:
-                raise GeoLookupError()
-            if loc[10]:
-                distance = {loc[10]: loc[9],}
-            else:
-                distance = { settings.DISTANCE_UNIT_DEFAULT: loc[9],}
-            # example: ...filter(coordinates__distance_lte=(pnt, D(km=7)))
-            if queryset.model == Event:
-                queryset = queryset.filter(
-                        coordinates__distance_lte =
-                            ( point, D( **distance ) ) )
-            else:
-                queryset = queryset.filter(
-                        event__coordinates__distance_lte =
-                            ( point, D( **distance ) ) )
-        elif loc[4]:
-            # coordinates given
-            point = Point( float(loc[5]), float(loc[4]) )
-            if loc[7]:
-                distance = {loc[7]: loc[6],}
-            else:
-                distance = { settings.DISTANCE_UNIT_DEFAULT: loc[6],}
+    return queryset
+
+def bounding_box( point, meters ): #{{{1
+    """ returns a ``Polygon`` containing all points within ``meters`` of
+    ``point`` on the sphere, or None if it would contain a pole or cross the
+    antimeridian
+
+    >>> box = bounding_box( Point( 13.4, 52.5 ), 10000 )
+    >>> [ round( value, 2 ) for value in box.extent ]
+    [13.25, 52.41, 13.55, 52.59]
+    >>> bounding_box( Point( 179.99, 0 ), 10000 ) is None
+    True
+    """
+    # the margin covers the difference with distances on the spheroid
+    angle = meters * 1.01 / EARTH_RADIUS
+    south = point.y - math.degrees( angle )
+    north = point.y + math.degrees( angle )
+    cos_lat = math.cos( math.radians( point.y ) )
+    if south <= -90 or north >= 90 or math.sin( angle ) >= cos_lat:
+        return None
+    delta_lng = math.degrees( math.asin( math.sin( angle ) / cos_lat ) )
+    west = point.x - delta_lng
+    east = point.x + delta_lng
+    if west < -180 or east > 180:
+        return None
+    return Polygon.from_bbox( ( west, south, east, north ) )
+
+def radius_q( point, meters, prefix = '' ): #{{{1
+    """ returns a ``Q`` of events (or of dates if ``prefix`` is ``event__``)
+    with coordinates within ``meters`` of ``point``.
+
+    In PostgreSQL it uses ``ST_DWithin`` on geography, which uses the index
+    of the geography of the coordinates. Otherwise the distance is only
+    computed for the coordinates inside a bounding box (see
+    :func:`bounding_box`), which uses the spatial index. """
+    if connection.vendor == 'postgresql':
+        return Q( **{ prefix + 'id__in': RawSQL( RADIUS_SQL,
+            [ 'SRID=4326;' + point.wkt, meters ] ) } )
+    distance_q = Q( **{ prefix + 'coordinates__distance_lte':
+        ( point, D( m = meters ) ) } )
+    box = bounding_box( point, meters )
+    if box is None:
+        return distance_q
+    return Q( **{ prefix + 'coordinates__contained': box } ) & distance_q
+
+def order_by_distance( queryset, point ): #{{{1
+    """ returns ``queryset`` of events with the annotation ``distance`` in
+    meters from ``point`` (1e9 for events without coordinates), for sorting
+    by it. It uses PostgreSQL or SpatiaLite functions. """
+    return queryset.annotate( distance = RawSQL(
+        DISTANCE_SQL[ connection.vendor ], [ point.wkt ],
+        output_field = FloatField() ) )
+
+def map_tiles( bbox, zoom ): #{{{1
+    """ returns a list of the tiles ``( zoom, x, y )`` covering ``bbox``, a
+    tuple ``( west, south, east, north )`` in degrees. Tiles are squares of
+    ``360 / 2 ** zoom`` degrees numbered from longitude -180 and latitude
+    -90. The zoom is reduced until there are at most
+    ``settings.MAP_CLUSTER_MAX_TILES`` tiles.
+
+    >>> map_tiles( ( 10, 40, 20, 50 ), 2 )
+    [(2, 2, 1)]
+    >>> map_tiles( ( -10, 40, 10, 50 ), 2 )
+    [(2, 1, 1), (2, 2, 1)]
+    """
+    west, south, east, north = bbox
+    if west > east:
+        # the box crosses the antimeridian
+        west, east = -180, 180
+    west, east = max( west, -180 ), min( east, 180 )
+    south, north = max( south, -90 ), min( north, 90 )
+    zoom = max( 0, min( int( zoom ), settings.MAP_CLUSTER_MAX_ZOOM ) )
+    while True:
+        size = 360.0 / 2 ** zoom
+        last_x = 2 ** zoom - 1
+        last_y = int( math.ceil( 180 / size ) ) - 1
+        xs = range( min( int( ( west + 180 ) // size ), last_x ),
+                min( int( ( east + 180 ) // size ), last_x ) + 1 )
+        ys = range( min( int( ( south + 90 ) // size ), last_y ),
+                min( int( ( north + 90 ) // size ), last_y ) + 1 )
+        if zoom == 0 or len( xs ) * len( ys ) <= \
+                settings.MAP_CLUSTER_MAX_TILES:
+            return [ ( zoom, x, y ) for x in xs for y in ys ]
+        zoom -= 1
+
+def location_restriction( queryset, locations ): #{{{1
+    """ returns ``queryset`` restricted to the ``locations`` of a compiled
+    term, see :meth:`CompiledTerm._compile_location` """
+    for location in locations:
+        kind = location[0]
+        if kind == 'name':
+            # TODO: use also translations of locations and alternative names
+            name = location[1]
             if queryset.model == Event:
                 queryset = queryset.filter(
-                        coordinates__distance_lte =
-                            ( point, D( **distance ) ) )
+                    Q( city__iexact = name ) | Q( country__iexact = name ) )
             else:
                 queryset = queryset.filter(
-                        event__coordinates__distance_lte =
-                            ( point, D( **distance ) ) )
-        elif loc[0]:
-            # We have 4 floats: longitude_west [0], longitude_east [1],
-            # latitude_north [2], latitude_south [3]
-            lng1 = float( loc[0] )
-            lat1 = float( loc[3] )
-            lng2 = float( loc[1] )
-            lat2 = float( loc[2] )
-            rectangle = Polygon( ((lng1, lat1), (lng2,lat1),
-                (lng2,lat2), (lng1,lat2), (lng1, lat1)) )
+                    Q( event__city__iexact = name ) |
+                    Q( event__country__iexact = name ) )
+        elif kind == 'city':
+            city, country, point, meters = location[1:]
+            prefix = '' if queryset.model == Event else 'event__'
+            place_q = Q( **{ prefix + 'city__iexact': city,
+                prefix + 'country__iexact': country } )
+            if point:
+                place_q |= radius_q( point, meters, prefix )
+            queryset = queryset.filter( place_q )
+        elif kind == 'distance':
+            point, meters = location[1:]
+            queryset = queryset.filter( radius_q( point, meters,
+                '' if queryset.model == Event else 'event__' ) )
+        else:
+            assert kind == 'box'
+            west, south, east, north = location[1:]
+            rectangle = Polygon( ( (west, south), (east, south),
+                (east, north), (west, north), (west, south) ) )
             if queryset.model == Event:
                 queryset = queryset.filter(
                         exact = True,
@@ -287,39 +351,92 @@ def location_restriction( queryset, query ): #{{{1
                 queryset = queryset.filter(
                         event__exact = True,
                         event__coordinates__within = rectangle )
-        else:
-            pass
-            # TODO: log error
-        query = LOCATION_REGEX.sub("", query)
-    return queryset, query
-
-def dates_restriction( queryset, query, broad ): #{{{1
-    dates = DATE_REGEX.findall( query )
-    if dates:
-        dates = [ datetime.date( int(year), int(month), int(day) ) for \
-                year, month, day in dates ]
-        sorted_dates = sorted( dates )
-        date1 = sorted_dates[0] # first date
-        date2 = sorted_dates[-1] # last date
+    return queryset
+
+def dates_restriction( queryset, dates_range, broad ): #{{{1
+    """ returns ``queryset`` restricted to events with a date in
+    ``dates_range`` (a tuple of two dates) or, if it is None and not
+    ``broad``, to events with upcoming dates """
+    if dates_range:
+        date1, date2 = dates_range
         if queryset.model == Event:
+            # multi-day events have no rows for the days between start and
+            # end, their span is checked instead
             queryset = queryset.filter(
-                    dates__eventdate_date__range = (date1, date2) )
+                    Q( dates__eventdate_date__range = (date1, date2) ) |
+                    span_overlap_q( date1, date2 ) )
         else:
             queryset = queryset.filter(
                     eventdate_date__range = (date1, date2) )
-        # remove all dates (yyyy-mm-dd) from the query
-        query = DATE_REGEX.sub("", query)
     elif not broad:
         today = datetime.date.today()
         if queryset.model == Event:
             queryset = queryset.filter( dates__eventdate_date__gte = today )
         else:
             queryset = queryset.filter( eventdate_date__gte = today )
-    return queryset, query
+    return queryset
 
-def words_restriction( queryset, words, broad, search_in_tags ): #{{{1
+def query_dates_window( query ): #{{{1
+    """ returns a tuple ``( first, last )`` with the first and the last date
+    a date of an event matching ``query`` can have, None meaning unbounded.
+
+    >>> query_dates_window( '2011-02-03 berlin | 2011-01-05 2011-01-01' )
+    (datetime.date(2011, 1, 1), datetime.date(2011, 2, 3))
+    >>> query_dates_window( '* berlin | 2011-01-05' )
+    (None, None)
+    """
+    firsts = []
+    lasts = []
+    for term in compile_query( query ).terms:
+        if term.dates_range:
+            firsts.append( term.dates_range[0] )
+            lasts.append( term.dates_range[1] )
+        elif term.upcoming:
+            firsts.append( datetime.date.today() )
+            lasts.append( None )
+        else:
+            firsts.append( None )
+            lasts.append( None )
+    first = None if None in firsts else min( firsts )
+    last = None if None in lasts else max( lasts )
+    return first, last
+
+def query_point( query ): #{{{1
+    """ returns the point of the first location of the terms of ``query``
+    with a distance (``@lat,lng+km``, ``@name+km``) or a city with
+    coordinates (``@city,country``), or None """
+    for term in compile_query( query ).terms:
+        for location in term.locations:
+            if location[0] == 'distance':
+                return location[1]
+            if location[0] == 'city' and location[3]:
+                return location[3]
+    return None
+
+def span_overlap_q( date1, date2 ): #{{{1
+    """ returns a ``Q`` for events with a span (from
+    :attr:`models.Event.start_date` to :attr:`models.Event.end_date`)
+    overlapping the range from ``date1`` to ``date2``, both included.
+
+    In PostgreSQL the GiST index ``events_event_span_gist`` is used with the
+    range operator ``&&``, see migration ``0006_event_date_spans``. """
+    if connection.vendor == 'postgresql':
+        return Q( id__in = RawSQL( "SELECT id FROM events_event WHERE "
+            "end_date IS NOT NULL AND daterange(start_date, end_date, '[]') "
+            "&& daterange(%s, %s, '[]')", ( date1, date2 ) ) )
+    return Q( start_date__lte = date2, end_date__gte = date1 )
+
+def words_restriction( queryset, words, broad, search_in_tags,
+        fuzzy = False ): #{{{1
     if not words:
         return queryset
+    if search_in_tags and connection.vendor == 'postgresql':
+        return full_text_restriction( queryset, words, broad, fuzzy )
+    return icontains_restriction( queryset, words, broad, search_in_tags )
+
+def icontains_restriction( queryset, words, broad, search_in_tags ): #{{{1
+    """ :func:`words_restriction` with ``icontains`` lookups, used when the
+    database is not PostgreSQL and for strict words """
     q_filters = None
     for word in words:
         if not word:
@@ -367,25 +484,481 @@ def words_restriction( queryset, words, broad, search_in_tags ): #{{{1
             q_filters &= q_word_filters # FIXME: events with partial words are matches, WTF
     return queryset.filter( q_filters )
 
-def tags_restriction( queryset, query ): #{{{1
-    tags = TAG_REGEX.findall(query)
+def full_text_restriction( queryset, words, broad, fuzzy = False ): #{{{1
+    """ PostgreSQL version of :func:`words_restriction`. All words must
+    match, each of them:
+
+    - in the full-text search document :attr:`models.Event.search_document`
+      stemmed with ``settings.FULL_TEXT_SEARCH_CONFIG`` (e.g.
+      ``conferences`` matches ``conference``). If not ``broad`` only the
+      title, acronym, tags, city and country are searched (the weights A, B
+      and C).
+    - or as part of the title, city or acronym (e.g. ``wash`` matches
+      ``Washington D.C.``), using ``ILIKE`` with the trigram indexes of
+      ``pg_trgm``.
+    - or, if ``fuzzy``, similar to a word of the title or city (e.g.
+      ``conferense`` matches ``conference``), see ``word_similarity`` of
+      ``pg_trgm``.
+
+    All conditions are resolved with GIN indexes. """
+    weights = u'' if broad else u':ABC'
+    conditions = []
+    params = []
+    for word in words:
+        alternatives = []
+        lexemes = LEXEME_REGEX.findall( word )
+        if lexemes:
+            alternatives.append(
+                    "search_document @@ to_tsquery(%s::regconfig, %s)" )
+            params.extend( [ settings.FULL_TEXT_SEARCH_CONFIG, u' & '.join(
+                [ lexeme + weights for lexeme in lexemes ] ) ] )
+        pattern = u'%' + LIKE_SPECIAL_REGEX.sub( r'\\\g<0>', word ) + u'%'
+        for column in TRIGRAM_COLUMNS:
+            alternatives.append( column + " ILIKE %s" )
+            params.append( pattern )
+        if fuzzy:
+            for column in ( 'title', 'city' ):
+                alternatives.append( "%s <%% " + column )
+                params.append( word )
+        conditions.append( u'(' + u' OR '.join( alternatives ) + u')' )
+    if not conditions:
+        return queryset
+    ids = RawSQL( "SELECT id FROM events_event WHERE " +
+            u' AND '.join( conditions ), params )
+    if queryset.model == Event:
+        return queryset.filter( id__in = ids )
+    return queryset.filter( event__id__in = ids )
+
+def add_rank( queryset, words ): #{{{1
+    """ returns a new queryset of events adding the relevance ``rank`` of
+    each event for ``words`` using its full-text search document. If the
+    database is not PostgreSQL, ``queryset`` is returned unchanged.
+
+    ``ts_rank`` returns a ``real`` which is cast to ``double precision`` so
+    that the rank of a cursor (see :func:`search_event_page`) is compared
+    exactly with the ranks of the rows. """
+    if not words or connection.vendor != 'postgresql':
+        return queryset
+    return queryset.annotate( rank = RawSQL( "ts_rank("
+        "events_event.search_document, plainto_tsquery(%s::regconfig, %s))"
+        "::float8",
+        ( settings.FULL_TEXT_SEARCH_CONFIG, u' '.join( words ) ),
+        output_field = FloatField() ) )
+
+def tags_restriction( queryset, tags ): #{{{1
+    """ returns ``queryset`` restricted to events with all existing tags of
+    ``tags`` """
     if tags:
         if queryset.model == Event:
             queryset = TaggedItem.objects.get_intersection_by_model(
-                    queryset, tags )
+                    queryset, list( tags ) )
         else:
             # TODO: inefficient, improve:
             for tag in tags:
                 queryset &= queryset.filter( event__tags__icontains = tag )
-        query = TAG_REGEX.sub("", query)
-    return queryset, query
+    return queryset
+
+def union_restriction( model, querysets ): #{{{1
+    """ returns a queryset of *model* with the rows of any of
+    ``querysets`` as one SQL statement with a subquery which is the
+    ``UNION`` of the ids of each queryset. Each part is planned
+    independently (e.g. using its own indexes and joins) instead of one
+    ``WHERE`` with the ``OR`` of the conditions and joins of all querysets.
+    Ordering and slicing can be applied to the returned queryset. """
+    parts = []
+    params = []
+    not_empty = []
+    for queryset in querysets:
+        if queryset.query.is_empty():
+            continue
+        try:
+            sql, part_params = queryset.order_by().values( 'id'
+                    ).query.sql_with_params()
+        except EmptyResultSet:
+            # e.g. a filter with an empty list of ids
+            continue
+        not_empty.append( queryset )
+        parts.append( sql )
+        params.extend( part_params )
+    if not not_empty:
+        return model.objects.none()
+    if len( not_empty ) == 1:
+        return not_empty[0]
+    return model.objects.filter(
+            id__in = RawSQL( u' UNION '.join( parts ), params ) )
+
+# plan cache {{{1
+# LRU of compiled queries keyed by queries and by their normalized forms
+_COMPILED_QUERIES = OrderedDict()
+_COMPILED_QUERIES_LOCK = threading.Lock()
+
+def compile_query( query ): #{{{1
+    """ returns a :class:`CompiledQuery` for ``query``, which is used by
+    :func:`search_events` to build the SQL query and can check in memory if
+    an event matches ``query`` as :func:`search_events` with ``related =
+    False`` would do.
+
+    Compiled queries are kept in a LRU cache (per process) of
+    ``settings.SEARCH_PLAN_CACHE_SIZE`` entries keyed by the query and by
+    its normalized form (:attr:`CompiledQuery.key`), so that parsing and
+    geographic lookups are shared by all views, feeds and filters, and
+    equivalent queries share the same compiled query:
+
+    >>> compile_query( u'Python  #b #a' ) is compile_query( u'#a python #b' )
+    True
+
+    It raises the same exceptions as :func:`search_events`, e.g. a
+    ``ValueError`` for a date out of range or :class:`GeoLookupError`.
+    """
+    if not query:
+        return CompiledQuery( query )
+    with _COMPILED_QUERIES_LOCK:
+        compiled = _COMPILED_QUERIES.pop( query, None )
+        if compiled is not None:
+            _COMPILED_QUERIES[ query ] = compiled
+            return compiled
+    compiled = CompiledQuery( query )
+    with _COMPILED_QUERIES_LOCK:
+        compiled = _COMPILED_QUERIES.pop( compiled.key, compiled )
+        _COMPILED_QUERIES[ compiled.key ] = compiled
+        _COMPILED_QUERIES[ query ] = compiled
+        while len( _COMPILED_QUERIES ) > settings.SEARCH_PLAN_CACHE_SIZE:
+            _COMPILED_QUERIES.popitem( last = False )
+    return compiled
 
-def search_events( query, related = True, model = Event ): #{{{1
+class CompiledQuery( object ): #{{{1
+    """ an immutable parsed query, see :func:`compile_query`. Its ``key`` is
+    a normalized form of the query, equal for equivalent queries.
+
+    To avoid SQL queries when calling :meth:`matches`, events should have
+    prefetched ``dates``, ``urls``, ``sessions`` and ``calendar__group``.
+    Only when an event has some but not all tags of a term, a query is made
+    to check if the other tags exist (non existing tags are ignored by the
+    search). In PostgreSQL the words of a term are checked with one query
+    with :func:`full_text_restriction`, because stemmed words can only be
+    matched by the database.
+    """
+    def __init__( self, query ):
+        terms = []
+        if query:
+            for term in query.split(' | '):
+                term = CompiledTerm( term )
+                if term.key not in [ other.key for other in terms ]:
+                    terms.append( term )
+        self.terms = tuple( sorted( terms, key = lambda term: term.key ) )
+        self.key = u' | '.join( [ compiled.key for compiled in self.terms ] )
+        self._frozen = True
+
+    def __setattr__( self, name, value ):
+        if getattr( self, '_frozen', False ):
+            raise AttributeError( 'compiled queries are immutable' )
+        super( CompiledQuery, self ).__setattr__( name, value )
+
+    def matches( self, event, fuzzy = False ):
+        """ returns True if ``event`` matches the query, with similar
+        words if ``fuzzy`` as :func:`search_events` """
+        for term in self.terms:
+            if term.matches( event, fuzzy ):
+                return True
+        return False
+
+class CompiledTerm( object ): #{{{1
+    """ an immutable term of a query (terms are separated by `` | ``) with
+    its restrictions normalized: sorted, lowercase (the search is not case
+    sensitive) and with the coordinates of the names of places """
+    def __init__( self, query ):
+        self.event_ids = tuple( sorted( set( [ int( event_id ) for event_id
+            in EVENT_REGEX.findall( query ) ] ) ) )
+        broad = bool( BROAD_REGEX.match( query ) )
+        query = BROAD_REGEX.sub( "", query )
+        self.exclusions = tuple( sorted( set( [ word.lower() for word in
+            EXCLUSION_REGEX.findall( query ) ] ) ) )
+        query = EXCLUSION_REGEX.sub( "", query )
+        if self.event_ids:
+            broad = True # '=' show past events too
+        self.broad = broad
+        query = EVENT_REGEX.sub( "", query )
+        self.groups = tuple( sorted( set( [ group_name.lower() for
+            group_name in GROUP_REGEX.findall( query ) ] ) ) )
+        query = GROUP_REGEX.sub( "", query )
+        # NOTE: continents (@@) must be before locations (@) because of the
+        # similar regexes
+        # tuples: (code, countries)
+        continents = []
+        for continent in set( [ loc.upper() for loc in
+                CONTINENT_REGEX.findall( query ) ] ):
+            from grical.data.models import (ContinentBorder,
+                    CONTINENT_COUNTRIES)
+            # TODO: also use names in different languages using
+            # data.models.CONTINENTS
+            # Example: @@europa
+            if not ContinentBorder.objects.filter( code = continent ).exists():
+                raise ContinentLookupError()
+            continents.append( ( continent, CONTINENT_COUNTRIES[continent] ) )
+        self.continents = tuple( sorted( continents ) )
+        query = CONTINENT_REGEX.sub( "", query )
+        locations = []
+        for loc in LOCATION_REGEX.findall( query ):
+            location = self._compile_location( loc )
+            if location and location not in locations:
+                locations.append( location )
+        self.locations = tuple( sorted( locations,
+            key = self._location_key ) )
+        query = LOCATION_REGEX.sub( "", query )
+        tags = TAG_REGEX.findall( query )
+        if tagging_settings.FORCE_LOWERCASE_TAGS:
+            tags = [ tag.lower() for tag in tags ]
+        self.tags = frozenset( tags )
+        query = TAG_REGEX.sub( "", query )
+        dates = DATE_REGEX.findall( query )
+        if dates:
+            dates = sorted( [ datetime.date( int(year), int(month), int(day) )
+                for year, month, day in dates ] )
+            self.dates_range = ( dates[0], dates[-1] )
+        else:
+            self.dates_range = None
+        self.upcoming = not dates and not self.broad
+        query = DATE_REGEX.sub( "", query )
+        words = SPACE_REGEX.split( query.lower() )
+        self.words = frozenset(
+                [ word for word in words if word and word[0] != '+' ] )
+        self.words_strict = frozenset( [ word[1:] for word in words
+            if word and word[0] == '+' and len(word) > 1 ] )
+        self.key = repr( (
+            self.broad, self.event_ids, self.exclusions, self.groups,
+            tuple( [ continent[0] for continent in self.continents ] ),
+            tuple( [ self._location_key( compiled ) for compiled in
+                self.locations ] ),
+            tuple( sorted( self.tags ) ), self.dates_range,
+            tuple( sorted( self.words ) ),
+            tuple( sorted( self.words_strict ) ) ) )
+        self._frozen = True
+
+    def __setattr__( self, name, value ):
+        if getattr( self, '_frozen', False ):
+            raise AttributeError( 'compiled terms are immutable' )
+        super( CompiledTerm, self ).__setattr__( name, value )
+
+    @staticmethod
+    def _compile_location( loc ):
+        """ returns a tuple for a match of :data:`LOCATION_REGEX`, the first
+        element being one of ``name``, ``city``, ``distance`` or ``box`` """
+        if loc[11]:
+            # name given, which can have a city, a comma and a country
+            city, country = CITY_COUNTRY_RE.findall( loc[11] )[0]
+            if not country:
+                return ( 'name', city.lower() )
+            result = search_name( city + ', ' + country )
+            point = result.get( 'coordinates', None ) if result else None
+            meters = D( **{ settings.DISTANCE_UNIT_DEFAULT:
+                settings.CITY_RADIUS } ).m
+            return ( 'city', city.lower(), country.lower(), point, meters )
+        elif loc[8]:
+            # name + distance + optional unit
+            result = search_name( loc[8] )
+            point = result.get( 'coordinates', None ) if result else None
+            if not point:
+                raise GeoLookupError()
+            unit = loc[10] or settings.DISTANCE_UNIT_DEFAULT
+            return ( 'distance', point, D( **{ unit: loc[9] } ).m )
+        elif loc[4]:
+            # coordinates given
+            point = Point( float(loc[5]), float(loc[4]) )
+            unit = loc[7] or settings.DISTANCE_UNIT_DEFAULT
+            return ( 'distance', point, D( **{ unit: loc[6] } ).m )
+        elif loc[0]:
+            # 4 floats: two longitudes and two latitudes
+            lngs = sorted( [ float( loc[0] ), float( loc[1] ) ] )
+            lats = sorted( [ float( loc[2] ), float( loc[3] ) ] )
+            return ( 'box', lngs[0], lats[0], lngs[1], lats[1] )
+        return None
+
+    @staticmethod
+    def _location_key( location ):
+        """ returns a comparable normalized form of a compiled location,
+        points are replaced by their rounded coordinates """
+        return tuple( [ ( round( value.x, 6 ), round( value.y, 6 ) )
+            if isinstance( value, Point ) else value
+            for value in location ] )
+
+    def matches( self, event, fuzzy = False ): #{{{2
+        """ returns True if ``event`` matches the term, with similar words
+        if ``fuzzy`` (only in PostgreSQL, as :func:`search_events`) """
+        for word in self.exclusions:
+            if _excluded( event, word ):
+                return False
+        for event_id in self.event_ids:
+            if event.pk != event_id:
+                return False
+        if self.groups:
+            names = set( [ calendar.group.name.lower() for calendar in
+                event.calendar.all() ] )
+            for group_name in self.groups:
+                if group_name not in names:
+                    return False
+        for code, countries in self.continents:
+            if event.continent != code and event.country not in countries:
+                return False
+        for location in self.locations:
+            if not _located( event, location ):
+                return False
+        if self.tags and not _tagged( event, self.tags ):
+            return False
+        if self.dates_range or self.upcoming:
+            dates = [ eventdate.eventdate_date for eventdate in
+                    event.dates.all() ]
+            if self.dates_range:
+                date1, date2 = self.dates_range
+                if not [ date for date in dates if date1 <= date <= date2 ] \
+                        and not _span_overlaps( event, date1, date2 ):
+                    return False
+            else:
+                today = datetime.date.today()
+                if not [ date for date in dates if date >= today ]:
+                    return False
+        if self.words:
+            if connection.vendor == 'postgresql':
+                if not full_text_restriction( Event.objects.filter(
+                        pk = event.pk ), list( self.words ),
+                        self.broad, fuzzy ).exists():
+                    return False
+            elif not _words_match( event, self.words, self.broad, True ):
+                return False
+        if self.words_strict and not _words_match(
+                event, self.words_strict, False, False ):
+            return False
+        return True
+
+def _span_overlaps( event, date1, date2 ): #{{{1
+    """ in-memory version of :func:`span_overlap_q` using the prefetched
+    dates of ``event`` """
+    start = end = None
+    for eventdate in event.dates.all():
+        if eventdate.eventdate_name == 'start':
+            start = eventdate.eventdate_date
+        elif eventdate.eventdate_name == 'end':
+            end = eventdate.eventdate_date
+    if start is None or end is None:
+        return False
+    return start <= date2 and end >= date1
+
+def _icontains( value, word ): #{{{1
+    return value is not None and word.lower() in unicode( value ).lower()
+
+def _iexact( value, word ): #{{{1
+    return value is not None and word.lower() == unicode( value ).lower()
+
+def _excluded( event, word ): #{{{1
+    """ in-memory version of :func:`exclusion` for one word """
+    if word[0] == '#':
+        if len(word) == 1:
+            return event.tags is not None
+        return _icontains( event.tags, word[1:] )
+    elif word[0] == '@':
+        if len(word) == 1:
+            return event.city is not None or event.country is not None or \
+                    event.coordinates is not None or event.address is not None
+        return _icontains( event.city, word[1:] ) or \
+                _icontains( event.country, word[1:] )
+    return _icontains( event.title, word ) or \
+            _icontains( event.city, word ) or \
+            _iexact( event.country, word ) or \
+            _icontains( event.acronym, word ) or \
+            _icontains( event.tags, word )
+
+def _sphere_distance( point1, point2 ): #{{{1
+    """ distance in meters between two points on a sphere """
+    lng1, lat1, lng2, lat2 = [ math.radians( value ) for value in
+            ( point1.x, point1.y, point2.x, point2.y ) ]
+    a = math.sin( ( lat2 - lat1 ) / 2 ) ** 2 + math.cos( lat1 ) * \
+            math.cos( lat2 ) * math.sin( ( lng2 - lng1 ) / 2 ) ** 2
+    return 2 * EARTH_RADIUS * math.asin( min( 1, math.sqrt( a ) ) )
+
+def _located( event, location ): #{{{1
+    """ in-memory version of :func:`location_restriction` for one location,
+    see :meth:`CompiledTerm._compile_location` """
+    kind = location[0]
+    if kind == 'name':
+        return _iexact( event.city, location[1] ) or \
+                _iexact( event.country, location[1] )
+    elif kind == 'city':
+        city, country, point, meters = location[1:]
+        if _iexact( event.city, city ) and _iexact( event.country, country ):
+            return True
+        return bool( point and event.coordinates is not None and
+                _sphere_distance( event.coordinates, point ) <= meters )
+    elif kind == 'distance':
+        point, meters = location[1:]
+        return event.coordinates is not None and \
+                _sphere_distance( event.coordinates, point ) <= meters
+    assert kind == 'box'
+    west, south, east, north = location[1:]
+    return event.exact == True and event.coordinates is not None and \
+            west < event.coordinates.x < east and \
+            south < event.coordinates.y < north
+
+def _tagged( event, tags ): #{{{1
+    """ in-memory version of :func:`tags_restriction`: all existing tags of
+    ``tags`` must be tags of ``event`` """
+    event_tags = parse_tag_input( event.tags )
+    if tagging_settings.FORCE_LOWERCASE_TAGS:
+        event_tags = [ tag.lower() for tag in event_tags ]
+    event_tags = set( event_tags )
+    if not tags & event_tags:
+        return False
+    missing = tags - event_tags
+    return not ( missing and Tag.objects.filter( name__in = missing ).exists() )
+
+def _words_match( event, words, broad, search_in_tags ): #{{{1
+    """ in-memory version of :func:`icontains_restriction` """
+    pending = []
+    for word in words:
+        if _icontains( event.title, word ) or \
+                _icontains( event.city, word ) or \
+                _iexact( event.country, word ) or \
+                _icontains( event.acronym, word ):
+            continue
+        if search_in_tags and _icontains( event.tags, word ):
+            continue
+        if broad and ( _icontains( event.address, word ) or
+                _icontains( event.description, word ) ):
+            continue
+        pending.append( word )
+    if not pending:
+        return True
+    if not broad:
+        return False
+    # all words are checked with the same joined rows of urls, dates and
+    # sessions, as the SQL query does
+    for url in list( event.urls.all() ) or [ None ]:
+        for eventdate in list( event.dates.all() ) or [ None ]:
+            for session in list( event.sessions.all() ) or [ None ]:
+                for word in pending:
+                    if url and ( _icontains( url.url_name, word ) or
+                            _icontains( url.url, word ) ):
+                        continue
+                    if eventdate and _icontains(
+                            eventdate.eventdate_name, word ):
+                        continue
+                    if session and _icontains( session.session_name, word ):
+                        continue
+                    break
+                else:
+                    return True
+    return False
+
+def search_events( query, related = True, model = Event,
+        fuzzy = False ): #{{{1
     # doc {{{2
     """ returns a sorted (by :attr:`models.Event.upcoming`) list of
     distinct events matching ``query`` adding related events if
     *related* is True.
 
+    In PostgreSQL the events (if *model* is Event) have a ``rank`` with their
+    relevance for the words of the query, see :func:`add_rank`. If *fuzzy*
+    is True, words also match similar words of titles and cities, see
+    :func:`full_text_restriction` (only in PostgreSQL).
+
     It can throw a ``ValueError`` if for instance a day is out of range for
     a month in a date, e.g. 2011-04-31. Also if for instance the location API
     didn't work.
@@ -395,7 +968,8 @@ def search_events( query, related = True, model = Event ): #{{{1
 
     If ``query`` contains `` | `` strings (space, pipe, space), they are
     consider as logical ``or``. Related events are found for each of these
-    terms.
+    terms. The terms are combined with a ``UNION``, see
+    :func:`union_restriction`.
 
     If *related* is True and there is no special restriction (see below) it
     adds to the result events with related tags, but no more that the
@@ -404,38 +978,28 @@ def search_events( query, related = True, model = Event ): #{{{1
     a location term (marked with ``@``), only related events with the same
     location are added. If the query contains a time term (``yyyy-mm-dd``
     or ``yyyy-mm-dd yyyy-mm-dd``), only related events with the same time
-    are added.
+    are added. Related tags are the ``settings.SEARCH_RELATED_TAGS`` tags
+    with the highest score of co-occurrence with the words, see
+    :class:`grical.tagging.models.TagCooccurrence`.
 
     Related events are not added if the query contains a group term (marked
     with ``!``), a tag term (marked with ``#``), or an event term (marked with
     ``=``).
     """
     # body {{{2
-    # TODO: add full indexing text on Event.description and comments. See
-    # http://wiki.postgresql.org/wiki/Full_Text_Indexing_with_PostgreSQL
-    # performance.
+    # NOTE: in PostgreSQL the words are searched in the full-text search
+    # document of events, see full_text_restriction
     assert ( model == Event ) | ( model == EventDate )
-    result = model.objects.none()
     if not query:
-        return result
-    terms = query.split(' | ')
-    # broad search check
-    broad_regex = re.compile(r'^\* +', re.UNICODE) # beginninig with * followed
-                                                # by 1 ore more spaces
+        return model.objects.none()
+    # words of all terms for ranking the result
+    ranked_words = set()
+    # a queryset for each term, see union_restriction
+    branches = []
     # searching for each term
-    for query in terms:
-        groups_match = GROUP_REGEX.findall( query )
-        tags_match = TAG_REGEX.findall( query )
-        events_match = EVENT_REGEX.findall( query )
-        if ( not related ) or groups_match or tags_match or events_match:
-            related = False
-        else:
-            related = True
-        if broad_regex.match( query ):
-            broad = True
-            query = broad_regex.sub("", query)
-        else:
-            broad = False
+    for term in compile_query( query ).terms:
+        term_related = related and not (
+                term.groups or term.tags or term.event_ids )
         if model == EventDate:
             queryset = EventDate.objects.select_related().defer(
                 'event__description', 'event__coordinates',
@@ -444,101 +1008,349 @@ def search_events( query, related = True, model = Event ): #{{{1
         else:
             queryset = Event.objects.all()
         # exclusion
-        queryset, query = exclusion(queryset, query)
+        queryset = exclusion( queryset, term.exclusions )
         # single events
-        for event_id in events_match:
+        for event_id in term.event_ids:
             if model == Event:
                 queryset = queryset.filter( pk = event_id )
             else: # model is EventDate
                 queryset = queryset.filter( event__pk = event_id )
-            broad = True # '=' show past events too
-        query = EVENT_REGEX.sub("", query)
         # groups
-        for group_name in GROUP_REGEX.findall( query ):
+        for group_name in term.groups:
             if model == Event:
                 queryset = queryset.filter(
                         calendar__group__name__iexact = group_name)
             else: # model is EventDate
                 queryset = queryset.filter(
                         event__calendar__group__name__iexact = group_name)
-        query = GROUP_REGEX.sub("", query)
         # continents
-        # NOTE: continent_restriction (@@) must be before (@) because of the
-        # similar regexes
-        queryset, query = continent_restriction( queryset, query )
+        queryset = continent_restriction( queryset, term.continents )
         # locations
-        queryset, query = location_restriction( queryset, query )
+        queryset = location_restriction( queryset, term.locations )
         # tags
-        queryset, query = tags_restriction( queryset, query )
+        queryset = tags_restriction( queryset, term.tags )
         # dates
-        queryset, query = dates_restriction( queryset, query, broad )
-        if not query.strip():
-            result = result | queryset
+        queryset = dates_restriction( queryset, term.dates_range, term.broad )
+        if not term.words and not term.words_strict:
+            branches.append( queryset )
             continue
         # remaining unique words
-        words = SPACE_REGEX.split( query )
-        words_set = set(
-                [ word for word in words if word and word[0] != '+' ] )
+        ranked_words.update( term.words )
         queryset_with_words_restriction = words_restriction(
-                queryset, list( words_set ), broad, True )
-        if related and words_set and model == Event:
+                queryset, list( term.words ), term.broad, True, fuzzy )
+        if term_related and term.words and model == Event:
             # FIXME: make it also work for: model = EventDate
-            related_tags = set()
-            for tag in list( words_set ):
-                try:
-                    tag = Tag.objects.get( name = tag )
-                    related_tags.update( Tag.objects.related_for_model(
-                        tag, Event, counts = False ) )
-                except Tag.DoesNotExist:
-                    pass
-            related_tags.difference_update( words_set )
+            # the tags most used together with the words as tags, from the
+            # co-occurrences table with one query
+            related_tags = TagCooccurrence.objects.related_for_tags(
+                    term.words, Event, settings.SEARCH_RELATED_TAGS )
             related_events = TaggedItem.objects.get_union_by_model(
                         queryset, # NOTE we use all the restrictions here
-                        [ tag.name for tag in related_tags ] )
-            partial_result = related_events | queryset_with_words_restriction
+                        related_tags )
+            partial_result = union_restriction( Event,
+                    [ queryset_with_words_restriction, related_events ] )
         else:
             partial_result = queryset_with_words_restriction
-        words_strict = set(
-            [ word[1:] for word in words if word and word[0] == '+' and
-                len(word) > 1 ] )
-        result = result | words_restriction(
-                partial_result, words_strict, False, False )
+        branches.append( words_restriction(
+                partial_result, list( term.words_strict ), False, False ) )
+    result = union_restriction( model, branches )
+    if model == Event:
+        result = add_rank( result, sorted( ranked_words ) )
     return result
 
+# result cache {{{1
+# the generation counter increased by any change of any event
+SEARCH_GENERATION = 'search_generation'
+
+def search_event_ids( query, related = True, model = Event,
+        fuzzy = False, ranked = True, by_distance = False ): #{{{2
+    """ returns a list with the ids of the distinct events (or dates if
+    *model* is EventDate) of :func:`search_events` sorted as the views show
+    them: events by ``rank`` (if *ranked* is True and there is a rank, see
+    :func:`add_rank`) and by ``upcoming``, and dates by date. If
+    *by_distance* is True and the query has a point (see
+    :func:`query_point`), events are sorted by their distance to it. The
+    events of a page of the list can be fetched with
+    :func:`fetch_search_results`.
+
+    Lists are cached for ``settings.SEARCH_RESULTS_CACHE_TIMEOUT`` seconds
+    keyed by the normalized query (:attr:`CompiledQuery.key`), the other
+    parameters, the current day (the upcoming dates change daily) and the
+    values of the generation counters the result depends on, see
+    :func:`search_generation_keys`. When an event changes, the counters of
+    its tags and places and the global counter are increased by
+    :func:`bump_search_generations` making the affected entries
+    unreachable. Hits and misses are counted, see :func:`search_cache_stats`.
+    """
+    compiled = compile_query( query )
+    if not compiled.terms:
+        return []
+    key = _search_results_key( compiled, model, related, bool( fuzzy ),
+            bool( ranked ), bool( by_distance ) )
+    ids = cache.get( key )
+    if ids is not None:
+        _count_search_cache( 'hits' )
+        return ids
+    _count_search_cache( 'misses' )
+    result, keys = _sorting_keys(
+            search_events( query, related, model, fuzzy ), ranked,
+            query_point( query ) if by_distance else None )
+    result = result.order_by( *keyset_ordering( keys ) ).distinct()
+    ids = list( result.values_list( 'id', flat = True ) )
+    cache.set( key, ids, settings.SEARCH_RESULTS_CACHE_TIMEOUT )
+    return ids
+
+def search_event_page( query, related = True, model = Event,
+        fuzzy = False, ranked = True, cursor = None,
+        limit = 20, by_distance = False ): #{{{2
+    """ returns a :class:`grical.events.pagination.CursorPage` with the
+    ids of up to ``limit`` events (or dates if *model* is EventDate) of
+    :func:`search_events` after the position of ``cursor``, sorted as by
+    :func:`search_event_ids`. Only the rows of the page are selected (see
+    :func:`grical.events.pagination.keyset_page`), without counting the
+    result. Pages are cached as :func:`search_event_ids`.
+
+    It raises :class:`grical.events.pagination.InvalidCursorError` if
+    ``cursor`` is not valid. """
+    compiled = compile_query( query )
+    if not compiled.terms:
+        return CursorPage( [] )
+    key = _search_results_key( compiled, model, related, bool( fuzzy ),
+            bool( ranked ), bool( by_distance ), cursor, limit )
+    page = cache.get( key )
+    if page is not None:
+        _count_search_cache( 'hits' )
+        return CursorPage( *page )
+    _count_search_cache( 'misses' )
+    result, keys = _sorting_keys(
+            search_events( query, related, model, fuzzy ), ranked,
+            query_point( query ) if by_distance else None )
+    names = [ name.lstrip( '-' ) for name in keys ]
+    page = keyset_page( result.distinct().values( *names ), keys, cursor,
+            limit )
+    page.object_list = [ row['id'] for row in page.object_list ]
+    cache.set( key, ( page.object_list, page.next_cursor,
+        page.previous_cursor ), settings.SEARCH_RESULTS_CACHE_TIMEOUT )
+    return page
+
+def search_event_count( query, related = True, model = Event,
+        fuzzy = False ): #{{{2
+    """ returns the number of results of :func:`search_events` as a
+    :class:`grical.events.pagination.ApproximateCount`, exact only up to
+    ``settings.COUNT_THRESHOLD`` results. It is cached as
+    :func:`search_event_ids`. """
+    compiled = compile_query( query )
+    if not compiled.terms:
+        return approximate_count( model.objects.none() )
+    key = _search_results_key( compiled, model, related, bool( fuzzy ),
+            'count' )
+    count = cache.get( key )
+    if count is not None:
+        _count_search_cache( 'hits' )
+        return count
+    _count_search_cache( 'misses' )
+    count = approximate_count(
+            search_events( query, related, model, fuzzy ).distinct() )
+    cache.set( key, count, settings.SEARCH_RESULTS_CACHE_TIMEOUT )
+    return count
+
+def search_clusters( query, bbox, zoom, related = True,
+        fuzzy = False ): #{{{2
+    """ returns a list with the clusters of the events of
+    :func:`search_events` in the tiles of ``bbox`` and ``zoom`` (see
+    :func:`map_tiles`) for showing all of them on a map. Each cluster is a
+    dictionary with the number of events ``count``, their mean
+    ``longitude`` and ``latitude`` and the ``ids`` of up to
+    ``settings.MAP_CLUSTER_IDS`` of them.
+
+    Events are grouped in SQL by the cells of a grid of
+    ``settings.MAP_CLUSTER_GRID`` x ``settings.MAP_CLUSTER_GRID`` cells in
+    each tile. The clusters of each tile are cached as
+    :func:`search_event_ids`, so that moving the map only computes the
+    clusters of new tiles. """
+    compiled = compile_query( query )
+    if not compiled.terms:
+        return []
+    queryset = None
+    clusters = []
+    for tile in map_tiles( bbox, zoom ):
+        key = _search_results_key( compiled, Event, related, bool( fuzzy ),
+                'clusters', tile )
+        tile_clusters = cache.get( key )
+        if tile_clusters is not None:
+            _count_search_cache( 'hits' )
+        else:
+            _count_search_cache( 'misses' )
+            if queryset is None:
+                queryset = search_events( query, related, Event, fuzzy )
+            tile_clusters = _tile_clusters( queryset, tile )
+            cache.set( key, tile_clusters,
+                    settings.SEARCH_RESULTS_CACHE_TIMEOUT )
+        clusters.extend( tile_clusters )
+    return clusters
+
+def _tile_clusters( queryset, tile ): #{{{2
+    """ returns the clusters of the events of ``queryset`` in ``tile``, see
+    :func:`search_clusters` """
+    zoom, x, y = tile
+    size = 360.0 / 2 ** zoom
+    west, south = x * size - 180, y * size - 90
+    cell = size / settings.MAP_CLUSTER_GRID
+    box = Polygon.from_bbox( ( west, south, west + size, south + size ) )
+    try:
+        sql, params = Event.objects.filter(
+                id__in = queryset.values( 'id' ),
+                coordinates__contained = box ).values(
+                        'id' ).query.sql_with_params()
+    except EmptyResultSet:
+        return []
+    if connection.vendor == 'postgresql':
+        # ST_SnapToGrid rounds to the nearest point of the grid, its origin
+        # is the center of the first cell
+        params = [ settings.MAP_CLUSTER_IDS ] + list( params ) + [
+                west + cell / 2, south + cell / 2, cell, cell ]
+    else:
+        params = list( params ) + [ west, cell, south, cell ]
+    with connection.cursor() as cursor:
+        cursor.execute( CLUSTER_SQL[ connection.vendor ] % sql, params )
+        rows = cursor.fetchall()
+    clusters = []
+    for count, longitude, latitude, ids in rows:
+        if not isinstance( ids, list ):
+            # group_concat of SQLite
+            ids = sorted( int( pk ) for pk in ids.split( ',' ) )
+        clusters.append( { 'count': count, 'longitude': longitude,
+            'latitude': latitude, 'ids': ids[ : settings.MAP_CLUSTER_IDS ] } )
+    return clusters
+
+def _sorting_keys( queryset, ranked, point = None ): #{{{2
+    """ returns a tuple with ``queryset`` (of :func:`search_events`) and
+    the keys for sorting it: events by the distance to ``point`` if given,
+    or by ``rank`` (if *ranked* is True and there is a rank) and
+    ``upcoming``, dates by date """
+    if queryset.model == EventDate:
+        return queryset, ( 'eventdate_date', 'id' )
+    if point is not None:
+        return order_by_distance( queryset, point ), ( 'distance', 'id' )
+    queryset = add_upcoming( queryset )
+    if ranked and 'rank' in queryset.query.annotations:
+        return queryset, ( '-rank', 'upcoming', 'id' )
+    return queryset, ( 'upcoming', 'id' )
+
+def _search_results_key( compiled, model, related, *args ): #{{{2
+    """ returns the cache key of a result of the compiled query
+    ``compiled`` for *model*, *related* and other parameters ``args``, see
+    :func:`search_event_ids` """
+    counters = search_generation_keys( compiled, related )
+    return 'search_results:' + md5( repr( ( compiled.key,
+        model._meta.label_lower, bool( related ), args,
+        datetime.date.today(),
+        zip( counters, search_generations( counters ) ) ) ) ).hexdigest()
+
+def fetch_search_results( ids, model = Event ): #{{{2
+    """ returns a list with the events (or dates if *model* is EventDate)
+    with ``ids`` in the same order, fetched with one query and with
+    ``start`` and ``end`` (and ``upcoming`` for events), see
+    :func:`grical.events.models.add_start`. Ids of deleted events are
+    ignored. """
+    if model == EventDate:
+        queryset = EventDate.objects.select_related().defer(
+            'event__description', 'event__coordinates',
+            'event__creation_time', 'event__modification_time',
+            'event__address')
+    else:
+        queryset = add_upcoming( Event.objects.all() )
+    queryset = add_end( add_start( queryset ) )
+    objects = queryset.in_bulk( list( ids ) )
+    return [ objects[ pk ] for pk in ids if pk in objects ]
+
+def search_generation_keys( compiled, related = True ): #{{{2
+    """ returns the sorted names of the generation counters whose increase
+    invalidates the result of the compiled query ``compiled``.
+
+    A term with tags can only contain events with these tags, and a term
+    with names of places (``@name``) only events in these places unless
+    related events (found with the tags of all events) are added. Other
+    terms depend on all events.
+
+    >>> search_generation_keys( compile_query( u'#linux @berlin' ) ) == \\
+    ...         [ _generation_key( 'tag', u'linux' ) ]
+    True
+    >>> search_generation_keys( compile_query( u'@berlin' ) ) == \\
+    ...         [ _generation_key( 'place', u'berlin' ) ]
+    True
+    >>> search_generation_keys( compile_query( u'python @berlin' ) )
+    ['search_generation']
+    >>> search_generation_keys( compile_query( u'python @berlin' ),
+    ...         related = False ) == [ _generation_key( 'place', u'berlin' ) ]
+    True
+    """
+    keys = set()
+    for term in compiled.terms:
+        names = [ location[1] for location in term.locations
+                if location[0] == 'name' ]
+        if term.tags:
+            keys.update( [ _generation_key( 'tag', tag )
+                for tag in term.tags ] )
+        elif names and not ( related and term.words ):
+            keys.update( [ _generation_key( 'place', name )
+                for name in names ] )
+        else:
+            keys.add( SEARCH_GENERATION )
+    return sorted( keys )
+
+def search_generations( keys ): #{{{2
+    """ returns a list with the values of the generation counters
+    ``keys``, initializing missing ones """
+    values = cache.get_many( keys )
+    for key in keys:
+        if key not in values:
+            # counters start with the current time in milliseconds instead of
+            # 1 so that an evicted counter doesn't make old entries valid
+            value = int( time.time() * 1000 )
+            cache.add( key, value, None )
+            values[key] = cache.get( key, value )
+    return [ values[key] for key in keys ]
+
+def bump_search_generations( tags = (), places = () ): #{{{2
+    """ increases the global generation counter and the counters of
+    ``tags`` and ``places`` (names of cities and country codes) invalidating
+    the cached results of :func:`search_event_ids` which can change """
+    if tagging_settings.FORCE_LOWERCASE_TAGS:
+        tags = [ tag.lower() for tag in tags ]
+    keys = set( [ SEARCH_GENERATION ] )
+    keys.update( [ _generation_key( 'tag', tag ) for tag in tags ] )
+    keys.update( [ _generation_key( 'place', place.lower() )
+        for place in places ] )
+    for key in keys:
+        try:
+            cache.incr( key )
+        except ValueError:
+            # not used yet, it will be initialized when used
+            pass
+
+def _generation_key( kind, name ): #{{{2
+    """ returns the cache key of the generation counter of a tag or place
+    ``name`` (hashed, as names can contain any character) """
+    return '%s:%s:%s' % ( SEARCH_GENERATION, kind,
+            md5( name.encode( 'utf-8' ) ).hexdigest() )
+
+def search_cache_stats(): #{{{2
+    """ returns a dictionary with the number of ``hits`` and ``misses`` of
+    the cache of :func:`search_event_ids` """
+    values = cache.get_many( [ 'search_results_hits',
+        'search_results_misses' ] )
+    return {
+            'hits': values.get( 'search_results_hits', 0 ),
+            'misses': values.get( 'search_results_misses', 0 ), }
+
+def reset_search_cache_stats(): #{{{2
+    """ sets to zero the counters of :func:`search_cache_stats` """
+    cache.delete_many( [ 'search_results_hits', 'search_results_misses' ] )
 
-# better old related algorithm but too slow {{{1
-    #related_tags = sorted( used_tags, key = lambda t: t.count )
-    #related_tags.reverse()
-    # used_tags contains the count of all tags present in queryset,
-    # example:
-    # used_tags = Tag.objects.usage_for_queryset( queryset, counts=True )
-    # [<Tag: linux>, <Tag: floss>, <Tag: foss>, <Tag: free-software>, ...
-    # used_tags[0].count
-    # 69
-    #used_tags = sorted( used_tags, key = lambda t: t.count )
-    #used_tags.reverse()
-    # Now we will use related_for_model. Examples:
-    # Tag.objects.related_for_model( used_tags[0:5], Event, counts=True )
-    # [<Tag: open-source>, <Tag: freedom>, <Tag: ubuntu> ...
-    # We will use the related tags to the 5 most used tags. TODO: 5 is best?
-    # tags = list() # we save here the tags that we will use at the end
-    # we save here the ids of the events already in queryset
-    # present_ids = set( queryset.values_list( 'id', flat=True ) )
-    #for nr_of_tags in [6,5,4,3,2,1]:
-    #    related_tags = Tag.objects.related_for_model(
-    #            used_tags[ 0 : nr_of_tags ], Event, counts = True )
-    #    if len( related_tags ) == 0:
-    #        continue
-    #    related_tags = sorted( related_tags, key = lambda t: t.count )
-    #    related_tags.reverse()
-    #    # we now find events with 1 of the
-    #    # tags, which are in 'restricted' but not in 'queryset'
-    #    # TODO: try to find first events with many related_tags
-    #    for tag in related_tags:
-    #        restricted_with_tag = \
-    #                TaggedItem.objects.get_by_model( restricted, tag )
-    #        not_in_queryset = restricted_with_tag.exclude(
-    #                id__in = present_ids )
-    #        if not_in_queryset.exists():
-    #            return not_in_queryset
-    #return Event.objects.none()
+def _count_search_cache( name ): #{{{2
+    key = 'search_results_' + name
+    try:
+        cache.incr( key )
+    except ValueError:
+        cache.add( key, 1, None )
@@ -25,13 +25,14 @@
 # imports {{{1
 from celery.decorators import task
 import logging
-from smtplib import SMTPConnectError
-import traceback
+from smtplib import SMTPException
+import socket
+import time
 
-from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
-from django.core.cache import cache, caches
-from django.core.mail import send_mail, BadHeaderError
+from django.core.cache import cache
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
 from django.template.loader import render_to_string
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
@@ -45,64 +46,253 @@ logger = logging.getLogger(__name__)
 #     ...
 #     translation.activate( prev_language )
 
-@task() # save_in_caches {{{1
-def save_in_caches( key, value, timeout = None ):
-    cache_db = caches['db']
-    if timeout:
-        cache.set( key, value, timeout )
-        cache_db.set( key, value, timeout )
-    else:
-        cache.set( key, value )
-        cache_db.set( key, value )
+@task( max_retries = settings.GEO_COMPLETION_MAX_RETRIES,
+        default_retry_delay = 60 ) # complete_geo_data {{{1
+def complete_geo_data( event_id, ip = None, notify = True ):
+    """ completes the geo data of the pending event *event_id* with
+    :meth:`Event.complete_geo_data` and marks it as complete. If *notify* is
+    True, users are then notified with :func:`notify_users_when_wanted`,
+    which is not done when pending events are created because their filters
+    can need the location.
+
+    The external APIs are called without locking the event, and only the
+    fields still empty are saved afterwards, so that running the task more
+    than once or after an edit of the event changes nothing wrong. If the
+    address was changed meanwhile, a new task is queued. If the coordinates
+    cannot be found (e.g. because an API is not available) the task is
+    retried with increasing delays, up to
+    ``settings.GEO_COMPLETION_MAX_RETRIES`` times, and the event is then
+    marked as failed. Saving increases ``Event.version``. """
+    from grical.events.models import Event
+    event = Event.objects.filter( pk = event_id,
+            geo_status = Event.GEO_PENDING ).first()
+    if event is None:
+        # deleted or already completed
+        return
+    address = event.address
+    retries = complete_geo_data.request.retries
+    last_try = retries >= complete_geo_data.max_retries
+    try:
+        event.complete_geo_data( ip )
+    except IOError as err:
+        if not last_try:
+            raise complete_geo_data.retry( exc = err,
+                    countdown = 60 * 2 ** retries )
+        logger.error( u'geo data of event %d not completed - %s' % (
+            event_id, err ) )
+    missing = ( event.address or event.city or event.country ) and \
+            not event.coordinates
+    if missing and not last_try:
+        raise complete_geo_data.retry( countdown = 60 * 2 ** retries )
+    with transaction.atomic():
+        current = Event.objects.select_for_update().filter( pk = event_id,
+                geo_status = Event.GEO_PENDING ).first()
+        if current is None:
+            return
+        if current.address != address:
+            # the lookups used an old address; a new task doesn't spend the
+            # retries of this one
+            complete_geo_data.delay( event_id, ip, notify )
+            return
+        for field in Event.GEO_FIELDS:
+            if field == 'exact':
+                continue
+            if not getattr( current, field ):
+                setattr( current, field, getattr( event, field ) )
+                if field == 'coordinates':
+                    current.exact = event.exact
+        if current.country == 'WW' and event.country == 'WW':
+            current.address = event.address
+        current.geo_status = Event.GEO_FAILED if missing else \
+                Event.GEO_COMPLETE
+        current.save()
+    if notify and not current.recurring:
+        notify_users_when_wanted.delay( event = event_id )
+
+@task() # update_next_dates {{{1
+def update_next_dates():
+    """ updates the next upcoming date of events, to be run daily """
+    from grical.events.models import Event
+    Event.update_next_dates()
+
+@task() # rebuild_event_places {{{1
+def rebuild_event_places():
+    """ rebuilds the places of the events used by
+    :func:`utils.search_name`, to be run periodically """
+    from grical.events.models import EventPlace
+    EventPlace.objects.rebuild()
 
 # @task() def notify_users_when_wanted( event ): {{{1
 @task()
 def notify_users_when_wanted( event = None ):
-    """ notifies users if *event* matches a filter of a user and the
-    user wants to be notified for the matching filter """
-    from grical.events.models import Event, Filter
+    """ looks up the candidate filters for *event* (an id) and splits them
+    in shards of ``settings.NOTIFICATION_SHARD_SIZE`` filters, checked in
+    parallel by :func:`match_filters_shard`. Matches are queued and sent as
+    digests by :func:`send_notification_digests`. """
+    from grical.events.models import Event, Filter, NotificationRun
     if isinstance(event, Event):
-        pass
-    elif isinstance(event, int) or isinstance(event, long):
-        event = Event.objects.get(pk = event)
-    else:
-        event = Event.objects.get(pk = int(event))
-    # TODO: the next code iterate throw all users but this is not workable
-    # for a big number of users: implement a special data structure which
-    # saves filters and can look up fast filters matching an event
+        event = event.id
+    event = Event.objects.get(pk = int(event))
+    # only the candidates of the reverse index of filters are checked
     # TODO: show a diff of the changes
-    users = User.objects.all()
-    for user in users:
-        user_filters = Filter.objects.filter( user = user ).filter(
-                email = True)
-        for fil in user_filters:
-            if not fil.matches_event( event ):
-                continue
-            context = {
-                'username': user.username,
-                'event': event,
-                'filter': fil,
-                'site_name': Site.objects.get_current().name,
-                'site_domain': Site.objects.get_current().domain, }
-            # TODO: create the subject from a text template
-            subject = _(u'filter match: ') + event.title
-            # TODO: use a preferred language setting for users to send
-            # emails to them in this language
-            message = render_to_string( 'mail/event_notice.txt', context )
-            from_email = settings.DEFAULT_FROM_EMAIL
-            if subject and message and from_email and user.email:
-                try:
-                    if ( not settings.DEBUG ) or user.username in \
-                            settings.USERNAMES_TO_MAIL_WHEN_DEBUGGING:
-                        send_mail( subject, message, from_email,
-                            [user.email,], fail_silently = False )
-                except (BadHeaderError, SMTPConnectError), err:
-                    logger.error(u'SMTP error while trying to send '
-                            'notificationsemail - %s'%err)
-                except:
-                    logger.error(u'Unexpected error while trying to send '
-                            'notifications - %s'%traceback.format_exc())
-            else:
+    filter_ids = sorted( Filter.objects.candidates_for_event( event ).filter(
+            email = True ).values_list( 'id', flat = True ) )
+    if not filter_ids:
+        return
+    size = settings.NOTIFICATION_SHARD_SIZE
+    shards = [ filter_ids[ i : i + size ] for i in
+            range( 0, len( filter_ids ), size ) ]
+    run = NotificationRun.objects.create( event = event,
+            shards = len( shards ), pending_shards = len( shards ) )
+    for shard in shards:
+        # only ids are sent to the tasks
+        match_filters_shard.delay( run.id, event.id, shard[0], shard[-1] )
+
+@task() # match_filters_shard {{{1
+def match_filters_shard( run_id, event_id, first_filter_id, last_filter_id ):
+    """ queues notifications for users with a filter with id between
+    *first_filter_id* and *last_filter_id* matching the event *event_id* if
+    the user wants to be notified for the matching filter """
+    from grical.events.models import (Event, Filter, NotificationRun,
+            PendingNotification)
+    start = time.time()
+    # related objects are prefetched for evaluating the filters in memory
+    event = Event.objects.prefetch_related(
+            'dates', 'urls', 'sessions', 'calendar__group' ).get(
+                    pk = event_id )
+    candidates = Filter.objects.candidates_for_event( event ).filter(
+            email = True,
+            id__range = ( first_filter_id, last_filter_id ) ).only(
+                    'id', 'user', 'query' )
+    count = 0
+    matches = 0
+    for fil in candidates:
+        count += 1
+        if not fil.matches_event( event ):
+            continue
+        PendingNotification.objects.get_or_create(
+                user_id = fil.user_id, filter = fil, event = event )
+        matches += 1
+    seconds = time.time() - start
+    logger.info( u'notifications for event %d, filters %d-%d: %d candidates, '
+            '%d matches, %.3f seconds' % ( event_id, first_filter_id,
+                last_filter_id, count, matches, seconds ) )
+    run = NotificationRun( pk = run_id ).shard_done( matches, seconds )
+    if not run:
+        return
+    # this was the last shard
+    logger.info( u'notifications for event %d: %d shards, %d matches, '
+            '%s' % ( event_id, run.shards, run.matches,
+                run.completion_time - run.creation_time ) )
+    if run.matches:
+        schedule_notification_digests()
+
+def schedule_notification_digests(): # {{{1
+    """ schedules :func:`send_notification_digests` to run at the end of the
+    current window of ``settings.NOTIFICATION_DIGEST_WINDOW`` seconds unless
+    it is already scheduled """
+    window = settings.NOTIFICATION_DIGEST_WINDOW
+    if cache.add( 'notification_digests_scheduled', True, window ):
+        send_notification_digests.apply_async( countdown = window )
+
+@task() # send_notification_digests {{{1
+def send_notification_digests():
+    """ sends the pending notifications as digests, one per user, in
+    batches of ``settings.NOTIFICATION_BATCH_SIZE`` users """
+    from grical.events.models import PendingNotification
+    cache.delete( 'notification_digests_scheduled' )
+    user_ids = sorted( set( PendingNotification.objects.values_list(
+        'user_id', flat = True ) ) )
+    size = settings.NOTIFICATION_BATCH_SIZE
+    for i in range( 0, len( user_ids ), size ):
+        send_notification_batch.delay( user_ids[ i : i + size ] )
+
+@task( max_retries = settings.NOTIFICATION_BATCH_MAX_RETRIES,
+        default_retry_delay = 60 ) # send_notification_batch {{{1
+def send_notification_batch( user_ids ):
+    """ sends a digest to each user of *user_ids* using only one SMTP
+    connection; the batch is retried if sending fails.
+
+    The users are claimed with a lock in the cache, so that a batch running
+    at the same time (e.g. a retry) skips them, and the pending
+    notifications of each user are deleted as soon as the digest is sent,
+    so that a retry after a failure only sends the digests not sent. """
+    claimed = [ user_id for user_id in user_ids if cache.add(
+        _notification_lock( user_id ), True,
+        settings.NOTIFICATION_DIGEST_WINDOW ) ]
+    try:
+        _send_notification_digests( claimed )
+    except ( SMTPException, socket.error ), err:
+        logger.error( u'SMTP error while trying to send a batch of '
+                'notifications - %s' % err )
+        raise send_notification_batch.retry( exc = err )
+    finally:
+        cache.delete_many( [ _notification_lock( user_id )
+            for user_id in claimed ] )
+
+def _notification_lock( user_id ): # {{{1
+    return 'notification_digest_lock_%d' % user_id
+
+def _send_notification_digests( user_ids ): # {{{1
+    """ sends the digests of :func:`send_notification_batch` """
+    from grical.events.models import PendingNotification
+    pending = PendingNotification.objects.filter(
+            user_id__in = user_ids ).select_related(
+                    'user', 'filter', 'event' )
+    # a dictionary user -> list of ( event, list of filters )
+    digests = {}
+    # a dictionary user -> list of ids of pending notifications
+    pending_ids = {}
+    for notification in pending:
+        pending_ids.setdefault( notification.user, [] ).append(
+                notification.id )
+        matches = digests.setdefault( notification.user, [] )
+        for event, filters in matches:
+            if event == notification.event:
+                filters.append( notification.filter )
+                break
+        else:
+            matches.append( ( notification.event, [ notification.filter ] ) )
+    site = Site.objects.get_current()
+    from_email = settings.DEFAULT_FROM_EMAIL
+    connection = get_connection( fail_silently = False )
+    try:
+        for user in sorted( digests, key = lambda user: user.id ):
+            matches = digests[ user ]
+            if not user.email or not from_email:
                 # FIXME: do something meaningfull, e.g. error log
-                pass
+                message = None
+            elif settings.DEBUG and user.username not in \
+                    settings.USERNAMES_TO_MAIL_WHEN_DEBUGGING:
+                message = None
+            else:
+                message = _digest_message( user, matches, site, from_email )
+            if message:
+                # the connection is opened for the first message
+                connection.open()
+                connection.send_messages( [ message ] )
+            PendingNotification.objects.filter(
+                    id__in = pending_ids[ user ] ).delete()
+    finally:
+        connection.close()
 
+def _digest_message( user, matches, site, from_email ): # {{{1
+    """ returns the EmailMessage of a digest of :func:`send_notification_batch`
+    """
+    context = {
+        'username': user.username,
+        'matches': matches,
+        'filters': sorted( set( [ fil for event, filters in matches
+            for fil in filters ] ), key = lambda fil: fil.name ),
+        'site_name': site.name,
+        'site_domain': site.domain, }
+    # TODO: create the subject from a text template
+    if len( matches ) == 1:
+        subject = _(u'filter match: ') + matches[0][0].title
+    else:
+        subject = _(u'filter matches: %(number)d new events') % {
+                'number': len( matches ) }
+    # TODO: use a preferred language setting for users to send
+    # emails to them in this language
+    message = render_to_string( 'mail/event_digest.txt', context )
+    return EmailMessage( subject, message, from_email, [ user.email, ] )
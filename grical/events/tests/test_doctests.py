@@ -26,11 +26,14 @@ Loading of ``wikical.core`` doctests
 
 from doctest import DocTestSuite
 
-from .. import forms, models, utils
+from .. import forms, models, pagination, percolator, search, utils
 
 def load_tests(loader, tests, ignore): #{{{1
     """ Load doctests from modules containing such tests.  """
     tests.addTest(DocTestSuite(forms))
     tests.addTest(DocTestSuite(models))
+    tests.addTest(DocTestSuite(pagination))
+    tests.addTest(DocTestSuite(percolator))
+    tests.addTest(DocTestSuite(search))
     tests.addTest(DocTestSuite(utils))
     return tests
@@ -39,6 +39,7 @@ import datetime
 from datetime import timedelta
 import re
 import httplib
+from smtplib import SMTPException
 import pytz
 import urllib
 import string
@@ -49,8 +50,10 @@ from unittest import skipIf, skip
 
 from django.contrib.auth.models import User
 from django.test import TestCase # WebTest is a subclass of TestCase
+from django.test.utils import override_settings
 from django.core.urlresolvers import reverse
 from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
 from django.conf import settings
 from django.contrib.gis.geos import Point
 from registration.models import RegistrationProfile
@@ -64,8 +67,19 @@ import urllib2
 
 from grical.events import utils
 from grical.events.models import ( Event, Group, Membership, TIMEZONES,
-        Calendar, GroupInvitation, EventDate, EXAMPLE )
+        Calendar, GroupInvitation, EventDate, EXAMPLE, Filter,
+        NotificationRun, PendingNotification, GazetteerName, GazetteerPlace )
 from grical.events.search import search_events
+from grical.events.tasks import complete_geo_data
+
+class FailingEmailBackend( EmailBackend ): # {{{1
+    """ an email backend of the tests failing for the address
+    fail@example.com """
+    def send_messages( self, messages ):
+        for message in messages:
+            if 'fail@example.com' in message.to:
+                raise SMTPException( 'test failure' )
+        return super( FailingEmailBackend, self ).send_messages( messages )
 
 # there is a bug in WebTest which have been solved by TestCase but not for
 # WebTest, see
@@ -483,6 +497,59 @@ class EventsTestCase( TestCase ):           # {{{1 pylint: disable-msg=R0904
     #    # TODO: makes this work even if emails are sent in a different thread
     #    eve.delete()
 
+    @override_settings( NOTIFICATION_SHARD_SIZE = 1 )
+    def test_filter_notification_digest( self ): # {{{2
+        """ test that matching filters of a user are sent in one digest """
+        from grical.events.tasks import notify_users_when_wanted
+        user = self._create_user()
+        event = Event.objects.create( title = 'test digest notification',
+                tags = 'digest' )
+        event.startdate = datetime.date.today()
+        Filter.objects.create(
+                user = user, query = '#digest', name = "tag", email = True )
+        Filter.objects.create(
+                user = user, query = 'notification', name = "word",
+                email = True )
+        Filter.objects.create(
+                user = user, query = 'nothing', name = "nothing",
+                email = True )
+        Filter.objects.create(
+                user = user, query = 'digest', name = "no-email",
+                email = False )
+        mail.outbox = []
+        notify_users_when_wanted( event.id )
+        self.assertEqual( len( mail.outbox ), 1 )
+        self.assertEqual( mail.outbox[0].to[0], user.email )
+        self.assertTrue( 'tag' in mail.outbox[0].body )
+        self.assertTrue( 'word' in mail.outbox[0].body )
+        self.assertFalse( 'no-email' in mail.outbox[0].body )
+        self.assertFalse( PendingNotification.objects.exists() )
+        run = NotificationRun.objects.get( event = event )
+        self.assertEqual( run.shards, 3 ) # '#digest', 'notification', 'nothing'
+        self.assertEqual( run.pending_shards, 0 )
+        self.assertEqual( run.matches, 2 )
+        self.assertTrue( run.completion_time )
+
+    @override_settings( EMAIL_BACKEND =
+            'grical.events.tests.test_main.FailingEmailBackend' )
+    def test_notification_batch_failure( self ): # {{{2
+        """ test that a failed batch keeps only the notifications not sent
+        """
+        from grical.events.tasks import _send_notification_digests
+        event = Event.objects.create( title = 'test batch notification' )
+        users = [ self._create_user(), self._create_user( 'fail' ) ]
+        for user in users:
+            PendingNotification.objects.create( user = user, event = event,
+                    filter = Filter.objects.create( user = user,
+                        query = 'batch', name = "batch", email = True ) )
+        mail.outbox = []
+        self.assertRaises( SMTPException, _send_notification_digests,
+                [ user.id for user in users ] )
+        self.assertEqual( [ message.to for message in mail.outbox ],
+                [ [ users[0].email ] ] )
+        self.assertEqual( list( PendingNotification.objects.values_list(
+            'user_id', flat = True ) ), [ users[1].id ] )
+
     def test_upcomingdate( self ):
         now = datetime.datetime.now().isoformat()
         today = datetime.date.today()
@@ -645,6 +712,53 @@ class complete_geo_dataTestCase(TestCase):           # {{{1
         self.assertEquals(self.e2.timezone, 'Europe/Berlin')
         self.assertEquals(self.e3.timezone, 'Europe/Berlin')
 
+class GeoCompletionTaskTestCase(TestCase):           # {{{1
+
+    def test_pending(self):
+        event = Event(title="pending", city='Berlin', country='DE',
+                address='Berlin, Germany',
+                coordinates=Point(13.40932, 52.548972),
+                timezone='Europe/Berlin')
+        event.queue_geo_completion('')
+        event.save()
+        self.assertEquals(event.geo_status, Event.GEO_PENDING)
+        version = event.version
+        complete_geo_data.apply(args=(event.id,))
+        event = Event.objects.get(pk=event.id)
+        self.assertEquals(event.geo_status, Event.GEO_COMPLETE)
+        self.assertEquals(event.city, 'Berlin')
+        self.assertEquals(event.version, version + 1)
+        # a second run does nothing
+        complete_geo_data.apply(args=(event.id,))
+        self.assertEquals(Event.objects.get(pk=event.id).version,
+                version + 1)
+
+    @override_settings(GEONAMES_REMOTE_FALLBACK=False)
+    def test_notification_after_completion(self):
+        place = GazetteerPlace.objects.create(id=2950159, name=u'Berlin',
+                country='DE', feature_code='PPLC', population=3426354,
+                coordinates=Point(13.41053, 52.52437))
+        GazetteerName.objects.create(place=place, name=u'berlin',
+                country='DE', population=3426354)
+        user = User.objects.create_user(username='geo_notification',
+                email='geo_notification@example.com', password='p')
+        Filter.objects.create(user=user, name='berlin', query='@berlin',
+                email=True)
+        mail.outbox = []
+        event = Event(title="pending notification", address='Berlin, DE',
+                timezone='Europe/Berlin')
+        event.queue_geo_completion('')
+        event.save()
+        event.startdate = datetime.date.today()
+        # without a city the filter cannot match yet
+        self.assertFalse(NotificationRun.objects.filter(
+            event=event).exists())
+        self.assertEqual(len(mail.outbox), 0)
+        complete_geo_data.apply(args=(event.id,))
+        self.assertEquals(Event.objects.get(pk=event.id).city, u'Berlin')
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to[0], user.email)
+
 class geoapiTestCase(TestCase):           # {{{1
 
     @skipIf(settings.GEONAMES_USERNAME in ('', 'demo'),
@@ -168,6 +168,63 @@ class ModelsTestCase(TestCase):
         fil.query = 'abcdef'
         self.assertFalse(fil.matches_event(event))
 
+    def test_event_denormalized_dates(self):
+        today = datetime.date.today()
+        event = Event.objects.create(title="denormalized dates")
+        event.startdate = today - datetime.timedelta(days=2)
+        event.enddate = today + datetime.timedelta(days=2)
+        EventDate.objects.create(event=event, eventdate_name="deadline",
+                eventdate_date=today + datetime.timedelta(days=1))
+        event = Event.objects.get(pk=event.pk)
+        self.assertEqual(event.start_date, today - datetime.timedelta(days=2))
+        self.assertEqual(event.end_date, today + datetime.timedelta(days=2))
+        self.assertEqual(event.next_date, today) # the event is ongoing
+        self.assertEqual(event.upcomingdate, today)
+        event.enddate = None
+        event = Event.objects.get(pk=event.pk)
+        self.assertEqual(event.end_date, None)
+        self.assertEqual(event.next_date, today + datetime.timedelta(days=1))
+        # outdated next dates are updated
+        Event.objects.filter(pk=event.pk).update(
+                next_date=today - datetime.timedelta(days=1))
+        self.assertEqual(Event.update_next_dates(), 1)
+        event = Event.objects.get(pk=event.pk)
+        self.assertEqual(event.next_date, today + datetime.timedelta(days=1))
+
+    def test_filter_model_candidates_for_event(self):
+        now = datetime.datetime.now().isoformat()
+        today = datetime.date.today()
+        event = Event.objects.create(title="percolator conference",
+            tags = "percolator", city = "Berlin", country = "DE" )
+        EventDate.objects.create(event = event, eventdate_name = "start",
+                eventdate_date = today)
+        user = User.objects.create(username = now)
+        matching = [
+                Filter.objects.create(user=user, name='1', query='#percolator'),
+                Filter.objects.create(user=user, name='2', query='@berlin'),
+                Filter.objects.create(user=user, name='3',
+                    query='conference | #abc'),
+                Filter.objects.create(user=user, name='4', query='-#abc'),
+                Filter.objects.create(user=user, name='5',
+                    query='=%d' % event.id),
+                Filter.objects.create(user=user, name='9',
+                    query='#Percolator @Berlin'), ]
+        not_matching = [
+                Filter.objects.create(user=user, name='6', query='#abc'),
+                Filter.objects.create(user=user, name='7', query='@paris'),
+                Filter.objects.create(user=user, name='8', query='workshop'),]
+        candidates = set(Filter.objects.candidates_for_event(event))
+        for fil in matching:
+            self.assertIn(fil, candidates)
+            self.assertTrue(fil.matches_event(event))
+        for fil in not_matching:
+            self.assertNotIn(fil, candidates)
+        # the index is updated when the query changes
+        not_matching[0].query = '#percolator'
+        not_matching[0].save()
+        self.assertIn(not_matching[0],
+                Filter.objects.candidates_for_event(event))
+
 
 class GroupTestCase(TestCase):
 
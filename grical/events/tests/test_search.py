@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+""" tests for the search of events and the in-memory evaluation of queries
+"""
+
+# imports {{{1
+import datetime
+from unittest import skipUnless
+
+from django.contrib.gis.geos import MultiPolygon, Point, Polygon
+from django.db import connection
+from django.db.models import F
+from django.test import TestCase, override_settings
+
+from ..models import (Calendar, Event, EventDate, EventSession, EventUrl,
+        Group, add_start, add_end, expand_ongoing)
+from ..search import (compile_query, search_events, search_event_ids,
+        fetch_search_results, search_cache_stats, search_generation_keys,
+        search_generations, search_clusters, map_tiles,
+        ContinentLookupError)
+from ..pagination import keyset_page
+from ..utils import reset_country_polygons
+from grical.data.models import ContinentBorder
+
+class CompiledQueryConformanceTestCase(TestCase): # {{{1
+    """ checks that :func:`search.compile_query` gives the same answer as
+    :func:`search.search_events` """
+
+    @classmethod
+    def setUpTestData(cls):
+        today = datetime.date.today()
+        cls.today = today
+        cls.group = Group.objects.create(name="conformance")
+        cls.conference = Event.objects.create(title="Python conference",
+                acronym="PyCon", tags="python programming", city="Berlin",
+                country="DE", coordinates=Point(13.40932, 52.548972),
+                exact=True)
+        cls.conference.startdate = today + datetime.timedelta(days=3)
+        cls.conference.enddate = today + datetime.timedelta(days=5)
+        EventUrl.objects.create(event=cls.conference, url_name="web",
+                url="http://pycon.example.org")
+        EventSession.objects.create(event=cls.conference,
+                session_name="keynote",
+                session_date=today + datetime.timedelta(days=4),
+                session_starttime=datetime.time(10, 0),
+                session_endtime=datetime.time(11, 0))
+        cls.workshop = Event.objects.create(title="Linux workshop",
+                tags="linux", city="Paris", country="FR",
+                coordinates=Point(2.3522, 48.8566), exact=False,
+                address="Rue de Rivoli, Paris",
+                description="hands-on kernel hacking")
+        cls.workshop.startdate = today + datetime.timedelta(days=10)
+        Calendar.objects.create(group=cls.group, event=cls.workshop)
+        cls.meetup = Event.objects.create(title="Old python meetup",
+                tags="python", city="Berlin", country="DE")
+        cls.meetup.startdate = today - datetime.timedelta(days=30)
+        cls.seminar = Event.objects.create(title="Online seminar")
+        cls.seminar.startdate = today + datetime.timedelta(days=1)
+
+    def assertConforms(self, query):
+        compiled = compile_query(query)
+        for event in Event.objects.all():
+            self.assertEqual(compiled.matches(event),
+                    search_events(query, related=False).filter(
+                        pk=event.pk).exists(),
+                    u'%s for query %s' % (event.title, query))
+
+    def test_words(self):
+        for query in ('python', 'conference', 'PYTHON', 'berlin', 'de', 'fr',
+                'pycon', 'python berlin', 'programming', 'xyz', 'kernel'):
+            self.assertConforms(query)
+
+    def test_broad(self):
+        for query in ('* python', '* kernel', '* keynote', '* web keynote',
+                '* rivoli', '* pycon.example', '* start', '* start web'):
+            self.assertConforms(query)
+
+    def test_strict_words(self):
+        for query in ('+conference', 'python +pycon', '+programming',
+                '* +kernel'):
+            self.assertConforms(query)
+
+    def test_tags(self):
+        for query in ('#python', '#python #programming', '#linux',
+                '#python #nonexistent', '#nonexistent', '#Python',
+                '#python berlin'):
+            self.assertConforms(query)
+
+    def test_exclusions(self):
+        for query in ('-#linux', '-python', '-@', '-#', '-@berlin',
+                'python -conference', '* -#python'):
+            self.assertConforms(query)
+
+    def test_locations(self):
+        for query in ('@berlin', '@Berlin', '@paris', '@de', '@berlin ',
+                '@52.5,13.4+50km', '@52.5,13.4+5km', '@48.8,2.3+10mi',
+                '@48.8,2.3+1000km', '@10,20,55,50', '@0,5,50,45'):
+            self.assertConforms(query)
+
+    def test_by_distance(self):
+        for query in ('@48.8,2.3+2000km', '@52.5,13.4+2000km'):
+            self.assertConforms(query)
+        self.assertEqual(search_event_ids('@48.8,2.3+2000km', related=False,
+            by_distance=True), [self.workshop.id, self.conference.id])
+        self.assertEqual(search_event_ids('@52.5,13.4+2000km', related=False,
+            by_distance=True), [self.conference.id, self.workshop.id])
+
+    def test_clusters(self):
+        world = (-180, -90, 180, 90)
+        self.assertEqual(search_clusters('python', world, 0, related=False),
+                [{'count': 1, 'longitude': 13.40932, 'latitude': 52.548972,
+                    'ids': [self.conference.id]}])
+        self.assertEqual(search_clusters('linux', (-10, 40, 20, 60), 3,
+            related=False)[0]['ids'], [self.workshop.id])
+        self.assertEqual(search_clusters('linux', (100, -40, 120, -20), 3,
+            related=False), [])
+        self.assertTrue(len(map_tiles(world, 18)) <= 16)
+
+    def test_groups_and_events(self):
+        for query in ('!conformance', '!CONFORMANCE', '!nogroup',
+                '=%d' % self.meetup.id, '=%d python' % self.meetup.id,
+                '=%d' % self.conference.id):
+            self.assertConforms(query)
+
+    def test_dates(self):
+        in_three_days = self.today + datetime.timedelta(days=3)
+        month_ago = self.today - datetime.timedelta(days=31)
+        for query in (
+                in_three_days.isoformat(),
+                self.today.isoformat(),
+                month_ago.isoformat() + ' ' + self.today.isoformat(),
+                '* python',
+                'python ' + month_ago.isoformat() + ' ' +
+                    self.today.isoformat()):
+            self.assertConforms(query)
+        self.assertRaises(ValueError, compile_query, '2011-04-31')
+        self.assertRaises(ValueError, search_events, '2011-04-31')
+
+    def test_date_spans(self):
+        in_four_days = self.today + datetime.timedelta(days=4)
+        # the days between start and end are not stored
+        self.assertFalse(EventDate.objects.filter(
+            eventdate_name='ongoing').exists())
+        query = in_four_days.isoformat()
+        self.assertConforms(query)
+        self.assertTrue(compile_query(query).matches(self.conference))
+        # but they are expanded when rendering
+        self.assertFalse(search_events(query, related=False,
+            model=EventDate).exists())
+        expanded = expand_ongoing([], search_events(query, related=False),
+                in_four_days, in_four_days)
+        self.assertEqual([(eventdate.event, eventdate.eventdate_date)
+            for eventdate in expanded], [(self.conference, in_four_days)])
+        eventdates = add_end(add_start(EventDate.objects.filter(
+            event=self.conference)))
+        expanded = expand_ongoing(eventdates, Event.objects.all())
+        self.assertEqual([(eventdate.eventdate_name, eventdate.eventdate_date)
+            for eventdate in expanded], [
+                ('start', self.today + datetime.timedelta(days=3)),
+                ('ongoing', in_four_days),
+                ('end', self.today + datetime.timedelta(days=5))])
+
+    def test_or(self):
+        for query in ('python | linux', 'xyz | #linux', '#linux | =%d' %
+                self.meetup.id, 'seminar | @paris'):
+            self.assertConforms(query)
+
+    def test_or_union(self):
+        # each term is a part of a UNION instead of an OR of all joins
+        query = '#python | seminar'
+        self.assertIn('UNION', str(search_events(query).query))
+        self.assertEqual(
+            sorted(search_events(query, model=EventDate).values_list(
+                'event_id', flat=True).distinct()),
+            sorted(search_events(query).values_list('id', flat=True)))
+        # terms without results are left out
+        self.assertNotIn('UNION',
+                str(search_events('#nonexistent | #python').query))
+
+    def test_normalized_queries(self):
+        query = '#python Berlin | =%d' % self.meetup.id
+        equivalent = '=%d | berlin  #python' % self.meetup.id
+        self.assertIs(compile_query(query), compile_query(equivalent))
+        self.assertEqual(
+            set(search_events(query).values_list('id', flat=True)),
+            set(search_events(equivalent).values_list('id', flat=True)))
+        self.assertConforms(equivalent)
+        compiled = compile_query(query)
+        self.assertRaises(AttributeError, setattr, compiled, 'terms', ())
+        self.assertRaises(AttributeError, setattr, compiled.terms[0],
+                'words', frozenset())
+
+    def test_empty(self):
+        self.assertFalse(compile_query('').matches(self.conference))
+        self.assertFalse(compile_query(None).matches(self.conference))
+
+    def test_continent(self):
+        # borders are not loaded when running tests
+        self.assertRaises(ContinentLookupError, compile_query, '@@EU')
+        self.assertRaises(ContinentLookupError, search_events, '@@EU')
+        ContinentBorder.objects.create(code='EU',
+                mpoly=MultiPolygon(Polygon.from_bbox((-10, 35, 30, 70))))
+        reset_country_polygons()
+        try:
+            # the continent of the coordinates is stored
+            sprint = Event.objects.create(title="Python sprint",
+                    coordinates=Point(12.5, 41.9))
+            self.assertEqual(sprint.continent, 'EU')
+            elsewhere = Event.objects.create(title="Python sprint",
+                coordinates=Point(-74.0, 40.7))
+            self.assertEqual(elsewhere.continent, None)
+            result = search_events('* @@eu python', related=False)
+            self.assertIn(sprint, result)
+            self.assertNotIn(elsewhere, result)
+            for query in ('@@EU', '@@eu python', '@@EU -@berlin'):
+                self.assertConforms(query)
+        finally:
+            reset_country_polygons()
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'search-results-test'}})
+class SearchResultCacheTestCase(TestCase): # {{{1
+    """ checks the cache of the ids of search results """
+
+    def test_hits_and_invalidation(self):
+        today = datetime.date.today()
+        first = Event.objects.create(title="Linux day", tags="linux",
+                city="Berlin", country="DE")
+        first.startdate = today + datetime.timedelta(days=2)
+        stats = search_cache_stats()
+        self.assertEqual(search_event_ids('#linux'), [first.id])
+        self.assertEqual(search_event_ids('#linux'), [first.id])
+        self.assertEqual(search_cache_stats()['hits'], stats['hits'] + 1)
+        self.assertEqual(search_cache_stats()['misses'],
+                stats['misses'] + 1)
+        # events with other tags don't invalidate the entry
+        keys = search_generation_keys(compile_query('#linux'))
+        generations = search_generations(keys)
+        other = Event.objects.create(title="Python day", tags="python")
+        other.startdate = today + datetime.timedelta(days=1)
+        self.assertEqual(search_generations(keys), generations)
+        # a new event with the tag does
+        second = Event.objects.create(title="Kernel day", tags="linux")
+        second.startdate = today + datetime.timedelta(days=1)
+        self.assertEqual(search_event_ids('#linux'), [second.id, first.id])
+        # and also removing the tag
+        first.tags = "python"
+        first.save()
+        self.assertEqual(search_event_ids('#linux'), [second.id])
+        events = fetch_search_results([second.id, first.id])
+        self.assertEqual([event.id for event in events],
+                [second.id, first.id])
+        self.assertEqual(events[1].start, first.startdate)
+
+class KeysetPageTestCase(TestCase): # {{{1
+    """ checks the keyset pagination of search results """
+
+    def pages(self, queryset, keys):
+        """ returns the ids of the rows of the pages of one row going
+        forward to the last page and then backward to the first one """
+        forward, backward = [], []
+        page = keyset_page(queryset, keys, limit = 1)
+        forward.extend(row['id'] for row in page.object_list)
+        while page.has_next():
+            page = keyset_page(queryset, keys, page.next_cursor, limit = 1)
+            forward.extend(row['id'] for row in page.object_list)
+        while page.has_previous():
+            page = keyset_page(queryset, keys, page.previous_cursor,
+                    limit = 1)
+            backward.extend(row['id'] for row in page.object_list)
+        backward.reverse()
+        return forward, backward
+
+    def test_null_keys(self):
+        today = datetime.date.today()
+        ids = []
+        for days in (2, 1, None, 1, None):
+            event = Event.objects.create(title="Keyset", tags="keyset")
+            event.startdate = today + datetime.timedelta(days=days or 0)
+            if days is None:
+                Event.objects.filter(id=event.id).update(next_date=None)
+            ids.append(event.id)
+        queryset = Event.objects.filter(id__in=ids).annotate(
+                upcoming=F('next_date')).values('upcoming', 'id')
+        # rows without a next date are last in both directions
+        forward, backward = self.pages(queryset, ('upcoming', 'id'))
+        expected = [ids[1], ids[3], ids[0], ids[2], ids[4]]
+        self.assertEqual(forward, expected)
+        self.assertEqual(backward, expected[:-1])
+        forward, backward = self.pages(queryset, ('-upcoming', 'id'))
+        expected = [ids[0], ids[1], ids[3], ids[2], ids[4]]
+        self.assertEqual(forward, expected)
+        self.assertEqual(backward, expected[:-1])
+
+@skipUnless(connection.vendor == 'postgresql',
+        'full-text search needs PostgreSQL')
+class FullTextSearchTestCase(TestCase): # {{{1
+    """ checks the full-text search document of events """
+
+    def test_stemming_weights_and_rank(self):
+        today = datetime.date.today()
+        talk = Event.objects.create(title="Kernel talk")
+        talk.startdate = today
+        workshop = Event.objects.create(title="Workshop",
+                description="about the kernels")
+        workshop.startdate = today
+        ids = lambda query: set(search_events(query, related=False
+            ).values_list('id', flat=True))
+        self.assertEqual(ids('kernels'), set([talk.id]))
+        self.assertEqual(ids('* kernel'), set([talk.id, workshop.id]))
+        self.assertEqual([event.id for event in search_events('* kernel',
+            related=False).order_by('-rank')], [talk.id, workshop.id])
+        # related objects update the document
+        self.assertEqual(ids('* tracing'), set())
+        EventSession.objects.create(event=workshop, session_name="tracing",
+                session_date=today, session_starttime=datetime.time(10, 0),
+                session_endtime=datetime.time(11, 0))
+        self.assertEqual(ids('* tracing'), set([workshop.id]))
+
+    def test_partial_and_fuzzy_words(self):
+        event = Event.objects.create(title="Workshop", city="Washington D.C.")
+        event.startdate = datetime.date.today()
+        ids = lambda query, fuzzy=False: set(search_events(query,
+            related=False, fuzzy=fuzzy).values_list('id', flat=True))
+        self.assertEqual(ids('washington'), set([event.id]))
+        self.assertEqual(ids('wash'), set([event.id]))
+        self.assertEqual(ids('worksh'), set([event.id]))
+        self.assertEqual(ids('workshp'), set())
+        self.assertEqual(ids('workshp', fuzzy=True), set([event.id]))
+
+    def test_conformance(self):
+        today = datetime.date.today()
+        conference = Event.objects.create(title="Kernel conference",
+                city="Washington D.C.", description="about the kernels")
+        conference.startdate = today
+        seminar = Event.objects.create(title="Seminar", tags="tracing")
+        seminar.startdate = today
+        for query in ('conferences', 'conference', 'kernels', '* kernel',
+                'wash', 'kern conferences', 'tracing', '#tracing seminars',
+                'seminar +semi', 'xyz', 'conferense', 'semniar kernel'):
+            compiled = compile_query(query)
+            for event in (conference, seminar):
+                for fuzzy in (False, True):
+                    self.assertEqual(compiled.matches(event, fuzzy),
+                            search_events(query, related=False,
+                                fuzzy=fuzzy).filter(pk=event.pk).exists(),
+                            u'%s for query %s' % (event.title, query))
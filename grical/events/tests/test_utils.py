@@ -20,15 +20,31 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with GriCal. If not, see <http://www.gnu.org/licenses/>.
 #############################################################################
+import io
 import math
+import os
+import shutil
+import tempfile
+import threading
 import time
 from unittest import skipIf
 
 from django.conf import settings
-from django.test import TestCase
+from django.contrib.gis.geos import MultiPolygon, Point, Polygon
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.test import TestCase, override_settings
 
 from ..utils import (search_address, search_coordinates, search_address_google,
-        search_address_osm)
+        search_address_osm, search_name, search_timezone,
+        reset_timezone_polygons, search_country, search_countries,
+        reverse_geocode, reset_country_polygons, TieredCache, GEO_CACHE,
+        search_country_code, reset_country_names, COUNTRY_NAMES)
+from ..geocoder import (fetch, set_provider, FakeProvider, RateLimiter,
+        GeocoderError, GeocoderUnavailable)
+from ..models import (Event, EventPlace, GazetteerName, GazetteerPlace,
+        TimezoneBoundary)
+from grical.data.models import CountryBorder
 
 class UtilsTestCase(TestCase):
 
@@ -72,3 +88,276 @@ class UtilsTestCase(TestCase):
         self.assertEqual(math.floor( float(result['latitude']) ), 52.0)
         self.assertEqual(result['country'], 'DE')
 
+CITIES = u"""2643743\tLondon\tLondon\tLondres,Londra\t51.50853\t-0.12574\tP\tPPLC\tGB\t\t\t\t\t\t7556900\t\t25\tEurope/London\t2017-01-01
+6058560\tLondon\tLondon\t\t42.98339\t-81.23304\tP\tPPL\tCA\t\t\t\t\t\t346765\t\t252\tAmerica/Toronto\t2017-01-01
+2867714\tMunich\tMunich\tM\u00fcnchen,Muenchen\t48.13743\t11.57549\tP\tPPLA\tDE\t\t\t\t\t\t1260391\t\t524\tEurope/Berlin\t2017-01-01
+2950159\tBerlin\tBerlin\t\t52.52437\t13.41053\tP\tPPLC\tDE\t\t\t\t\t\t3426354\t\t74\tEurope/Berlin\t2017-01-01
+"""
+COUNTRIES = u"""#ISO\tISO3\tISO-Numeric\tfips\tCountry\tCapital\tArea\tPopulation\tContinent\ttld\tCurrencyCode\tCurrencyName\tPhone\tPostal\tRegex\tLanguages\tgeonameid\tneighbours\tEquivalentFipsCode
+DE\tDEU\t276\tGM\tGermany\tBerlin\t357021\t81802257\tEU\t.de\tEUR\tEuro\t49\t#####\t\tde\t2921044\tCH,PL\t
+"""
+ALTERNATE_NAMES = u"""1\t2921044\tde\tDeutschland\t1\t\t\t
+2\t2921044\tlink\thttps://en.wikipedia.org/wiki/Germany\t\t\t\t
+"""
+
+@override_settings(GEONAMES_REMOTE_FALLBACK = False)
+class GazetteerTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        paths = []
+        for name, content in (('cities.txt', CITIES),
+                ('countryInfo.txt', COUNTRIES),
+                ('alternateNames.txt', ALTERNATE_NAMES)):
+            paths.append(os.path.join(self.directory, name))
+            with io.open(paths[-1], 'w', encoding = 'utf-8') as dump:
+                dump.write(content)
+        call_command('loadgeonames', paths[0], countries = paths[1],
+                alternate_names = paths[2], stdout = io.BytesIO())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_search_name(self):
+        result = search_name(u'london,ca')
+        self.assertAlmostEquals(result['coordinates'].x, -81.23304, places=5)
+        self.assertEqual(result['city'], u'London')
+        self.assertEqual(search_name(u'London')['country'], u'GB')
+        self.assertEqual(search_name(u'Londres, GB')['country'], u'GB')
+        result = search_name(u'M\u00fcnchen, Deutschland')
+        self.assertEqual(result['city'], u'Munich')
+        self.assertEqual(result['country'], u'DE')
+        result = search_name(u'Germany')
+        self.assertEqual(result['city'], None)
+        self.assertAlmostEquals(result['coordinates'].x, 13.41053, places=5)
+        self.assertEqual(search_name(u'london, DE'), None)
+        self.assertEqual(search_name(u'https://en.wikipedia.org/wiki/Germany'),
+                None)
+
+@override_settings(GEONAMES_REMOTE_FALLBACK = False)
+class TimezoneBoundaryTestCase(TestCase):
+
+    def setUp(self):
+        for name, x in (('Europe/Berlin', 0), ('Europe/Paris', 10)):
+            polygon = MultiPolygon(Polygon.from_bbox((x, 0, x + 10, 10)))
+            TimezoneBoundary.objects.create(name = name, polygon = polygon,
+                    simplified = polygon)
+        reset_timezone_polygons()
+
+    def tearDown(self):
+        reset_timezone_polygons()
+
+    def test_search_timezone(self):
+        self.assertEqual(search_timezone(5, 5), 'Europe/Berlin')
+        self.assertEqual(search_timezone(5, 15), 'Europe/Paris')
+        # near the boundary the database is queried
+        self.assertEqual(search_timezone(5, 9.999), 'Europe/Berlin')
+        self.assertEqual(search_timezone(50, 50), None)
+
+class ReverseGeocoderTestCase(TestCase):
+
+    def setUp(self):
+        # the borders of the data migration are not loaded when testing
+        for code, box in (('DE', (6, 47, 15, 55)), ('PL', (15, 49, 24, 55)),
+                ('US', (-125, 25, -67, 49))):
+            CountryBorder.objects.create(code = code,
+                    mpoly = MultiPolygon(Polygon.from_bbox(box)))
+        reset_country_polygons()
+
+    def tearDown(self):
+        reset_country_polygons()
+
+    def test_search_country(self):
+        self.assertEqual(search_country(51.2, 10.3), 'DE')
+        # near a border the database is queried
+        self.assertEqual(search_countries(
+            [(41.2, -103.0), (52.0, 15.001), (0.0, -30.0)]),
+            ['US', 'PL', None])
+        # cached
+        self.assertEqual(search_country(41.2, -103.0), 'US')
+
+    def test_reverse_geocode(self):
+        GazetteerPlace.objects.create(id = 2950159, name = u'Berlin',
+                country = 'DE', feature_code = 'PPLC', population = 3426354,
+                coordinates = Point(13.41053, 52.52437))
+        result = reverse_geocode(52.5, 13.4, city = True)
+        self.assertEqual(result, {'country': 'DE', 'city': u'Berlin'})
+        self.assertEqual(reverse_geocode(48.1, 11.6, city = True),
+                {'country': 'DE', 'city': None})
+
+REVERSE = u"""{"display_name": "Kopenhagener Str., Berlin, 10437",
+"address": {"city": "Berlin", "country_code": "de"}}"""
+
+# the rate limiter and the circuit breaker need a cache shared by processes
+@override_settings(GEOCODER_FAILURES = 2, CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'geocoder-test'},
+    'db': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'geocoder-db-test'}})
+class GeocoderTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        caches['db'].clear()
+        GEO_CACHE.local.clear()
+        self.provider = FakeProvider('nominatim', {'reverse': REVERSE})
+        set_provider('nominatim', self.provider)
+
+    def tearDown(self):
+        set_provider('nominatim', None)
+        cache.clear()
+
+    def test_fake_provider(self):
+        result = search_coordinates(52.548972, 13.40932)
+        self.assertEqual(result['city'], u'Berlin')
+        self.assertEqual(result['country'], u'DE')
+        self.assertTrue('lat=52.548972' in self.provider.requests[0])
+
+    def test_circuit_breaker(self):
+        for i in range(2):
+            self.assertRaises(GeocoderError, fetch, 'nominatim', 'search')
+        self.assertEqual(len(self.provider.requests), 2)
+        # the circuit is open, the provider is not called
+        self.assertRaises(GeocoderUnavailable, fetch, 'nominatim', 'reverse')
+        self.assertEqual(search_coordinates(52.548972, 13.40932), None)
+        self.assertEqual(len(self.provider.requests), 2)
+        # the failure was not cached
+        cache.clear()
+        self.assertEqual(search_coordinates(52.548972, 13.40932)['city'],
+                u'Berlin')
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter('test', 2, 0)
+        limiter.acquire()
+        limiter.acquire()
+        start = time.time()
+        try:
+            limiter.acquire()
+        except GeocoderUnavailable:
+            # the tokens of the second are taken
+            self.assertTrue(time.time() - start < 1)
+
+@override_settings(CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'tiered-default-test'},
+    'db': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'tiered-db-test'}})
+class TieredCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.tiered = TieredCache('test', 10, 60, 60)
+        self.tiered.reset_stats()
+        self.calls = []
+
+    def compute(self, value):
+        self.calls.append(value)
+        return value
+
+    def test_lookup(self):
+        self.assertEqual(self.tiered.lookup('a', lambda: self.compute(1)), 1)
+        self.assertEqual(self.tiered.lookup('a', lambda: self.compute(2)), 1)
+        # negative entries
+        self.assertEqual(self.tiered.lookup('b',
+            lambda: self.compute(None)), None)
+        self.assertEqual(self.tiered.lookup('b', lambda: self.compute(3)),
+                None)
+        self.assertEqual(self.calls, [1, None])
+        self.assertEqual(self.tiered.stats()['misses'], 2)
+
+    def test_errors_not_cached(self):
+        def fail():
+            raise GeocoderUnavailable('test')
+        self.assertRaises(GeocoderUnavailable, self.tiered.lookup, 'a', fail)
+        self.assertEqual(self.tiered.lookup('a', lambda: self.compute(1)), 1)
+
+    def test_lock_released_without_value(self):
+        tiered = TieredCache('test', 10, 60, 60, lock_timeout=10)
+        lock_key = tiered._key('a') + ':lock'
+        cache.add(lock_key, True, 10)
+        # another process fails and releases the lock
+        threading.Timer(0.2, cache.delete, [lock_key]).start()
+        start = time.time()
+        self.assertEqual(tiered.lookup('a', lambda: self.compute(1)), 1)
+        self.assertTrue(time.time() - start < 5)
+
+    def test_promotion(self):
+        self.tiered.set('a', 1)
+        self.tiered.local.clear()
+        caches['default'].clear()
+        self.assertEqual(self.tiered.get_many(['a', 'b']), {'a': 1})
+        self.assertEqual(self.tiered.stats()['db'], 1)
+        # copied to the faster tiers
+        self.assertEqual(self.tiered.get_many(['a']), {'a': 1})
+        self.tiered.local.clear()
+        self.assertEqual(self.tiered.get_many(['a']), {'a': 1})
+        self.assertEqual(self.tiered.stats()['default'], 1)
+
+@override_settings(GEONAMES_REMOTE_FALLBACK = False)
+class CountryIndexTestCase(TestCase):
+
+    def setUp(self):
+        reset_country_names()
+
+    def tearDown(self):
+        reset_country_names()
+
+    def test_search_country_code(self):
+        self.assertEqual(search_country_code(u'Germany'), 'DE')
+        self.assertEqual(search_country_code(u'  united  states. '), 'US')
+        self.assertEqual(search_country_code(u'de'), 'DE')
+        self.assertEqual(search_country_code(u'Atlantis'), None)
+        place = GazetteerPlace.objects.create(id = 2921044,
+                name = u'Germany', country = 'DE',
+                feature_code = GazetteerPlace.COUNTRY)
+        GazetteerName.objects.create(place = place, name = u'deutschland',
+                country = 'DE')
+        reset_country_names()
+        self.assertEqual(search_country_code(u'Deutschland'), 'DE')
+        self.assertEqual(COUNTRY_NAMES.name('de'), u'Germany')
+
+class EventPlaceTestCase(TestCase):
+
+    def create_event(self, title, city, country, longitude, latitude):
+        return Event.objects.create(title=title, city=city, country=country,
+                coordinates=Point(longitude, latitude), timezone='UTC')
+
+    @override_settings(GEONAMES_REMOTE_FALLBACK=False)
+    def test_rebuild(self):
+        self.assertEqual(search_name(u'Lindau, DE'), None)
+        self.create_event(u'one', u'Lindau', 'DE', 9.68, 47.54)
+        self.create_event(u'two', u'lindau ', 'DE', 9.70, 47.56)
+        self.create_event(u'three', u'Lindau', 'DE', 9.69, 47.55)
+        event = self.create_event(u'wrong', u'Lindau', 'DE', 100.0, 0.0)
+        self.assertEqual(EventPlace.objects.rebuild(), (1, 0, 0))
+        result = search_name(u'LINDAU, Germany')
+        self.assertEqual(result['city'], u'Lindau')
+        self.assertEqual(result['country'], 'DE')
+        # the median ignores the wrong coordinates
+        self.assertAlmostEqual(result['coordinates'].x, 9.695)
+        self.assertAlmostEqual(result['coordinates'].y, 47.545)
+        self.assertEqual(search_name(u'Lindau, FR'), None)
+        self.assertEqual(EventPlace.objects.rebuild(), (0, 0, 0))
+        event.delete()
+        self.assertEqual(EventPlace.objects.rebuild(), (0, 1, 0))
+        self.assertEqual(EventPlace.objects.get().events, 3)
+        Event.objects.all().delete()
+        self.assertEqual(EventPlace.objects.rebuild(), (0, 0, 1))
+
+    @override_settings(GEONAMES_REMOTE_FALLBACK=False)
+    def test_minimum_events(self):
+        place = GazetteerPlace.objects.create(id=2878695, name=u'Lindau',
+                country='DE', feature_code='PPL', population=24513,
+                coordinates=Point(9.68451, 47.54612))
+        GazetteerName.objects.create(place=place, name=u'lindau',
+                country='DE', population=24513)
+        # one event with wrong coordinates doesn't override the gazetteer
+        self.create_event(u'wrong', u'Lindau', 'DE', 100.0, 0.0)
+        with self.settings(EVENT_PLACE_MIN_EVENTS=2):
+            self.assertEqual(EventPlace.objects.rebuild(), (1, 0, 0))
+            self.assertAlmostEqual(
+                search_name(u'Lindau, DE')['coordinates'].x, 9.68451)
+            # with enough events the place is used
+            self.create_event(u'right', u'Lindau', 'DE', 9.68, 47.54)
+            EventPlace.objects.rebuild()
+            self.assertAlmostEqual(
+                search_name(u'Lindau, DE')['coordinates'].x, 54.84)
@@ -21,6 +21,8 @@
 # along with GriCal. If not, see <http://www.gnu.org/licenses/>.
 #############################################################################
 import datetime
+import json
+import re
 
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
@@ -109,6 +111,52 @@ class ViewsTestCase(TestCase):
         self.assertContains(response,
             'There are no events for this search currently')
 
+    def test_search_cursor(self):
+        today = datetime.date.today()
+        for title in ('c1_test', 'c2_test', 'c3_test'):
+            event = Event.objects.create(title = title, tags = 'cursortest')
+            event.startdate = today
+        response = self.client.get(reverse('search'),
+                {'query': '#cursortest', 'view': 'json', 'limit': 2})
+        self.assertEqual(len(json.loads(response.content)), 2)
+        links = dict((rel, url) for url, rel in
+                re.findall(r'<([^>]*)>; rel="(\w+)"', response['Link']))
+        self.assertEqual(links.keys(), ['next'])
+        response = self.client.get(links['next'])
+        self.assertEqual([row['title'] for row in
+            json.loads(response.content)], ['c3_test'])
+        self.assertEqual(re.findall(r'rel="(\w+)"', response['Link']),
+                ['prev'])
+        # html views show no count of pages
+        response = self.client.get(reverse('search'),
+                {'query': '#cursortest', 'limit': 1})
+        self.assertTrue(response.context['page'].has_next())
+        self.assertContains(response, '3 entries found')
+        # the links to other pages keep the parameters of the search and
+        # the last page reached with a cursor counts all events
+        response = self.client.get(reverse('search'),
+                {'query': '#cursortest', 'limit': 2, 'fuzzy': '1'})
+        self.assertContains(response, 'limit=2')
+        self.assertContains(response, 'fuzzy=1')
+        response = self.client.get(reverse('search'),
+                {'query': '#cursortest', 'limit': 2,
+                    'cursor': response.context['page'].next_cursor})
+        self.assertFalse(response.context['page'].has_next())
+        self.assertContains(response, '3 entries found')
+        # above the threshold the count is capped
+        with self.settings(COUNT_THRESHOLD = 2):
+            response = self.client.get(reverse('search'),
+                    {'query': '#cursortest', 'limit': 1, 'view': 'table'})
+        self.assertContains(response, '2+ entries found')
+        # an invalid cursor shows the first page
+        response = self.client.get(reverse('search'),
+                {'query': '#cursortest', 'cursor': 'invalid'})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.context['page'].has_previous())
+        self.assertEqual(len(response.context['page']), 3)
+        self.assertIn('not valid', ' '.join(
+            unicode(message) for message in response.context['messages']))
+
     def test_filter_save(self):
         self.client.login(username = self.user.username, password = 'p')
         response = self.client.get(reverse('filter_save'),
@@ -24,35 +24,39 @@
 """ utilities """
 
 # imports {{{1
+from collections import OrderedDict
 from difflib import HtmlDiff, unified_diff
 import datetime
+from functools import wraps
+from hashlib import md5
 from dateutil import parser
 from dateutil.relativedelta import relativedelta
-import httplib
 import json
+import math
 import re
 import time
-import urllib
-import urllib2
+import unicodedata
 from xml.etree.ElementTree import fromstring
 from xml.parsers.expat import ExpatError
 
 from django.core.cache import cache, caches
 from django.core.mail import mail_admins
-from django.contrib.gis.geos import Point
+from django.contrib.gis.geos import MultiPoint, Point, Polygon
+from django.contrib.gis.measure import D
 from django.contrib.gis.geoip2 import GeoIP2
 from django.core.exceptions import ValidationError
-from django.utils.encoding import smart_unicode
+from django.utils import translation
+from django.utils.encoding import smart_str, smart_unicode
 from django.utils.translation import ugettext as _
 from django.conf import settings
 
-#from grical.events.tasks import save_in_caches
+from grical.events.geocoder import fetch, GeocoderError, GeocoderUnavailable
 
-# TODO: avoid transgression of OpenStreetMap and Google terms of use. E.g.
-# OpenStreetMap doesn't want more than one query per second
-# Google Geocoding API is subject to a query limit of 2,500 geolocation
-# requests per day. (Users of Google Maps API Premier may perform up to 100,000
-# requests per day.)
+# NOTE: the requests per second to OpenStreetMap, Google and GeoNames are
+# limited by grical.events.geocoder, see settings.GEOCODER_RATES. Google
+# Geocoding API is subject to a query limit of 2,500 geolocation requests per
+# day. (Users of Google Maps API Premier may perform up to 100,000 requests
+# per day.)
 
 # TODO: count and avoid transgressions of the geonames terms of use, which
 # seems to be 2000 credits hourly
@@ -78,6 +82,24 @@ def exact_as_bool_str(value):
             '%(comma_separated_list)s') %
             {'comma_separated_list': ', '.join(true_values + false_values)})
 
+def geo_cached( name ): # {{{1
+    """ decorator of geo functions caching their results in
+    :data:`GEO_CACHE` keyed by ``name`` and the arguments. Functions raise a
+    ``GeocoderError`` for temporary failures, which are not cached and
+    return None. """
+    def decorator( function ):
+        @wraps( function )
+        def cached( *args ):
+            key = u'%s:%s' % ( name, u'|'.join( [ unicode( arg )
+                for arg in args ] ) )
+            try:
+                return GEO_CACHE.lookup( key, lambda: function( *args ) )
+            except GeocoderError:
+                return None
+        return cached
+    return decorator
+
+@geo_cached( 'search_coordinates' )
 def search_coordinates( lat, lon ): # {{{1
     # doc {{{2
     """ returns a dictionary with the keys 'address', 'city' and 'country'
@@ -139,25 +161,17 @@ def search_coordinates( lat, lon ): # {{{1
     try:
         lat = float( lat )
         lon = float( lon )
-        conn = httplib.HTTPConnection( "nominatim.openstreetmap.org",
-                timeout=10 )
-        params = '&format=json' + \
-                 '&zoom=18' + \
-                 '&addressdetails=1' + \
-                 '&email=' + settings.ADMINS[0][1] + \
-                 '&lat=' + str(lat) + \
-                 '&lon=' + str(lon)
-        url_sufix = "/reverse?" + params
-        conn.request( "GET", url_sufix )
-        conn.sock.settimeout( 10.0 )
-        response = conn.getresponse()
-        response_text = response.read()
+        response_text = fetch( 'nominatim', 'reverse', (
+            ( 'format', 'json' ),
+            ( 'zoom', 18 ),
+            ( 'addressdetails', 1 ),
+            ( 'email', settings.ADMINS[0][1] ),
+            ( 'lat', lat ),
+            ( 'lon', lon ) ) )
         dic = json.loads( response_text )
         # TODO: use other APIs like
         # http://www.geonames.org/export/reverse-geocoding.html
         # when the response is not satisfactory
-        # TODO: Take care that not more than one query per second is sent to
-        # OSM because of the terms of use (maybe using celery)
         to_return = dict()
         to_return['address'] = dic.get('display_name', None)
         if dic.has_key('address'):
@@ -176,6 +190,8 @@ def search_coordinates( lat, lon ): # {{{1
             to_return['city'] = None
             to_return['country'] = None
         return to_return
+    except GeocoderError:
+        raise
     except:
         return None
 
@@ -202,18 +218,11 @@ def search_address( data, ip = None ): # {{{1
         geoip = GeoIP2()
         # we try adding the country (from the IP) if not already given
         last_item = data[data.rfind(',')+1:].strip().upper()
-        # TODO GEO: include translations, GeoNames.org
-        from grical.events.models import COUNTRIES
-        country_codes = [ val[0].upper() for val in COUNTRIES ]
-        country_names = [ val[1].upper() for val in COUNTRIES ]
         country_code = None
-        if ( last_item not in country_codes ) and \
-                ( last_item not in country_names ):
+        if COUNTRY_NAMES.code( last_item ) is None:
             country_code = geoip.country(ip)['country_code']
             if country_code:
                 data_extended = data + u", " + country_code
-                # OpenStreetMap doesn't want more than one query per second
-                time.sleep(1)
                 result_osm = search_address_osm( data_extended )
                 if result_osm and len( result_osm ) == 1:
                     return result_osm
@@ -236,7 +245,6 @@ def search_address( data, ip = None ): # {{{1
                 if result_google and len( result_google ) == 1:
                     return result_google
                 # we try again with OSM
-                time.sleep(1)
                 result_osm = search_address_osm( data_extended )
                 if result_osm and len( result_osm ) == 1:
                     return result_osm
@@ -251,9 +259,93 @@ def search_address( data, ip = None ): # {{{1
         return result_google
     return None
 
+def normalize_name( name ): #{{{1
+    """ returns ``name`` in lower case without accents, punctuation and
+    repeated spaces, for comparing names of places
+
+    >>> normalize_name( u'  C\\xf4te d\\u2019Ivoire ' )
+    u'cote d ivoire'
+    """
+    name = unicodedata.normalize( 'NFKD', unicode( name ) )
+    name = u''.join( [ char for char in name
+        if not unicodedata.combining( char ) ] )
+    return u' '.join( re.findall( r'[^\W_]+', name.lower(), re.UNICODE ) )
+
+class CountryIndex( object ): # {{{1
+    """ dictionaries of the countries of
+    :data:`grical.events.models.COUNTRIES`: codes to names, and normalized
+    names (see :func:`normalize_name`) to codes. The names are the ones of
+    ``COUNTRIES`` in English and translated to the languages of
+    ``settings.LANGUAGES``, and the names of the countries of the gazetteer,
+    which include the alternate names of the GeoNames dump (see the command
+    ``loadgeonames``). They are read once per process. """
+    def __init__( self ):
+        self._names = None
+        self._codes = None
+
+    def names( self ): # {{{2
+        """ returns the dictionary of normalized names to codes """
+        if self._names is None:
+            from grical.events.models import (COUNTRIES, GazetteerName,
+                    GazetteerPlace)
+            names = {}
+            languages = [ 'en' ] + [ language for language, language_name
+                    in settings.LANGUAGES if language != 'en' ]
+            for language in languages:
+                with translation.override( language ):
+                    for code, name in COUNTRIES:
+                        names.setdefault( normalize_name( name ), code )
+            codes = self.codes()
+            for name, code in GazetteerName.objects.filter(
+                    place__feature_code = GazetteerPlace.COUNTRY
+                    ).values_list( 'name', 'country' ).iterator():
+                if code in codes:
+                    names.setdefault( normalize_name( name ), code )
+            names.pop( u'', None )
+            self._names = names
+        return self._names
+
+    def codes( self ): # {{{2
+        """ returns the dictionary of codes to (translatable) names """
+        if self._codes is None:
+            from grical.events.models import COUNTRIES
+            self._codes = dict( COUNTRIES )
+        return self._codes
+
+    def code( self, name ): # {{{2
+        """ returns the code of the country with the code or the name
+        ``name`` in any language, or None """
+        if not name:
+            return None
+        name = unicode( name ).strip()
+        if len( name ) == 2 and name.upper() in self.codes():
+            return name.upper()
+        return self.names().get( normalize_name( name ), None )
+
+    def name( self, code ): # {{{2
+        """ returns the name of the country ``code`` or None """
+        if not code:
+            return None
+        return self.codes().get( unicode( code ).upper(), None )
+
+    def reset( self ): # {{{2
+        """ empties the dictionaries, to be called when the gazetteer
+        changes """
+        self._names = None
+        self._codes = None
+
+COUNTRY_NAMES = CountryIndex()
+""" the codes and names of countries, see :func:`search_country_code` """
+
+def reset_country_names(): # {{{1
+    """ empties the names of countries in memory, to be called when the
+    gazetteer changes """
+    COUNTRY_NAMES.reset()
+
 def search_country_code( name ): #{{{1
     """ returns the country code uppercase of a country code or of a country
-    name accepting different languages
+    name accepting different languages, see :class:`CountryIndex`. Unknown
+    names are looked up with :func:`search_name`.
     """
     # next line needed because len(django_countries.fields.Country) produces an
     # error, and `name` can be of that type
@@ -262,17 +354,15 @@ def search_country_code( name ): #{{{1
     name = unicode( name )
     if len( name ) == 2:
         return name.upper()
-    from grical.events.models import COUNTRIES
-    for code_country in COUNTRIES:
-        if code_country[1].lower == name.lower():
-            return code_country[0]
-    # TODO GEO: before using an external API check for translations already
-    # done for the package django_countries
+    code = COUNTRY_NAMES.code( name )
+    if code:
+        return code
     result = search_name( name )
     if result:
         return result['country']
     return None
 
+@geo_cached( 'search_address_google' )
 def search_address_google(data): # {{{1
     """ loop up using The Google Geocoding API
 
@@ -357,14 +447,9 @@ def search_address_google(data): # {{{1
         </GeocodeResponse>
     """
     try:
-        address = urllib.quote( data.encode('utf-8') )
-        conn = httplib.HTTPConnection( "maps.googleapis.com", timeout=10 )
-        url_sufix = "//maps/api/geocode/xml?address=" + address + \
-                    "&sensor=false"
-        conn.request( "GET", url_sufix )
-        conn.sock.settimeout( 10.0 )
-        response = conn.getresponse()
-        response_text = response.read()
+        response_text = fetch( 'google', 'maps/api/geocode/xml', (
+            ( 'address', data ),
+            ( 'sensor', 'false' ) ) )
         doc = fromstring( response_text )
         # a dictionary with a display_name as unicode keys and values as
         # dictionaries of field names and values
@@ -398,82 +483,444 @@ def search_address_google(data): # {{{1
                 result[ data ] = pdic
         if len( result ) > 0:
             return result
+    except GeocoderError:
+        raise
     except:
         pass
     return None
 
 def search_timezone( lat, lng, use_cache = True ): # {{{1
-    """ it uses the geonames API returning the name of the timezone (according
-    to olson).
+    """ it returns the name of the timezone (according to olson) of the
+    polygons of timezones (see :func:`search_timezone_boundaries`) or, if
+    not found and ``settings.GEONAMES_REMOTE_FALLBACK`` is True, of the
+    geonames API.
 
     See http://www.geonames.org/export/web-services.html
     """
+    from grical.events.models import TIMEZONE_NAMES
+    timezone = search_timezone_boundaries( lat, lng )
+    if timezone in TIMEZONE_NAMES:
+        return timezone
+    if not settings.GEONAMES_REMOTE_FALLBACK:
+        return None
+    try:
+        if not use_cache:
+            return _geonames_timezone( lat, lng )
+        return GEO_CACHE.lookup( u'search_timezone:%s,%s' % ( lat, lng ),
+                lambda: _geonames_timezone( lat, lng ) )
+    except GeocoderError:
+        # temporary failures are not cached
+        return None
+
+def _geonames_timezone( lat, lng ): # {{{1
+    """ returns the name of the timezone of the geonames API or None, see
+    :func:`search_timezone`. It raises a ``GeocoderError`` if the API is not
+    available. """
+    from grical.events.models import TIMEZONE_NAMES
     # TODO: add settings options to use the primium server ws.geonames.net and
     # token (auth setting in geonames.org)
-    if use_cache:
-        cache_value = None
-        cache_key =  'search_timezone__' + str(lat) + "_" + str(lng)
-        db_cache = caches['db']
-        # we try the memcached cache (see settings.CACHES)
-        if cache.has_key( cache_key ):
-            cache_value = cache.get( cache_key )
-        # we try the db cache
-        elif db_cache.has_key( cache_key ):
-            cache_value = db_cache.get( cache_key )
-        if cache_value:
-            # we want to be sure that it is saved in all caches
-            #save_in_caches.delay( cache_key, cache_value )
-            return cache_value
-    url = settings.GEONAMES_URL + 'timezone?lat=%s&lng=%s&username=%s' % \
-            ( str(lat), str(lng), settings.GEONAMES_USERNAME )
     try:
         # FIXME: check for API limit reached
-        response = urllib2.urlopen( url, timeout = 10 )
-        if not response:
-            if use_cache:
-                pass
-                #save_in_caches.delay( cache_key, None, timeout = 300 )
-            return None
-        response_text = response.read()
+        response_text = fetch( 'geonames', 'timezone', (
+            ( 'lat', str(lat) ),
+            ( 'lng', str(lng) ),
+            ( 'username', settings.GEONAMES_USERNAME ) ) )
         doc = fromstring( response_text ) # can raise a ExpatError
         timezone = doc.findall( 'timezone' )[0]
         timezoneId = timezone.find('timezoneId').text
-    except (urllib2.HTTPError, urllib2.URLError, ExpatError,
-            IndexError, AttributeError):
+    except (ExpatError, IndexError, AttributeError):
         # TODO: log the err
-        if use_cache:
-            pass
-            #save_in_caches.delay( cache_key, None, timeout = 300 )
-        return None
-    if not timezoneId:
-        if use_cache:
-            pass
-            #save_in_caches.delay( cache_key, None, timeout = 300 )
         return None
-    from grical.events.models import TIMEZONES
-    found = False
-    for group in TIMEZONES:
-        for tup in group[1]:
-            if tup[0] == timezoneId:
-                found = True
-                break
-    if not found:
+    if timezoneId not in TIMEZONE_NAMES:
         # TODO: log the error
-        if use_cache:
-            pass
-            #save_in_caches.delay( cache_key, None, timeout = 300 )
         return None
-    if use_cache:
-        # we save it fast in memcached before saving it slowly in all caches
-        cache.set( cache_key, timezoneId )
-        #save_in_caches.delay( cache_key, timezoneId )
-        # TODO: test that we recognize the timezoneId and log if not
     return timezoneId
 
+class LRUCache( object ): # {{{1
+    """ a dictionary in memory with at most ``size`` entries, dropping the
+    least recently used one when full
+
+    >>> lru = LRUCache( 2 )
+    >>> lru.set( 'a', 1 ); lru.set( 'b', 2 ); lru.get( 'a' )
+    1
+    >>> lru.set( 'c', 3 ); lru.get( 'b', 'dropped' ), lru.get( 'a' )
+    ('dropped', 1)
+    """
+    def __init__( self, size ):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get( self, key, default = None ):
+        try:
+            value = self.entries.pop( key )
+        except KeyError:
+            return default
+        self.entries[ key ] = value
+        return value
+
+    def set( self, key, value ):
+        self.entries.pop( key, None )
+        if len( self.entries ) >= self.size:
+            self.entries.popitem( last = False )
+        self.entries[ key ] = value
+
+    def clear( self ):
+        self.entries.clear()
+
+class TieredCache( object ): # {{{1
+    """ a read-through cache with three tiers: a :class:`LRUCache` of
+    ``size`` entries in the process, the ``default`` cache (memcached) and
+    the ``db`` cache. Values found in a slower tier are copied to the faster
+    ones.
+
+    :meth:`lookup` computes and saves missing values in all tiers, with
+    only one process computing the same value at a time. None results are
+    saved as negative entries for ``negative_timeout`` seconds, the rest for
+    ``timeout`` seconds. Exceptions (e.g. of temporary failures) are raised
+    and nothing is saved. Hits of each tier and misses are counted, see
+    :meth:`stats`. """
+    NEGATIVE = 'tiered_cache_negative'
+    TIERS = ( 'default', 'db' )
+
+    def __init__( self, name, size, timeout, negative_timeout,
+            lock_timeout = 30 ):
+        self.name = name
+        self.local = LRUCache( size )
+        self.timeout = timeout
+        self.negative_timeout = negative_timeout
+        self.lock_timeout = lock_timeout
+        self.local_hits = 0
+
+    def _key( self, key ): # {{{2
+        # memcached keys have at most 250 characters without spaces
+        return 'tiered_cache:%s:%s' % ( self.name,
+                md5( smart_str( key ) ).hexdigest() )
+
+    def _timeout( self, value ): # {{{2
+        if value is None or value == self.NEGATIVE:
+            return self.negative_timeout
+        return self.timeout
+
+    def get_many( self, keys ): # {{{2
+        """ returns a dictionary with the values of the ``keys`` found in
+        any tier, None for negative entries """
+        now = time.time()
+        found = {}
+        missing = {}
+        for key in keys:
+            entry = self.local.get( self._key( key ) )
+            if entry is not None and entry[1] > now:
+                found[ key ] = entry[0]
+            else:
+                missing[ self._key( key ) ] = key
+        self._count_local( len( found ) )
+        faster = []
+        for tier in self.TIERS:
+            if not missing:
+                break
+            values = caches[ tier ].get_many( missing.keys() )
+            self._count( tier, len( values ) )
+            for cache_key, value in values.items():
+                key = missing.pop( cache_key )
+                timeout = self._timeout( value )
+                for faster_tier in faster:
+                    caches[ faster_tier ].set( cache_key, value, timeout )
+                if value == self.NEGATIVE:
+                    value = None
+                self.local.set( cache_key, ( value, now + timeout ) )
+                found[ key ] = value
+            faster.append( tier )
+        self._count( 'misses', len( missing ) )
+        return found
+
+    def set( self, key, value ): # {{{2
+        """ saves ``value`` (None as a negative entry) in all tiers """
+        timeout = self._timeout( value )
+        cache_key = self._key( key )
+        self.local.set( cache_key, ( value, time.time() + timeout ) )
+        if value is None:
+            value = self.NEGATIVE
+        for tier in self.TIERS:
+            caches[ tier ].set( cache_key, value, timeout )
+
+    def lookup( self, key, function ): # {{{2
+        """ returns the value of ``key``, computing it with ``function()``
+        if not found. Other processes looking up the same missing key wait
+        up to ``lock_timeout`` seconds for the value instead of computing it
+        too, and compute it themselves if the lock is released without a
+        value (e.g. because ``function`` raised an exception). """
+        found = self.get_many( [ key ] )
+        if key in found:
+            return found[ key ]
+        cache_key = self._key( key )
+        lock_key = cache_key + ':lock'
+        locked = cache.add( lock_key, True, self.lock_timeout )
+        if not locked:
+            deadline = time.time() + self.lock_timeout
+            while time.time() < deadline:
+                time.sleep( 0.1 )
+                values = cache.get_many( [ cache_key, lock_key ] )
+                value = values.get( cache_key )
+                if value is not None:
+                    return None if value == self.NEGATIVE else value
+                if lock_key not in values:
+                    # the other process failed
+                    break
+        try:
+            value = function()
+            self.set( key, value )
+        finally:
+            if locked:
+                cache.delete( lock_key )
+        return value
+
+    def stats( self ): # {{{2
+        """ returns a dictionary with the hits of each tier (``local``,
+        ``default`` and ``db``) and the ``misses`` of all processes. Local
+        hits are added up in batches of 100. """
+        names = ( 'local', ) + self.TIERS + ( 'misses', )
+        keys = [ self._stats_key( name ) for name in names ]
+        values = cache.get_many( keys )
+        return dict( [ ( name, values.get( key, 0 ) ) for name, key in
+            zip( names, keys ) ] )
+
+    def reset_stats( self ): # {{{2
+        """ sets to zero the counters of :meth:`stats` """
+        self.local_hits = 0
+        cache.delete_many( [ self._stats_key( name ) for name in
+            ( 'local', ) + self.TIERS + ( 'misses', ) ] )
+
+    def _stats_key( self, name ): # {{{2
+        return 'tiered_cache_stats:%s:%s' % ( self.name, name )
+
+    def _count_local( self, number ): # {{{2
+        # counting each hit in the shared cache would be slower than the hit
+        self.local_hits += number
+        if self.local_hits >= 100:
+            self._count( 'local', self.local_hits )
+            self.local_hits = 0
+
+    def _count( self, name, number ): # {{{2
+        if not number:
+            return
+        key = self._stats_key( name )
+        try:
+            cache.incr( key, number )
+        except ValueError:
+            cache.add( key, number, None )
+
+GEO_CACHE = TieredCache( 'geo', settings.GEO_CACHE_SIZE,
+        settings.GEO_CACHE_TIMEOUT, settings.GEO_CACHE_NEGATIVE_TIMEOUT )
+""" cache of the results of the external geo APIs, see :func:`geo_cached` """
+
+class PolygonIndex( object ): # {{{1
+    """ finds the name of the polygon of a model containing a point.
+
+    The polygons, simplified with the tolerance of the setting
+    ``tolerance_setting``, are read once per process and checked in memory
+    after comparing their extents. Simplified boundaries deviate at most the
+    tolerance from the real ones, so that the result is only exact if the
+    point is farther from them. Otherwise the real polygons are queried using
+    the spatial index of the database.
+
+    ``model`` is a string ``app_label.ModelName``. If ``simplified_field``
+    is None, polygons are simplified when read. """
+    def __init__( self, model, name_field, polygon_field, tolerance_setting,
+            simplified_field = None ):
+        self.model = model
+        self.name_field = name_field
+        self.polygon_field = polygon_field
+        self.tolerance_setting = tolerance_setting
+        self.simplified_field = simplified_field
+        self._polygons = None
+
+    def get_model( self ): # {{{2
+        from django.apps import apps
+        return apps.get_model( self.model )
+
+    def simplified_polygons( self ): # {{{2
+        """ returns a list of tuples with the name and the simplified polygon
+        of the rows of the model """
+        if self.simplified_field:
+            return self.get_model().objects.values_list(
+                    self.name_field, self.simplified_field )
+        tolerance = getattr( settings, self.tolerance_setting )
+        return [ ( name, polygon.simplify( tolerance,
+            preserve_topology = True ) ) for name, polygon in
+            self.get_model().objects.values_list(
+                self.name_field, self.polygon_field ) ]
+
+    def polygons( self ): # {{{2
+        """ returns a list of tuples with the name, the extent, the prepared
+        geometry and the boundary of the simplified polygons """
+        if self._polygons is None:
+            self._polygons = [ ( name, polygon.extent, polygon.prepared,
+                polygon.boundary ) for name, polygon in
+                self.simplified_polygons() if not polygon.empty ]
+        return self._polygons
+
+    def reset( self ): # {{{2
+        """ empties the polygons in memory, to be called when the polygons
+        change """
+        self._polygons = None
+
+    def search( self, point ): # {{{2
+        """ returns the name of the polygon containing ``point`` or None """
+        return self.search_many( [ point ] )[0]
+
+    def search_many( self, points ): # {{{2
+        """ returns a list with the name of the polygon containing each point
+        of ``points`` (or None), querying the database at most once """
+        tolerance = getattr( settings, self.tolerance_setting )
+        polygons = self.polygons()
+        names = []
+        doubtful = []
+        for index, point in enumerate( points ):
+            found = [ ( name, boundary ) for name, extent, prepared, boundary
+                    in polygons if extent[0] <= point.x <= extent[2] and
+                    extent[1] <= point.y <= extent[3] and
+                    prepared.contains( point ) ]
+            if len( found ) == 1 and \
+                    found[0][1].distance( point ) > tolerance:
+                names.append( found[0][0] )
+            else:
+                names.append( None )
+                doubtful.append( index )
+        if not doubtful:
+            return names
+        candidates = self.get_model().objects.filter( **{
+            self.polygon_field + '__intersects': MultiPoint(
+                [ points[ index ] for index in doubtful ], srid = 4326 ) }
+            ).values_list( self.name_field, self.polygon_field )
+        candidates = [ ( name, polygon.prepared )
+                for name, polygon in candidates ]
+        for index in doubtful:
+            for name, prepared in candidates:
+                if prepared.contains( points[ index ] ):
+                    names[ index ] = name
+                    break
+        return names
+
+TIMEZONE_POLYGONS = PolygonIndex( 'events.TimezoneBoundary', 'name',
+        'polygon', 'TIMEZONE_SIMPLIFY_TOLERANCE', 'simplified' )
+""" the polygons of timezones, see :func:`search_timezone_boundaries` """
+
+class BorderIndex( PolygonIndex ): # {{{1
+    """ a :class:`PolygonIndex` of the borders of countries or continents
+    (``kind`` being ``country`` or ``continent``) which reads the borders
+    simplified in advance of :class:`grical.data.models.SimplifiedBorder`
+    when there are for the tolerance """
+    def __init__( self, kind, model, tolerance_setting ):
+        super( BorderIndex, self ).__init__( model, 'code', 'mpoly',
+                tolerance_setting )
+        self.kind = kind
+
+    def simplified_polygons( self ): # {{{2
+        from grical.data.models import SimplifiedBorder
+        borders = list( SimplifiedBorder.objects.filter( kind = self.kind,
+            tolerance = getattr( settings, self.tolerance_setting )
+            ).values_list( 'code', 'mpoly' ) )
+        return borders or super( BorderIndex, self ).simplified_polygons()
+
+COUNTRY_POLYGONS = BorderIndex( 'country', 'data.CountryBorder',
+        'COUNTRY_SIMPLIFY_TOLERANCE' )
+""" the borders of countries, see :func:`search_country` """
+
+CONTINENT_POLYGONS = BorderIndex( 'continent', 'data.ContinentBorder',
+        'CONTINENT_SIMPLIFY_TOLERANCE' )
+""" the borders of continents, see :func:`search_continent` """
+
+def reset_timezone_polygons(): # {{{1
+    """ empties the polygons of timezones in memory, to be called when they
+    change """
+    TIMEZONE_POLYGONS.reset()
+
+def search_timezone_boundaries( lat, lng ): # {{{1
+    """ returns the name of the timezone whose polygon contains the point,
+    or None, see :class:`PolygonIndex` """
+    return TIMEZONE_POLYGONS.search( Point( float( lng ), float( lat ) ) )
+
+_countries_lru = LRUCache( settings.REVERSE_GEOCODER_CACHE_SIZE )
+""" cache of :func:`search_countries` """
+
+def reset_country_polygons(): # {{{1
+    """ empties the borders of countries and continents and the results of
+    :func:`search_countries` in memory, to be called when the borders change
+    """
+    COUNTRY_POLYGONS.reset()
+    CONTINENT_POLYGONS.reset()
+    _countries_lru.clear()
+
+def search_continent( lat, lng ): # {{{1
+    """ returns the code of the continent whose border contains the point,
+    or None, see :class:`PolygonIndex`. For countries in more than one
+    continent only one of them is returned. """
+    return CONTINENT_POLYGONS.search( Point( float( lng ), float( lat ) ) )
+
+def search_country( lat, lng ): # {{{1
+    """ returns the code of the country whose border contains the point, or
+    None, without network access. See :func:`search_countries`. """
+    return search_countries( [ ( lat, lng ) ] )[0]
+
+def search_countries( coordinates ): # {{{1
+    """ returns a list with the code of the country (or None) of each tuple
+    latitude, longitude of ``coordinates`` using the borders of
+    :class:`grical.data.models.CountryBorder` (see :class:`PolygonIndex`),
+    querying the database at most once. Results are cached in memory by
+    coordinates rounded to ``settings.REVERSE_GEOCODER_PRECISION`` decimals.
+    """
+    precision = settings.REVERSE_GEOCODER_PRECISION
+    keys = [ ( round( float( lat ), precision ),
+        round( float( lng ), precision ) ) for lat, lng in coordinates ]
+    codes = [ _countries_lru.get( key, False ) for key in keys ]
+    missing = [ index for index, code in enumerate( codes )
+            if code is False ]
+    if missing:
+        found = COUNTRY_POLYGONS.search_many( [ Point( keys[ index ][1],
+            keys[ index ][0] ) for index in missing ] )
+        for index, code in zip( missing, found ):
+            codes[ index ] = code
+            _countries_lru.set( keys[ index ], code )
+    return codes
+
+def reverse_geocode( lat, lng, city = False ): # {{{1
+    """ returns a dictionary with the ``country`` (see
+    :func:`search_country`) of the point and, if ``city`` is True, the
+    ``city`` of the gazetteer (see :func:`search_gazetteer`) in the country
+    nearest to the point within ``settings.CITY_RADIUS``, or None if the point
+    is in no country """
+    country = search_country( lat, lng )
+    if not country:
+        return None
+    result = { 'country': country, 'city': None }
+    if city:
+        from grical.events.models import GazetteerPlace
+        point = Point( float( lng ), float( lat ), srid = 4326 )
+        # an approximate box with the radius in degrees of latitude, which is
+        # widened for longitudes
+        radius = D( **{ settings.DISTANCE_UNIT_DEFAULT:
+            settings.CITY_RADIUS } ).km / 111.0
+        width = radius / max( math.cos( math.radians( point.y ) ), 0.01 )
+        box = Polygon.from_bbox( ( point.x - width, point.y - radius,
+            point.x + width, point.y + radius ) )
+        places = GazetteerPlace.objects.filter( country = country,
+                coordinates__contained = box ).exclude(
+                        feature_code = GazetteerPlace.COUNTRY ).only(
+                                'name', 'coordinates' )
+        places = sorted( places,
+                key = lambda place: place.coordinates.distance( point ) )
+        if places:
+            result['city'] = places[0].name
+    return result
+
 # TODO cache API searches and download the data of geonames to use when running
 # out of allowed queries
 def search_name( name, use_cache = True ): # {{{1
-    """ it uses the geonames API returning a dictionary with:
+    """ it looks up ``name`` in the places of the events (see
+    :func:`search_event_place`), then in the local gazetteer (see
+    :func:`search_gazetteer`) and, if not found and
+    ``settings.GEONAMES_REMOTE_FALLBACK`` is True, with the geonames API
+    returning a dictionary with:
 
     - 'coordinates': a ``Point`` with the most relevant location given e.g.
       ``London,GB``
@@ -526,33 +973,28 @@ def search_name( name, use_cache = True ): # {{{1
           </geoname>
         </geonames>
     """
-    query = urllib.quote( name.encode('utf-8'), safe=',' )
-    if use_cache:
-        cache_value = None
-        cache_key =  'search_name__' +  query
-        db_cache = caches['db']
-        # we try the memcached cache (see settings.CACHES)
-        # there is however a limit of 250 chars for the memcached key
-        if len(cache_key) <= 250 and cache.has_key(cache_key):
-            cache_value = cache.get(cache_key)
-        if not cache_value and db_cache.has_key( cache_key ):
-            # we try the db cache
-            cache_value = db_cache.get( cache_key )
-        if cache_value:
-            # we want to be sure that it is saved in all caches
-            #save_in_caches.delay( cache_key, cache_value )
-            return cache_value
-    url = settings.GEONAMES_URL + 'search?q=%s&maxRows=1&username=%s' % \
-            ( query, settings.GEONAMES_USERNAME )
+    result = search_event_place( name ) or search_gazetteer( name )
+    if result or not settings.GEONAMES_REMOTE_FALLBACK:
+        return result
+    try:
+        if not use_cache:
+            return _geonames_search( name )
+        return GEO_CACHE.lookup( u'search_name:' + name,
+                lambda: _geonames_search( name ) )
+    except GeocoderError:
+        # temporary failures are not cached
+        return None
+
+def _geonames_search( name ): # {{{1
+    """ returns the dictionary of :func:`search_name` of the most relevant
+    location of the geonames API or None. It raises a ``GeocoderError`` if
+    the API is not available. """
     try:
         response_text = None
-        response = urllib2.urlopen( url, timeout = 10 )
-        if not response:
-            if use_cache:
-                #save_in_caches.delay( cache_key, None, timeout = 300 )
-                pass
-            return None
-        response_text = response.read()
+        response_text = fetch( 'geonames', 'search', (
+            ( 'q', name ),
+            ( 'maxRows', 1 ),
+            ( 'username', settings.GEONAMES_USERNAME ) ) )
         doc = fromstring( response_text ) # can raise a ExpatError
         geonames = doc.findall( 'geoname' )
         # if no geoname, genonames is None and when trying to get geonames[0] a
@@ -563,11 +1005,14 @@ def search_name( name, use_cache = True ): # {{{1
         lng = float( geonames[0].find('lng').text )
         city = geonames[0].find('name').text
         country = geonames[0].find('countryCode').text
-    except ( urllib2.HTTPError, urllib2.URLError, ExpatError,
-            IndexError, AttributeError ) as err:
-        if use_cache:
-            pass
-            #save_in_caches.delay( cache_key, None, timeout = 300 )
+    except GeocoderError as err:
+        if not isinstance( err, GeocoderUnavailable ):
+            mail_admins(
+                'error in search_name',
+                'time: %s\nsearch query: %s\nerror: %s' % \
+                    ( str(datetime.datetime.now()), name, unicode(err) ) )
+        raise
+    except ( ExpatError, IndexError, AttributeError ) as err:
         if response_text and 'the daily limit of' in response_text:
             mail_admins(
                 'URGENT: geonames limit reached',
@@ -580,16 +1025,46 @@ def search_name( name, use_cache = True ): # {{{1
                     ( str(datetime.datetime.now()), name, str(err) ) )
         return None
     coordinates = Point( lng, lat )
-    to_return = dict( (
+    return dict( (
         ('coordinates', coordinates),
         ('city', city),
         ('country', country) ) )
-    if use_cache:
-        # we save it fast in memcached before saving it slowly in all caches
-        cache.set( cache_key, to_return )
-        #save_in_caches.delay( cache_key, to_return )
-    return to_return
 
+def search_event_place( name ): # {{{1
+    """ looks up ``name`` (a city, or a city, a comma and a country code or
+    name) in the places of the events built with the command
+    ``rebuildplaces``, returning the dictionary of :func:`search_name` or
+    None """
+    from grical.events.models import EventPlace
+    parts = [ part.strip() for part in unicode( name ).split( ',' ) ]
+    if not parts[0]:
+        return None
+    if len( parts ) == 1:
+        place = EventPlace.objects.search( parts[0] )
+    else:
+        place = EventPlace.objects.search( parts[-2], parts[-1] )
+    if not place:
+        return None
+    return place.as_search_name()
+
+def search_gazetteer( name ): # {{{1
+    """ looks up ``name`` (a city, a country, or a city, a comma and a
+    country code or name) in the places of the GeoNames dump loaded with the
+    command ``loadgeonames``, returning the dictionary of
+    :func:`search_name` or None """
+    from grical.events.models import GazetteerPlace
+    parts = [ part.strip() for part in unicode( name ).split( ',' ) ]
+    if not parts[0]:
+        return None
+    if len( parts ) == 1:
+        place = GazetteerPlace.objects.search( parts[0] )
+    else:
+        place = GazetteerPlace.objects.search( parts[-2], parts[-1] )
+    if not place:
+        return None
+    return place.as_search_name()
+
+@geo_cached( 'search_address_osm' )
 def search_address_osm( data ): # {{{1
     """ uses nominatim.openstreetmap.org to look up for ``data``.
 
@@ -641,21 +1116,15 @@ def search_address_osm( data ): # {{{1
     # TODO: better use the json format (instead of xml) and the json library:
     # import json ; data = json.loads( response_text )
     try:
-        address = urllib.quote( data.encode('utf-8') )
-        params = '&format=xml' \
-            '&polygon=0' \
-            '&addressdetails=1' \
-            '&email=' + settings.ADMINS[0][1] + \
-            '&limit=10'
-        conn = httplib.HTTPConnection( "nominatim.openstreetmap.org",
-                timeout=10 )
         # see http://wiki.openstreetmap.org/wiki/Nominatim
         # TODO: include parameter accept-language according to user/browser
-        url_sufix = "/search?q=" + address + params
-        conn.request( "GET", url_sufix )
-        conn.sock.settimeout( 10.0 )
-        response = conn.getresponse()
-        response_text = response.read()
+        response_text = fetch( 'nominatim', 'search', (
+            ( 'q', data ),
+            ( 'format', 'xml' ),
+            ( 'polygon', 0 ),
+            ( 'addressdetails', 1 ),
+            ( 'email', settings.ADMINS[0][1] ),
+            ( 'limit', 10 ) ) )
         doc = fromstring( response_text ) # can throw a ExpatError
         # a dictionary with a display_name as unicode keys and values as
         # dictionaries of field names and values
@@ -684,6 +1153,8 @@ def search_address_osm( data ): # {{{1
                 result[ data ] = pdic
         if len( result ) > 0:
             return result
+    except GeocoderError:
+        raise
     except:
         pass
     return None
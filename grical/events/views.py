@@ -53,7 +53,6 @@ from django.contrib.sites.models import Site
 from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
-from django.db.models.query import QuerySet
 from django.db import transaction, IntegrityError
 # from django.core.exceptions import ValidationError
 from django.forms import ValidationError
@@ -63,6 +62,7 @@ from django.shortcuts import ( render, get_object_or_404,
         get_list_or_404 )
 from django.template import loader
 from django.utils.encoding import smart_unicode
+from django.utils.functional import SimpleLazyObject
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext as _
 from django.views.decorators.cache import cache_page
@@ -78,11 +78,15 @@ from grical.events.forms import (
 from grical.events.models import (
     Event, EventUrl, EventSession, EventDate, Filter, Group, Recurrence,
     Membership, GroupInvitation, Calendar, RevisionInfo,
-    add_start, add_end, add_upcoming )
+    add_start, add_end, add_upcoming, expand_ongoing )
 from grical.events.utils import html_diff
 from grical.events.tables import EventTable
 from grical.events.feeds import SearchEventsFeed
-from grical.events.search import search_events, GeoLookupError
+from grical.events.pagination import (CursorPage, InvalidCursorError,
+        keyset_page, ApproximatePaginator)
+from grical.events.search import (search_events, query_dates_window,
+        search_event_ids, search_event_page, search_event_count,
+        fetch_search_results, search_clusters, GeoLookupError)
 
 # TODO: check if this works with i18n
 views = [_('boxes'), _('map'),_('table'),_('calendars'),]
@@ -1054,6 +1058,27 @@ def event_undelete(request, event_id):
             'equal': equal,}
     return render(request, 'event_undelete_error.html', templates)
 
+def search_clusters_json( request, query, related = True,
+        fuzzy = False ): # {{{1
+    """ returns a json list with the clusters of the events found by
+    ``query`` inside the box of the GET value ``bbox``
+    (``west,south,east,north`` in degrees, default the whole world) for the
+    GET value ``zoom`` of the map (default 0), see
+    :func:`grical.events.search.search_clusters`. A malformed query or box
+    gets the status 400. """
+    try:
+        bbox = [ float( value ) for value in
+                request.GET.get( 'bbox', '-180,-90,180,90' ).split( ',' ) ]
+        if len( bbox ) != 4:
+            raise ValueError( _( u"bbox must have four numbers" ) )
+        zoom = int( request.GET.get( 'zoom', 0 ) )
+        clusters = search_clusters( query or '', bbox, zoom, related, fuzzy )
+    except ( ValueError, GeoLookupError ) as err:
+        return HttpResponse( status = 400, content_type = "application/json",
+                content = json.dumps( { 'error': unicode( err ) } ) )
+    return HttpResponse( content_type = "application/json",
+            content = json.dumps( clusters ) )
+
 def search( request, query = None, view = 'boxes' ): # {{{1
     # doc {{{2
     """ View to get the data of a search query.
@@ -1069,6 +1094,19 @@ def search( request, query = None, view = 'boxes' ): # {{{1
     deactivates the inclusion of related events. Notice that some search
     options like '@' (for places) produces no related events. If the value
     cannot be converted to Boolean, or it is not present, we fall back to True.
+
+    ``request`` can also have a ``fuzzy`` value, which if ``1`` or ``true``
+    makes words match also similar words in titles and cities (only with
+    PostgreSQL).
+
+    The view ``clusters`` returns the events found as json clusters for the
+    map, see :func:`search_clusters_json`.
+
+    Results are paginated with opaque ``cursor`` values (see
+    :func:`pagination.keyset_page`) and without counting them, except for
+    the view calendars or if ``request`` has a ``page`` number. The views
+    json, xml and yaml return the urls of the next and previous pages in a
+    ``Link`` header; there are more events if it has a ``next`` url.
     """
     # function body {{{2
     # query, we prioritize /s/?query= in the url but if not present we accept
@@ -1078,7 +1116,7 @@ def search( request, query = None, view = 'boxes' ): # {{{1
     view = request.GET.get('view', 'boxes')
     # shows the homepage with a message if no query, except when view=json
     # because client expect json
-    if (not query) and (view != 'json'):
+    if (not query) and (view not in ('json', 'clusters')):
         # When a client ask for json, html should not be the response
         # TODO: test what happens for empty query with json, xml and yaml
         messages.error(request,
@@ -1093,18 +1131,78 @@ def search( request, query = None, view = 'boxes' ): # {{{1
         related = bool(request.GET.get('related', True))
     except ValueError:
         related = True
+    # fuzzy {{{3
+    # words also match similar words, e.g. with typos
+    fuzzy = request.GET.get( 'fuzzy' ) in ( '1', 'true', 'True' )
+    if view == 'clusters': # {{{3
+        return search_clusters_json( request, query, related, fuzzy )
+    # page_nr {{{3
+    # Make sure page request is an int. If not, deliver first page.
+    try:
+        page_nr = int(request.GET.get('page', '1'))
+    except ValueError:
+        page_nr = 1
+    # limit {{{3
+    # views can have a max limit, which is stored in the dictionary
+    # settings.views_max_limits
+    # however, the user/api can specify a smaller limit
+    limit = request.GET.get( 'limit', settings.DEFAULT_LIMIT )
+    try:
+        limit = int( limit )
+        if limit <= 0 or limit > settings.DEFAULT_LIMIT:
+            limit = settings.DEFAULT_LIMIT
+    except ValueError:
+        limit = settings.DEFAULT_LIMIT
+    max_limit = settings.VIEWS_MAX_LIMITS.get( view, settings.DEFAULT_LIMIT )
+    if limit > max_limit:
+        limit = max_limit
+    # cursor {{{3
+    # pages are selected after the sorting keys of the last event of the
+    # previous page (see pagination.keyset_page) without counting the
+    # result, except for the view calendars and the urls with a page number
+    cursor = request.GET.get( 'cursor', None )
+    keyset = view != 'calendars' and 'page' not in request.GET
+    # events can be sorted by their distance to the point of a radius search
+    by_distance = request.GET.get( 'sort', None ) == 'distance'
     # search {{{3
+    # the result is a sorted list of ids (cached, see search_event_ids) or a
+    # page of ids (see search_event_page), only the rows of the page are
+    # fetched
+    if view == 'boxes' or view == 'calendars':
+        # for the view boxes and calendars we use EventDate model to get
+        # each date of each event
+        model = EventDate
+    else:
+        model = Event
     try:
-        if view == 'boxes' or view == 'calendars':
-            # for the view boxes and calendars we use EventDate model to get
-            # each date of each event
-            search_result = search_events( query, related, model = EventDate )
+        # TODO: the table is sorted by upcoming only, see below
+        if keyset:
+            try:
+                search_result = search_event_page( query, related,
+                        model = model, fuzzy = fuzzy,
+                        ranked = view != 'table', cursor = cursor,
+                        limit = limit, by_distance = by_distance )
+            except InvalidCursorError:
+                # e.g. an edited url or a cursor of another sorting
+                messages.error( request, _( u"The requested page of the"
+                    " results is not valid, the first page is shown" ) )
+                cursor = None
+                search_result = search_event_page( query, related,
+                        model = model, fuzzy = fuzzy,
+                        ranked = view != 'table', limit = limit,
+                        by_distance = by_distance )
         else:
-            search_result = search_events( query, related, model = Event )
-            search_result = add_upcoming( search_result )
-        search_result = add_start( search_result )
-        search_result = add_end( search_result )
-        search_result = search_result.distinct()
+            search_result = search_event_ids( query, related,
+                    model = model, fuzzy = fuzzy, ranked = view != 'table',
+                    by_distance = by_distance )
+        if model == EventDate:
+            # multi-day events are stored as spans without a date for each
+            # day, the days are expanded later only for the rendered page.
+            # The search is built only if expand_ongoing needs it, not e.g.
+            # for a page found in the cache
+            span_events = SimpleLazyObject( lambda: search_events( query,
+                related, model = Event, fuzzy = fuzzy ) )
+            dates_window = query_dates_window( query )
     except (ValueError, GeoLookupError) as err: # TODO: catch other errors
         if isinstance( err, ValueError ):
             # this can happen for instance when a date is malformed like 2011-01-32
@@ -1118,47 +1216,28 @@ def search( request, query = None, view = 'boxes' ): # {{{1
                     _( u"The lookup of the coordinates of the name was not"
                         " possible. You can try using the coordinates instead."
                         " Example: @52.12,13.23+500km" ) )
-        if view == 'boxes' or view == 'calendars':
-            search_result = EventDate.objects.none()
-        else:
-            search_result = Event.objects.none()
+        search_result = CursorPage( [] ) if keyset else []
+        if model == EventDate:
+            span_events = Event.objects.none()
+            dates_window = ( None, None )
     # order {{{3
-    if view == 'boxes' or view == 'calendars':
-        pass
-    elif view == 'table':
+    # events are sorted by search_event_ids: the most relevant first (see
+    # search.add_rank) and by upcoming date
+    if view == 'table':
         sort = request.GET.get( 'sort', 'upcoming' )
         # sanity check
         if sort not in ('upcoming', 'title', 'city', 'country',
-                'start', 'end'):
+                'start', 'end', 'distance'):
             raise Http404
-        # TODO: following line produces an error when sorting after something
-        # else than upcoming. Fix it and change the table template
-        # search_result = search_result.order_by( sort )
-        search_result = search_result.order_by( 'upcoming' )
-    else:
-        search_result = search_result.order_by( 'upcoming' )
-    # page_nr {{{3
-    # Make sure page request is an int. If not, deliver first page.
-    try:
-        page_nr = int(request.GET.get('page', '1'))
-    except ValueError:
-        page_nr = 1
-    # limit {{{3
-    # views can have a max limit, which is stored in the dictionary
-    # settings.views_max_limits
-    # however, the user/api can specify a smaller limit
-    limit = request.GET.get( 'limit', settings.DEFAULT_LIMIT )
-    try:
-        limit = int( limit )
-        if limit <= 0 or limit > settings.DEFAULT_LIMIT:
-            limit = settings.DEFAULT_LIMIT
-    except ValueError:
-        limit = settings.DEFAULT_LIMIT
-    max_limit = settings.VIEWS_MAX_LIMITS.get( view, settings.DEFAULT_LIMIT )
-    if limit > max_limit:
-        limit = max_limit
+        # TODO: sorting after something else than upcoming. Fix it and change
+        # the table template
     if view not in ('table', 'map', 'boxes', 'calendars'):
-        search_result = search_result[(page_nr - 1) * limit : page_nr * limit]
+        if keyset:
+            page = search_result
+            search_result = fetch_search_results( page.object_list )
+        else:
+            search_result = fetch_search_results(
+                search_result[(page_nr - 1) * limit : page_nr * limit] )
         # for the others we use a paginator later on
     # views
     if view in ('json', 'yaml', 'xml'):
@@ -1173,6 +1252,7 @@ def search( request, query = None, view = 'boxes' ): # {{{1
                     'start': e.start,
                     'tags': e.tags,
                     'upcoming': e.upcoming,
+                    'geo_status': e.geo_status,
                     'url': 'http://' + domain + e.get_absolute_url(),
                     # see https://en.wikipedia.org/wiki/GeoJSON
                     'geometry': e.coordinates
@@ -1202,7 +1282,8 @@ def search( request, query = None, view = 'boxes' ): # {{{1
             content_type = "application/javascript"
         else:
             content_type = "application/json"
-        return HttpResponse( content_type = content_type, content = data )
+        return _with_cursor_links( request, page if keyset else None,
+                HttpResponse( content_type = content_type, content = data ) )
     if view == 'xml': # {{{3
         # TODO: use a proper xml library for performance
         data = loader.render_to_string(
@@ -1211,11 +1292,15 @@ def search( request, query = None, view = 'boxes' ): # {{{1
                     'events': event_list_dict,
                     'VERSION': settings.VERSION
                 } )
-        return HttpResponse( content_type = 'application/xml', content = data )
+        return _with_cursor_links( request, page if keyset else None,
+                HttpResponse( content_type = 'application/xml',
+                    content = data ) )
     if view == 'yaml': # {{{3
         # TODO: fix POINT output
         data = yaml.dump( event_list_dict )
-        return HttpResponse( content_type = 'application/x-yaml', content = data )
+        return _with_cursor_links( request, page if keyset else None,
+                HttpResponse( content_type = 'application/x-yaml',
+                    content = data ) )
     # views table, map, boxes or calendars {{{3
     # variables to be passed to the html templates
     context = dict()
@@ -1228,19 +1313,45 @@ def search( request, query = None, view = 'boxes' ): # {{{1
                 'view': view }
     context['user_id'] = request.user.id
     context['query'] = query
-    if isinstance(search_result, QuerySet):
-        n_events = search_result.count()
+    # the search parameters for the urls of the other pages
+    page_params = request.GET.copy()
+    page_params.pop( 'cursor', None )
+    page_params.pop( 'page', None )
+    page_params['query'] = query
+    page_params['view'] = view
+    context['page_params'] = page_params.urlencode()
+    n_events = len( search_result )
+    if keyset and ( cursor or search_result.has_next() ):
+        # with keyset pagination only the events of the page are known (not
+        # the ones of the previous pages if there is a cursor), the total
+        # is counted exactly only up to settings.COUNT_THRESHOLD
+        context['number_of_events_found'] = search_event_count( query,
+                related, model = model, fuzzy = fuzzy )
     else:
-        n_events = len( search_result )
-    context['number_of_events_found'] = n_events
+        context['number_of_events_found'] = n_events
+    if n_events == 0 and view in ( 'boxes', 'calendars' ) and not cursor:
+        # the query can still match days of multi-day events
+        context['eventdates'] = expand_ongoing(
+                [], span_events, *dates_window )
+        n_events = len( context['eventdates'] )
+        context['number_of_events_found'] = n_events
+        search_result = context['eventdates']
+        model = None # already fetched
     if n_events == 0:
         return render(request, 'search.html', context)
     if view in ( 'boxes', 'map', 'calendars', 'table' ):
-        paginator = Paginator( search_result, limit)
-        try:
-            page = paginator.page( page_nr )
-        except ( EmptyPage, InvalidPage ):
-            page = paginator.page( paginator.num_pages )
+        if isinstance( search_result, CursorPage ):
+            page = search_result
+        else:
+            paginator = Paginator( search_result, limit)
+            try:
+                page = paginator.page( page_nr )
+            except ( EmptyPage, InvalidPage ):
+                page = paginator.page( paginator.num_pages )
+        if model:
+            # batched fetch of the rows of the page
+            page.object_list = fetch_search_results(
+                    page.object_list, model )
         context['page'] = page
         if view == 'table':
             context['events_table'] = EventTable(
@@ -1249,13 +1360,43 @@ def search( request, query = None, view = 'boxes' ): # {{{1
             # we use the Django paginator now. In the past for this view:
             #search_result_table.paginate(
             #        Paginator, limit, page = page_nr, orphans = 2 )
+        if view in ( 'boxes', 'calendars' ) and \
+                'eventdates' not in context:
+            # the days of multi-day events inside the dates of the page
+            date1, date2 = dates_window
+            if page.has_previous():
+                date1 = None
+            if page.has_next():
+                date2 = None
+            context['eventdates'] = expand_ongoing( page.object_list,
+                    span_events, date1, date2 )
         if view == 'calendars':
             context['years_cals'] = \
-                    EventsCalendar( page.object_list).years_cals()
+                    EventsCalendar( context['eventdates'] ).years_cals()
     else:
         raise Http404
     return render(request, 'search.html', context)
 
+def _with_cursor_links( request, page, response ): # {{{1
+    """ adds to ``response`` a ``Link`` header with the urls of the next
+    and previous pages of the :class:`pagination.CursorPage` ``page`` (if
+    not None). Clients know that there are more events if there is a
+    ``next`` link. """
+    if page is None:
+        return response
+    links = []
+    for rel, cursor in ( ( 'next', page.next_cursor ),
+            ( 'prev', page.previous_cursor ) ):
+        if cursor is None:
+            continue
+        params = request.GET.copy()
+        params['cursor'] = cursor
+        links.append( '<%s?%s>; rel="%s"' % ( request.build_absolute_uri(
+            request.path ), params.urlencode(), rel ) )
+    if links:
+        response['Link'] = ', '.join( links )
+    return response
+
 # def filter_save( request ): {{{1
 @login_required
 @only_if_write_enabled
@@ -1439,7 +1580,8 @@ def main( request, status_code=200 ):# {{{1
                 if cleaned_data['when'].has_key('endtime'):
                     event.endtime = cleaned_data['when']['endtime']
                 with reversion.create_revision():
-                    event.complete_geo_data(
+                    # the address is completed in the background
+                    event.queue_geo_completion(
                             request.META.get('REMOTE_ADDR', None))
                     event.save()
                     event.startdate = cleaned_data['when']['startdate']
@@ -1470,17 +1612,34 @@ def main( request, status_code=200 ):# {{{1
             eventdate_date__gte = today )
     eventdates = add_start( eventdates )
     eventdates = add_end( eventdates )
-    paginator = Paginator(eventdates, settings.MAX_EVENTS_ON_ROOT_PAGE)
-    # Make sure page request is an int. If not, deliver first page.
-    try:
-        page_nr = int(request.GET.get('page', '1'))
-    except ValueError:
-        page_nr = 1
-    # If page request (9999) is out of range, deliver last page of results.
-    try:
-        page = paginator.page( page_nr )
-    except ( EmptyPage, InvalidPage ):
-        page = paginator.page( paginator.num_pages )
+    if 'page' in request.GET:
+        # the number of pages is counted up to settings.COUNT_THRESHOLD dates
+        paginator = ApproximatePaginator(eventdates,
+                settings.MAX_EVENTS_ON_ROOT_PAGE)
+        # Make sure page request is an int. If not, deliver first page.
+        try:
+            page_nr = int(request.GET.get('page', '1'))
+        except ValueError:
+            page_nr = 1
+        # If page request (9999) is out of range, deliver last page of results.
+        try:
+            page = paginator.page( page_nr )
+        except ( EmptyPage, InvalidPage ):
+            page = paginator.page( paginator.num_pages )
+    else:
+        # keyset pagination, see pagination.keyset_page
+        try:
+            page = keyset_page( eventdates, ( 'eventdate_date', 'id' ),
+                    request.GET.get( 'cursor', None ),
+                    settings.MAX_EVENTS_ON_ROOT_PAGE )
+        except ValueError:
+            page = keyset_page( eventdates, ( 'eventdate_date', 'id' ),
+                    None, settings.MAX_EVENTS_ON_ROOT_PAGE )
+    # ongoing days of multi-day events of the page
+    eventdates = expand_ongoing( page.object_list, Event.objects.defer(
+            'description', 'coordinates', 'creation_time',
+            'modification_time', 'address' ),
+        None if page.has_previous() else today )
     about_text = open(os.path.join(settings.PROGRAM_DIR, 'ABOUT.TXT')).read()
     # We generate the response with a custom status code. Reason: our custom
     # handler404 and handler500 returns the main page with a custom error
@@ -1490,6 +1649,7 @@ def main( request, status_code=200 ):# {{{1
                 'title': Site.objects.get_current().name,
                 'form': event_form,
                 'page': page,
+                'eventdates': eventdates,
                 'reserved_names': EventDate.reserved_names(),
                 'about_text': about_text,
             }
@@ -1702,10 +1862,10 @@ def ICalForSearch( request, query ): # {{{2
     """
     # TODO: add test checking that an event with two dates is not a duplicate
     try:
-        elist = search_events( query ).distinct()
+        elist = fetch_search_results( search_event_ids( query ) )
     except ValueError:
         # this can happen for instance when a date is malformed like 2011-01-32
-        elist = Event.objects.none()
+        elist = []
     domain = Site.objects.get_current().domain
     return _ical_http_response_from_event_list( elist, query,
             calname = domain + " " + query )
@@ -1733,7 +1893,7 @@ def ICalForGroup( request, group_id ): # {{{2
     group = get_object_or_404(Group, pk = group_id)
     today = datetime.date.today()
     elist = Event.objects.filter( calendar__group = group,
-            dates__eventdate_date__gte = today ).distinct()
+            next_date__gte = today ).distinct()
     elist = add_upcoming( elist ).order_by('upcoming')
     domain = Site.objects.get_current().domain
     return _ical_http_response_from_event_list( elist, group.name,
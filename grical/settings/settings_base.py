@@ -76,6 +76,31 @@ default is 20.
 Finally, FEED_SIZE is the limit for feeds. The default is 50.
 """
 
+MAP_CLUSTER_GRID = 8
+MAP_CLUSTER_IDS = 5
+MAP_CLUSTER_MAX_TILES = 16
+MAP_CLUSTER_MAX_ZOOM = 18
+"""
+The map shows all events found as clusters computed by the database. The
+map is divided in square tiles of ``360 / 2 ** zoom`` degrees, and each
+tile in :data:`MAP_CLUSTER_GRID` x :data:`MAP_CLUSTER_GRID` cells; the
+events of a cell are a cluster with the ids of up to
+:data:`MAP_CLUSTER_IDS` of them. A request for more than
+:data:`MAP_CLUSTER_MAX_TILES` tiles uses a smaller zoom, and zoom levels
+are at most :data:`MAP_CLUSTER_MAX_ZOOM`. The defaults are 8, 5, 16 and 18.
+"""
+
+COUNT_THRESHOLD = 1000
+COUNT_STRATEGY = 'capped'
+"""
+The number of events found by a search is counted exactly only up to
+:data:`COUNT_THRESHOLD` events. Above it, with :data:`COUNT_STRATEGY`
+``'capped'`` the number is shown as e.g. ``1000+``, and with
+``'estimate'`` the estimate of rows of the query planner is shown as e.g.
+``~12000`` (only with PostgreSQL, otherwise it falls back to ``'capped'``).
+The defaults are 1000 and ``'capped'``.
+"""
+
 # dates thereafter from now are not allowed
 MAX_DAYS_IN_FUTURE = 1095 # 3 years: 365 * 3
 """
@@ -135,6 +160,76 @@ Reply-To header will be added.
 EMAIL_HOST = 'localhost'
 EMAIL_BACKEND = "django.core.mail.backends.console.EmailBackend"
 
+# notifications of filters matching new events
+NOTIFICATION_DIGEST_WINDOW = 600
+NOTIFICATION_BATCH_SIZE = 100
+NOTIFICATION_BATCH_MAX_RETRIES = 5
+NOTIFICATION_SHARD_SIZE = 500
+"""
+Matches of filters with new events are queued and sent to users as
+digests (one email per user) :data:`NOTIFICATION_DIGEST_WINDOW`
+seconds after the first match was queued. The default is 600.
+
+Digests are sent in batches of :data:`NOTIFICATION_BATCH_SIZE` users,
+each batch using only one SMTP connection. A batch is retried up to
+:data:`NOTIFICATION_BATCH_MAX_RETRIES` times if the SMTP server fails,
+sending only the digests not sent before the failure.
+The defaults are 100 and 5.
+
+The candidate filters for a new event are checked in parallel tasks
+of :data:`NOTIFICATION_SHARD_SIZE` filters each. The default is 500.
+
+For load tests the management command ``smtpsink`` runs a local SMTP
+server which only counts the received emails. Set ``EMAIL_BACKEND`` to
+``django.core.mail.backends.smtp.EmailBackend`` and ``EMAIL_PORT`` to
+its port.
+"""
+
+# completion of geo data of new events
+GEO_COMPLETION_MAX_RETRIES = 5
+"""
+The coordinates, city, country and timezone of new events are completed
+in the background by the task ``complete_geo_data``, which calls external
+APIs. If the coordinates cannot be found, it is retried with increasing
+delays (1, 2, 4... minutes) up to :data:`GEO_COMPLETION_MAX_RETRIES`
+times, and the event is then marked as failed. The default is 5.
+
+The management command ``completegeodata`` queues again the events still
+pending, e.g. after the task queue was not available.
+"""
+
+# full-text search of events
+FULL_TEXT_SEARCH_CONFIG = 'english'
+"""
+The PostgreSQL text search configuration used for the full-text search
+document of events and for the words of queries. It determines the
+language of the stemming and of the stop words. The default is
+``english``. After changing it, run the management command
+``updatesearchdocuments``. Other databases don't use full-text search.
+"""
+
+# search
+SEARCH_PLAN_CACHE_SIZE = 1000
+"""
+Parsed queries (including the coordinates of the names of places) are
+kept in a cache of :data:`SEARCH_PLAN_CACHE_SIZE` entries in each process,
+shared by the views, the feeds and the filters. The default is 1000.
+"""
+
+SEARCH_RESULTS_CACHE_TIMEOUT = 60 * 60
+"""
+Seconds the ids of the result of a search are kept in the cache for the
+views and feeds. Entries are invalidated earlier when events which can be
+in the result change. The default is one hour.
+"""
+
+SEARCH_RELATED_TAGS = 10
+"""
+Maximum number of tags used to add related events to the result of a
+search: the tags which are most often used together with the words of the
+query. The default is 10.
+"""
+
 # =============================================================================
 # GeoIP, GEONAME and django-countries settings {{{1
 # =============================================================================
@@ -157,6 +252,82 @@ these settings to logon to Geonames. The default
 :data:`GEONAMES_URL` is http://api.geonames.org/, and the default
 :data:`GEONAMES_USERNAME` is "demo".
 """
+GEOCODER_RATES = {
+    'nominatim': 1,
+    'google': 10,
+    'geonames': 1,
+}
+GEOCODER_TIMEOUT = 10
+GEOCODER_MAX_WAIT = 5
+GEOCODER_FAILURES = 5
+GEOCODER_RESET_TIMEOUT = 300
+GEOCODER_USER_AGENT = 'GriCal'
+"""
+The external geocoding APIs (OpenStreetMap Nominatim, Google and
+GeoNames) are called with kept-alive connections and at most
+:data:`GEOCODER_RATES` requests per second each, counted in the cache
+for all processes. A request waits up to :data:`GEOCODER_MAX_WAIT`
+seconds for the rate limit and :data:`GEOCODER_TIMEOUT` seconds for the
+response. After :data:`GEOCODER_FAILURES` consecutive failures an API is
+not called during :data:`GEOCODER_RESET_TIMEOUT` seconds. Requests are
+sent with the ``User-Agent`` :data:`GEOCODER_USER_AGENT`.
+"""
+GEO_CACHE_SIZE = 10000
+GEO_CACHE_TIMEOUT = 60 * 60 * 24 * 31
+GEO_CACHE_NEGATIVE_TIMEOUT = 300
+"""
+Results of the external geocoding APIs are cached in memory
+(:data:`GEO_CACHE_SIZE` entries per process), in the ``default`` cache and
+in the ``db`` cache (see ``CACHES``) for :data:`GEO_CACHE_TIMEOUT` seconds.
+Lookups without a result are cached for
+:data:`GEO_CACHE_NEGATIVE_TIMEOUT` seconds. The defaults are 10000, 31
+days and 300. The command ``geocachestats`` shows the hits of each cache.
+"""
+GEONAMES_REMOTE_FALLBACK = True
+"""
+Names of locations are looked up in a local gazetteer loaded from a
+GeoNames dump with the command ``loadgeonames``, and timezones in the
+polygons of timezones loaded with the command ``loadtimezones``. If this
+setting is True, names and timezones not found are looked up with the
+Geonames API. You can set it to False once the data is loaded to avoid any
+network access. The default is True.
+"""
+EVENT_PLACE_MIN_EVENTS = 3
+"""
+Cities are looked up first in the places of the events, built periodically
+(e.g. daily with cron) with the command ``rebuildplaces``, and then in the
+gazetteer. A place is only used if it has at least this number of events
+with coordinates, so that one event with a mistyped city or wrong
+coordinates doesn't change the lookups of other events. The default is 3.
+"""
+TIMEZONE_SIMPLIFY_TOLERANCE = 0.01
+"""
+Maximum deviation in degrees of the simplified polygons of timezones,
+which are kept in memory, from the real ones. Only points nearer to the
+boundary of a timezone are looked up in the database. The default is 0.01
+(about 1 km).
+"""
+COUNTRY_SIMPLIFY_TOLERANCE = 0.01
+CONTINENT_SIMPLIFY_TOLERANCE = 0.1
+"""
+Maximum deviation in degrees of the simplified borders of countries and
+continents, which are kept in memory for finding the country and continent
+of coordinates, from the real ones. The defaults are 0.01 (about 1 km) and
+0.1.
+"""
+BORDER_SIMPLIFY_TOLERANCES = ( 0.001, 0.01, 0.1 )
+"""
+Tolerances in degrees of the simplified borders of countries and continents
+stored in the database by the command ``simplifyborders``. Other tolerances
+are computed when needed. The default is (0.001, 0.01, 0.1).
+"""
+REVERSE_GEOCODER_PRECISION = 4
+REVERSE_GEOCODER_CACHE_SIZE = 10000
+"""
+The countries of coordinates are cached in memory by coordinates rounded to
+:data:`REVERSE_GEOCODER_PRECISION` decimals (default 4, about 10 m), up to
+:data:`REVERSE_GEOCODER_CACHE_SIZE` entries (default 10000).
+"""
 
 # Default value for distance unit, possible values are: 'km' and 'mi'
 DISTANCE_UNIT_DEFAULT = 'km' # alternative: 'mi'
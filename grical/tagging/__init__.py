@@ -54,7 +54,9 @@ def register(model, tag_descriptor_attr='tags',
     Sets the given model class up for working with tags.
     """
 
+    from django.db.models import signals
     from tagging.managers import ModelTaggedItemManager, TagDescriptor
+    from tagging.models import delete_object_tags
 
     if model in registry:
         raise AlreadyRegistered("The model '%s' has already been "
@@ -80,5 +82,8 @@ def register(model, tag_descriptor_attr='tags',
     # Add custom manager
     ModelTaggedItemManager().contribute_to_class(model, tagged_item_manager_attr)
 
+    # Remove the tags of deleted objects
+    signals.pre_delete.connect(delete_object_tags, model)
+
     # Finally register in registry
     registry.append(model)
@@ -28,7 +28,7 @@ from django.db.models.fields import CharField
 from django.utils.translation import ugettext_lazy as _
 
 from grical.tagging import settings
-from grical.tagging.models import Tag
+from grical.tagging.models import Tag, delete_object_tags
 from grical.tagging.utils import edit_string_for_tags
 
 class TagField(CharField):
@@ -50,6 +50,8 @@ class TagField(CharField):
 
         # Save tags back to the database post-save
         signals.post_save.connect(self._save, cls, True)
+        # Remove the tags of deleted objects
+        signals.pre_delete.connect(delete_object_tags, cls)
 
     def __get__(self, instance, owner=None):
         """
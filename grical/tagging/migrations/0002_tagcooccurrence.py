@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 textwidth=79 foldmethod=marker:
+# gpl {{{1
+#############################################################################
+# Copyright 2009-2016 Stefanos Kozanis <stefanos ät wikical.com>
+#
+# This file is part of GriCal.
+#
+# GriCal is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# GriCal is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the Affero GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with GriCal. If not, see <http://www.gnu.org/licenses/>.
+#############################################################################
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+FILL_SQL = """INSERT INTO tagging_tagcooccurrence
+    (tag_id, related_id, content_type_id, count, score)
+    SELECT a.tag_id, b.tag_id, a.content_type_id, COUNT(*), 0
+    FROM tagging_taggeditem a INNER JOIN tagging_taggeditem b
+      ON a.content_type_id = b.content_type_id
+     AND a.object_id = b.object_id
+    GROUP BY a.tag_id, b.tag_id, a.content_type_id"""
+
+SCORES_SQL = """UPDATE tagging_tagcooccurrence SET score =
+    tagging_tagcooccurrence.count * 1.0 / (
+        (SELECT u.count FROM tagging_tagcooccurrence u
+         WHERE u.content_type_id = tagging_tagcooccurrence.content_type_id
+           AND u.tag_id = tagging_tagcooccurrence.tag_id
+           AND u.related_id = tagging_tagcooccurrence.tag_id) +
+        (SELECT u.count FROM tagging_tagcooccurrence u
+         WHERE u.content_type_id = tagging_tagcooccurrence.content_type_id
+           AND u.tag_id = tagging_tagcooccurrence.related_id
+           AND u.related_id = tagging_tagcooccurrence.related_id) -
+        tagging_tagcooccurrence.count)"""
+
+
+def fill_cooccurrences(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(FILL_SQL)
+        cursor.execute(SCORES_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('tagging', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TagCooccurrence',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='count')),
+                ('score', models.FloatField(default=0, verbose_name='score')),
+                ('content_type', models.ForeignKey(to='contenttypes.ContentType', verbose_name='content type')),
+                ('related', models.ForeignKey(related_name='+', to='tagging.Tag', verbose_name='related tag')),
+                ('tag', models.ForeignKey(related_name='cooccurrences', to='tagging.Tag', verbose_name='tag')),
+            ],
+            options={
+                'verbose_name': 'tag co-occurrence',
+                'verbose_name_plural': 'tag co-occurrences',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='tagcooccurrence',
+            unique_together=set([('content_type', 'tag', 'related')]),
+        ),
+        migrations.RunPython(fill_cooccurrences, migrations.RunPython.noop),
+    ]
@@ -25,7 +25,8 @@ Models and managers for generic tagging.
 """
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.db import connection, models
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import F, Sum
 from django.utils.translation import ugettext_lazy as _
 
 from grical.tagging import settings
@@ -64,10 +65,15 @@ class TagManager(models.Manager):
                                                tag__in=tags_for_removal).delete()
         # Add new tags
         current_tag_names = [tag.name for tag in current_tags]
+        updated_tags = [tag for tag in current_tags \
+                        if tag not in tags_for_removal]
         for tag_name in updated_tag_names:
             if tag_name not in current_tag_names:
                 tag, created = self.get_or_create(name=tag_name)
                 TaggedItem._default_manager.create(tag=tag, object=obj)
+                updated_tags.append(tag)
+        TagCooccurrence._default_manager.update_counts(
+            ctype, current_tags, updated_tags)
 
     def add_tag(self, obj, tag_name):
         """
@@ -85,8 +91,12 @@ class TagManager(models.Manager):
             tag_name = tag_name.lower()
         tag, created = self.get_or_create(name=tag_name)
         ctype = ContentType.objects.get_for_model(obj)
-        TaggedItem._default_manager.get_or_create(
+        current_tags = list(self.get_for_object(obj))
+        item, created = TaggedItem._default_manager.get_or_create(
             tag=tag, content_type=ctype, object_id=obj.pk)
+        if created:
+            TagCooccurrence._default_manager.update_counts(
+                ctype, current_tags, current_tags + [tag])
 
     def get_for_object(self, obj):
         """
@@ -480,6 +490,175 @@ class TaggedItemManager(models.Manager):
         return self.get(
                 tag = tag, content_type = content_type, object_id = object_id )
 
+class TagCooccurrenceManager(models.Manager):
+
+    def update_counts(self, content_type, old_tags, new_tags):
+        """
+        Update the co-occurrences of the tags of an object of
+        ``content_type`` whose tags changed from the list ``old_tags`` to
+        the list ``new_tags``.
+
+        Only the rows of the added and removed tags change: the pairs of
+        a removed tag and a former tag are decreased, the pairs of an
+        added tag and a new tag are increased, and then their scores are
+        recalculated.
+
+        The rows of new pairs can be created at the same time by the save
+        of another object: PostgreSQL inserts them with ``ON CONFLICT DO
+        UPDATE``, other databases create them in a savepoint and increase
+        them if the unique index already has them.
+        """
+        old = set([tag.pk for tag in old_tags])
+        new = set([tag.pk for tag in new_tags])
+        removed = old - new
+        added = new - old
+        kept = old & new
+        if not removed and not added:
+            return
+        rows = self.filter(content_type__pk=content_type.pk)
+        if removed:
+            rows.filter(tag__in=removed, related__in=old).update(
+                count=F('count') - 1)
+            if kept:
+                rows.filter(tag__in=kept, related__in=removed).update(
+                    count=F('count') - 1)
+            rows.filter(count__lte=0).delete()
+        if added:
+            # sorted to lock the rows in the same order in all transactions
+            pairs = sorted(
+                [(tag, related) for tag in added for related in new] +
+                [(tag, related) for tag in kept for related in added])
+            if connection.vendor == 'postgresql':
+                self._upsert_counts(content_type, pairs)
+            else:
+                increased = rows.filter(
+                    models.Q(tag__in=added, related__in=new) |
+                    models.Q(tag__in=kept, related__in=added))
+                existing = set(increased.values_list('tag_id', 'related_id'))
+                increased.update(count=F('count') + 1)
+                for tag, related in pairs:
+                    if (tag, related) in existing:
+                        continue
+                    try:
+                        with transaction.atomic():
+                            self.create(tag_id=tag, related_id=related,
+                                        content_type=content_type, count=1)
+                    except IntegrityError:
+                        rows.filter(tag=tag, related=related).update(
+                            count=F('count') + 1)
+        self.update_scores(content_type, removed | added)
+
+    def _upsert_counts(self, content_type, pairs):
+        """
+        Increase the counts of the co-occurrences of the ``(tag_id,
+        related_id)`` pairs ``pairs`` by one, inserting the missing rows,
+        in one statement (PostgreSQL only).
+        """
+        query = """
+        INSERT INTO %(table)s
+            (content_type_id, tag_id, related_id, %(count)s, %(score)s)
+        VALUES %(values)s
+        ON CONFLICT (content_type_id, tag_id, related_id)
+        DO UPDATE SET %(count)s = %(table)s.%(count)s + EXCLUDED.%(count)s
+        """ % {
+            'table': qn(self.model._meta.db_table),
+            'score': qn('score'),
+            'count': qn('count'),
+            'values': ','.join(['(%s, %s, %s, 1, 0)'] * len(pairs)),
+        }
+        params = []
+        for tag, related in pairs:
+            params.extend([content_type.pk, tag, related])
+        cursor = connection.cursor()
+        cursor.execute(query, params)
+
+    def update_scores(self, content_type, tag_ids=None):
+        """
+        Recalculate the ``score`` of the co-occurrences of
+        ``content_type``, only of the rows with a tag or related tag in
+        ``tag_ids`` if given.
+
+        The score of two tags is the Jaccard index of their sets of
+        objects: the number of objects with both tags divided by the
+        number of objects with any of them (the number of objects with a
+        tag is stored as the co-occurrence of the tag with itself).
+        """
+        query = """
+        UPDATE %(table)s SET %(score)s = %(table)s.%(count)s * 1.0 / (
+            (SELECT u.%(count)s FROM %(table)s u
+             WHERE u.content_type_id = %(table)s.content_type_id
+               AND u.tag_id = %(table)s.tag_id
+               AND u.related_id = %(table)s.tag_id) +
+            (SELECT u.%(count)s FROM %(table)s u
+             WHERE u.content_type_id = %(table)s.content_type_id
+               AND u.tag_id = %(table)s.related_id
+               AND u.related_id = %(table)s.related_id) -
+            %(table)s.%(count)s)
+        WHERE %(table)s.content_type_id = %%s
+        %(tags_sql)s""" % {
+            'table': qn(self.model._meta.db_table),
+            'score': qn('score'),
+            'count': qn('count'),
+            'tags_sql': tag_ids and
+                'AND (%(table)s.tag_id IN (%(ids)s) OR '
+                '%(table)s.related_id IN (%(ids)s))' % {
+                    'table': qn(self.model._meta.db_table),
+                    'ids': ','.join(['%s'] * len(tag_ids))} or '',
+        }
+        params = [content_type.pk]
+        if tag_ids:
+            params.extend(list(tag_ids) * 2)
+        cursor = connection.cursor()
+        cursor.execute(query, params)
+
+    def rebuild(self, model):
+        """
+        Recount the co-occurrences of the tags of all objects of ``model``
+        and return the number of rows.
+        """
+        content_type = ContentType.objects.get_for_model(model)
+        self.filter(content_type=content_type).delete()
+        query = """
+        INSERT INTO %(table)s (tag_id, related_id, content_type_id,
+                               %(count)s, %(score)s)
+        SELECT a.tag_id, b.tag_id, a.content_type_id, COUNT(*), 0
+        FROM %(tagged_item)s a INNER JOIN %(tagged_item)s b
+          ON a.content_type_id = b.content_type_id
+         AND a.object_id = b.object_id
+        WHERE a.content_type_id = %%s
+        GROUP BY a.tag_id, b.tag_id, a.content_type_id""" % {
+            'table': qn(self.model._meta.db_table),
+            'count': qn('count'),
+            'score': qn('score'),
+            'tagged_item': qn(TaggedItem._meta.db_table),
+        }
+        cursor = connection.cursor()
+        cursor.execute(query, [content_type.pk])
+        count = cursor.rowcount
+        self.update_scores(content_type)
+        return count
+
+    def related_for_tags(self, tags, model, limit=None):
+        """
+        Obtain a list of the names of the tags used together with any of
+        the given tags (names) by objects of ``model``, excluding the
+        given tags, the most related first: sorted by the sum of the
+        scores of their co-occurrences with the given tags.
+
+        If ``limit`` is given, only the first ``limit`` tags are returned.
+        """
+        tags = list(tags)
+        if not tags:
+            return []
+        content_type = ContentType.objects.get_for_model(model)
+        related = self.filter(content_type=content_type,
+                              tag__name__in=tags).exclude(
+            related__name__in=tags).values('related__name').annotate(
+            weight=Sum('score')).order_by('-weight', 'related__name')
+        if limit:
+            related = related[:limit]
+        return [row['related__name'] for row in related]
+
 ##########
 # Models #
 ##########
@@ -531,4 +710,39 @@ class TaggedItem(models.Model):
     natural_key.dependencies = ['tagging.tag', 'contenttypes.contenttype']
     # TODO: possible to dinamically add the dependency of object_id ?
 
-    # TODO: check what happens with the TaggedItem of an event if it is deleted
+class TagCooccurrence(models.Model):
+    """
+    Holds the number of objects of a content type with both ``tag`` and
+    ``related``, and a normalized ``score``, see
+    :meth:`TagCooccurrenceManager.update_scores`. Rows are stored in both
+    directions, and the row of a tag with itself holds the number of
+    objects with the tag.
+    """
+    tag          = models.ForeignKey(Tag, verbose_name=_('tag'),
+                                     related_name='cooccurrences')
+    related      = models.ForeignKey(Tag, verbose_name=_('related tag'),
+                                     related_name='+')
+    content_type = models.ForeignKey(ContentType,
+                                     verbose_name=_('content type'))
+    count        = models.PositiveIntegerField(_('count'), default=0)
+    score        = models.FloatField(_('score'), default=0)
+
+    objects = TagCooccurrenceManager()
+
+    class Meta:
+        # the unique index is used for the lookups of related tags
+        unique_together = (('content_type', 'tag', 'related'),)
+        verbose_name = _('tag co-occurrence')
+        verbose_name_plural = _('tag co-occurrences')
+
+    def __unicode__(self):
+        return u'%s + %s: %d' % (self.tag, self.related, self.count)
+
+def delete_object_tags(sender, instance, **kwargs):
+    """
+    ``pre_delete`` receiver of tagged models (see ``TagField`` and
+    ``tagging.register``) removing the tags of a deleted object, so that
+    its tagged items are deleted and the co-occurrences of its tags are
+    decreased.
+    """
+    Tag.objects.update_tags(instance, None)
@@ -28,7 +28,7 @@ from django.db.models import Q
 from django.test import TestCase
 from grical.tagging.forms import TagField
 from grical.tagging import settings
-from grical.tagging.models import Tag, TaggedItem
+from grical.tagging.models import Tag, TagCooccurrence, TaggedItem
 from grical.tagging.tests.models import Article, Link, Perch, Parrot, FormTest
 from grical.tagging.utils import calculate_cloud, edit_string_for_tags, get_tag_list, get_tag, parse_tag_input
 from grical.tagging.utils import LINEAR
@@ -605,6 +605,65 @@ class TestTagsRelatedForModel(TestCase):
         relevant_attribute_list = [(tag.name, tag.count) for tag in related_tags]
         self.assertEquals(len(relevant_attribute_list), 0)
 
+class TestTagCooccurrence(TestCase):
+    def setUp(self):
+        parrot_details = (
+            ('pining for the fjords', 'foo bar'),
+            ('passed on',             'bar baz ter'),
+            ('no more',               'foo ter'),
+            ('late',                  'bar ter'),
+        )
+
+        for state, tags in parrot_details:
+            parrot = Parrot.objects.create(state=state)
+            Tag.objects.update_tags(parrot, tags)
+
+    def cooccurrences(self):
+        return sorted(TagCooccurrence.objects.values_list(
+            'tag__name', 'related__name', 'count', 'score'))
+
+    def test_related_for_tags(self):
+        # scores: ter 2/4, baz 1/3, foo 1/4
+        self.assertEquals(
+            TagCooccurrence.objects.related_for_tags(['bar'], Parrot),
+            [u'ter', u'baz', u'foo'])
+        self.assertEquals(
+            TagCooccurrence.objects.related_for_tags(['bar'], Parrot, 1),
+            [u'ter'])
+        self.assertEquals(
+            TagCooccurrence.objects.related_for_tags(['bar', 'ter'], Parrot),
+            [u'baz', u'foo'])
+        self.assertEquals(
+            TagCooccurrence.objects.related_for_tags(['nonexistent'], Parrot),
+            [])
+
+    def test_incremental_update(self):
+        parrot = Parrot.objects.get(state='late')
+        Tag.objects.update_tags(parrot, 'bar foo')
+        self.assertEquals(
+            TagCooccurrence.objects.related_for_tags(['bar'], Parrot),
+            [u'foo', u'baz', u'ter'])
+        Tag.objects.add_tag(parrot, 'baz')
+        Tag.objects.update_tags(Parrot.objects.get(state='no more'), None)
+        incremental = self.cooccurrences()
+        TagCooccurrence.objects.rebuild(Parrot)
+        self.assertEquals(incremental, self.cooccurrences())
+
+    def test_deleted_object(self):
+        first = FormTest.objects.create(tags=u'spam eggs')
+        first_id = first.pk
+        FormTest.objects.create(tags=u'spam ham')
+        FormTest.objects.create(tags=u'spam ham')
+        self.assertEquals(
+            TagCooccurrence.objects.related_for_tags(['spam'], FormTest),
+            [u'ham', u'eggs'])
+        first.delete()
+        self.assertEquals(
+            TagCooccurrence.objects.related_for_tags(['spam'], FormTest),
+            [u'ham'])
+        self.assertFalse(TaggedItem.objects.filter(object_id=first_id,
+            tag__name=u'eggs').exists())
+
 class TestGetTaggedObjectsByModel(TestCase):
     def setUp(self):
         parrot_details = (